@@ -1,16 +1,76 @@
+import asyncio
 import datetime
 import os
+import time
+from functools import wraps
 from typing import Optional
 
-import aioboto3
-import boto3
 from azure.storage.blob import BlobSasPermissions, generate_blob_sas
 from azure.storage.blob.aio import BlobClient, ContainerClient
 from botocore.exceptions import ClientError
-from helpers.samples import get_spectrogram_image
+from cachetools import TTLCache
+from helpers.blobinfo import blob_info_cache
+from helpers.blockcache import block_cache
+from helpers.cipher import decrypt
+from helpers.localio import read_local_file, run_local_io
+from helpers.metrics import observe_storage_call
+from helpers.mmapcache import mmap_cache
+from helpers.samples import get_bytes_per_iq_sample, get_spectrogram_image
 from helpers.urlmapping import ApiType, get_file_name
 from pydantic import SecretStr
 
+from . import client_pool
+from .database import db
+from .models import DataSource
+
+LOCAL_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# SAS tokens handed out by generate_sas_token are valid for an hour and reused for the first 45 minutes, so the
+# client always gets at least 15 minutes out of one
+SAS_TOKEN_LIFETIME = datetime.timedelta(hours=1)
+SAS_TOKEN_REUSE_SECONDS = 45 * 60
+_sas_tokens: TTLCache = TTLCache(maxsize=10_000, ttl=SAS_TOKEN_REUSE_SECONDS)
+
+
+def iter_local_file(path: str, offset: Optional[int] = None, length: Optional[int] = None):
+    # Large chunks instead of iterating the file object, which splits a binary file on newlines. This is a plain
+    # generator so StreamingResponse runs the reads in its threadpool rather than on the event loop.
+    with open(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(LOCAL_STREAM_CHUNK_SIZE if remaining is None else min(LOCAL_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def timed_storage_call(operation: str):
+    # Counts and times the storage calls of AzureBlobClient by backend, reads also count the bytes they returned
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            outcome = "cancelled"
+            result = None
+            try:
+                result = await func(self, *args, **kwargs)
+                outcome = "ok"
+                return result
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                bytes_read = len(result) if isinstance(result, (bytes, memoryview)) else None
+                observe_storage_call(self.backend, operation, time.perf_counter() - start, outcome, bytes_read)
+
+        return wrapper
+
+    return decorator
+
 
 # IQEngine-oriented wrappers around the Azure BlobClient class.
 class AzureBlobClient:
@@ -33,6 +93,26 @@ class AzureBlobClient:
             if not self.base_filepath:
                 raise Exception("IQENGINE_BACKEND_LOCAL_FILEPATH must be set to use local")
 
+    @classmethod
+    def from_datasource(cls, datasource: DataSource) -> "AzureBlobClient":
+        # A client with the datasource's credentials set, decrypting them is cached in helpers.cipher
+        azure_client = cls(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
+        if datasource.sasToken:
+            azure_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
+        if datasource.accountKey:
+            azure_client.set_account_key(decrypt(datasource.accountKey.get_secret_value()))
+        if datasource.awsSecretAccessKey:
+            azure_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
+        return azure_client
+
+    @property
+    def backend(self) -> str:
+        if self.account == "local":
+            return "local"
+        if self.awsAccessKeyId:
+            return "s3"
+        return "azure"
+
     def set_sas_token(self, sas_token):
         self.sas_token = sas_token
 
@@ -66,114 +146,100 @@ class AzureBlobClient:
             return None
         elif self.awsAccessKeyId:
             return None
-        # Azure Blob (every case below)
-        elif self.account_key:
-            sas_token = self.generate_sas_token(filepath, self.account_key.get_secret_value(), True)
-            blob_client = BlobClient.from_blob_url(
-                f"https://{self.account}.blob.core.windows.net/" f"{self.container}/{filepath}",
-                credential=sas_token,
-            )
-        elif not self.sas_token:
-            blob_client = BlobClient.from_blob_url(f"https://{self.account}.blob.core.windows.net/" f"{self.container}/{filepath}")
-        else:
-            blob_client = BlobClient.from_blob_url(
-                f"https://{self.account}.blob.core.windows.net/" f"{self.container}/{filepath}",
-                credential=self.sas_token.get_secret_value(),
-            )
+        # Azure Blob, blob clients share the connection pool of the long-lived container client
+        blob_client = self.get_container_client().get_blob_client(filepath)
         self.clients[filepath] = blob_client
         return blob_client
 
     async def close_blob_clients(self):
+        # The underlying transport belongs to the pooled container client, this only releases the per-blob wrappers
         for client in self.clients.values():
             await client.close()
+        self.clients = {}
 
-    def get_container_client(self):
+    def get_container_client(self) -> Optional[ContainerClient]:
         if self.account == "local":
             return None
         elif self.awsAccessKeyId:
             return None
-        elif not self.sas_token:
-            return ContainerClient.from_container_url(f"https://{self.account}.blob.core.windows.net/{self.container}")
-        return ContainerClient.from_container_url(
-            f"https://{self.account}.blob.core.windows.net/{self.container}",
-            credential=self.sas_token.get_secret_value(),
+        return client_pool.get_container_client(
+            self.account,
+            self.container,
+            sas_token=self.sas_token.get_secret_value() if self.sas_token else None,
+            account_key=self.account_key.get_secret_value() if self.account_key else None,
         )
 
+    async def get_s3_client(self):
+        return await client_pool.get_s3_client(self.account, self.awsAccessKeyId, self.awsSecretAccessKey.get_secret_value())
+
     async def get_blob_content(self, filepath: str, offset: Optional[int] = None, length: Optional[int] = None) -> bytes:
+        # Only range reads go through the block cache, whole-blob reads are metas/minimaps/thumbnails that get rewritten.
+        # Local files skip it too, the page cache behind the memory maps already does that job.
+        if offset is None or length is None or self.account == "local":
+            return await self._get_blob_content(filepath, offset, length)
+        key = (self.account, self.container, filepath, offset, length)
+        content = block_cache.get(key)
+        if content is None:
+            content = await self._get_blob_content(filepath, offset, length)
+            block_cache.put(key, content)
+        return content
+
+    @timed_storage_call("read")
+    async def _get_blob_content(self, filepath: str, offset: Optional[int] = None, length: Optional[int] = None) -> bytes:
         if self.account == "local":
             if ".." in filepath:
                 raise Exception("Invalid filepath")
-            with open(os.path.join(self.base_filepath, filepath), "rb") as f:
-                f.seek(offset)
-                return f.read(length)
+            # range reads of recordings are memoryviews into the mapped file
+            use_mmap = filepath.endswith(".sigmf-data") and mmap_cache.max_handles > 0
+            return await run_local_io(read_local_file, os.path.join(self.base_filepath, filepath), offset, length, use_mmap)
         elif self.awsAccessKeyId:  # S3
-            session = aioboto3.Session()
-            async with session.client(
-                "s3",
-                aws_access_key_id=self.awsAccessKeyId,
-                aws_secret_access_key=self.awsSecretAccessKey.get_secret_value(),
-                region_name=self.account,
-            ) as s3_client:
-                if length is not None and offset is not None:
-                    byte_range = f"bytes={offset}-{offset + length - 1}"
-                    obj = await s3_client.get_object(Bucket=self.container, Key=filepath, Range=byte_range)
-                else:
-                    obj = await s3_client.get_object(Bucket=self.container, Key=filepath)
-                return await obj["Body"].read()
+            s3_client = await self.get_s3_client()
+            if length is not None and offset is not None:
+                byte_range = f"bytes={offset}-{offset + length - 1}"
+                obj = await s3_client.get_object(Bucket=self.container, Key=filepath, Range=byte_range)
+            else:
+                obj = await s3_client.get_object(Bucket=self.container, Key=filepath)
+            return await obj["Body"].read()
         else:  # Azure blob
             blob_client = self.get_blob_client(filepath)
             blob = await blob_client.download_blob(offset=offset, length=length)
             return await blob.readall()
 
+    @timed_storage_call("open_stream")
     async def get_blob_stream(self, filepath: str, offset: Optional[int] = None, length: Optional[int] = None):
         if self.account == "local":
             if ".." in filepath:
                 raise Exception("Invalid filepath")
-            f = open(os.path.join(self.base_filepath, filepath), "rb")
-            if offset:
-                f.seek(offset)
-            return f  # TODO: this leads to the download being pretty slow because it feeds it byte by byte
+            return iter_local_file(os.path.join(self.base_filepath, filepath), offset, length)
         if self.awsAccessKeyId:  # S3
-            session = aioboto3.Session()
-            s3_client = await session.client(
-                "s3",
-                aws_access_key_id=self.awsAccessKeyId,
-                aws_secret_access_key=self.awsSecretAccessKey.get_secret_value(),
-                region_name=self.account,
-            ).__aenter__()
-            try:
-                if length is not None and offset is not None:
-                    byte_range = f"bytes={offset}-{offset + length - 1}"
-                    obj = await s3_client.get_object(Bucket=self.container, Key=filepath, Range=byte_range)
-                else:
-                    obj = await s3_client.get_object(Bucket=self.container, Key=filepath)
-                return obj["Body"]
-            except Exception as e:
-                await s3_client.__aexit__(type(e), e, e.__traceback__)
-                raise
+            s3_client = await self.get_s3_client()
+            if length is not None and offset is not None:
+                byte_range = f"bytes={offset}-{offset + length - 1}"
+                obj = await s3_client.get_object(Bucket=self.container, Key=filepath, Range=byte_range)
+            else:
+                obj = await s3_client.get_object(Bucket=self.container, Key=filepath)
+            return obj["Body"]
         else:
             blob_client = self.get_blob_client(filepath)
             # returns type StorageStreamDownloader, an Azure class, we use its chunks() method which returns Iterator[bytes]
             blob = await blob_client.download_blob(offset=offset, length=length)
             return blob.chunks()
 
+    @timed_storage_call("upload")
     async def upload_blob(self, filepath: str, data: bytes):
+        block_cache.invalidate(self.account, self.container, filepath)
+        blob_info_cache.invalidate(self.account, self.container, filepath)
         if self.account == "local":
             # print("Cannot upload to local") # making this a raise() was causing delay
             return
         if self.awsAccessKeyId:  # S3
             # Upload data to filepath in s3
-            session = aioboto3.Session()
-            async with session.client(
-                "s3",
-                aws_access_key_id=self.awsAccessKeyId,
-                aws_secret_access_key=self.awsSecretAccessKey.get_secret_value(),
-                region_name=self.account,
-            ) as s3_client:
-                await s3_client.put_object(Bucket=self.container, Key=filepath, Body=data)
-            return
-        blob_client = self.get_blob_client(filepath)
-        await blob_client.upload_blob(data, overwrite=True)
+            s3_client = await self.get_s3_client()
+            await s3_client.put_object(Bucket=self.container, Key=filepath, Body=data)
+        else:
+            blob_client = self.get_blob_client(filepath)
+            await blob_client.upload_blob(data, overwrite=True)
+        blob_info_cache.set_size(self.account, self.container, filepath, len(data))
 
     async def get_new_thumbnail(self, data_type: str, filepath: str) -> bytes:
         iq_path = get_file_name(filepath, ApiType.IQDATA)
@@ -182,40 +248,69 @@ class AzureBlobClient:
         skip_bytes = 256000
         # it's not going to be 1024 rows, for f32 its 128 rows and for int16 its 256 rows
         content = await self.get_blob_content(iq_path, skip_bytes, fftSize * 1024)
-        return get_spectrogram_image(content, data_type, fftSize)
+        # FFTs and JPEG encoding are CPU bound, keep them off the event loop
+        return await asyncio.to_thread(get_spectrogram_image, content, data_type, fftSize)
 
     async def blob_exist(self, filepath):
+        exists = blob_info_cache.exists(self.account, self.container, filepath)
+        if exists is None:
+            exists = await self._blob_exist(filepath)
+            if exists is not None:
+                blob_info_cache.set_exists(self.account, self.container, filepath, exists)
+        return exists
+
+    @timed_storage_call("exists")
+    async def _blob_exist(self, filepath):
         if self.account == "local":
-            return os.path.isfile(os.path.join(self.base_filepath, filepath))
+            return await run_local_io(os.path.isfile, os.path.join(self.base_filepath, filepath))
         elif self.awsAccessKeyId:  # S3
-            session = aioboto3.Session()
-            async with session.client(
-                "s3",
-                aws_access_key_id=self.awsAccessKeyId,
-                aws_secret_access_key=self.awsSecretAccessKey.get_secret_value(),
-                region_name=self.account,
-            ) as s3_client:
-                try:
-                    await s3_client.head_object(Bucket=self.container, Key=filepath)
-                    return True
-                except ClientError as e:
-                    if e.response["Error"]["Code"] == "404":
-                        return False
+            s3_client = await self.get_s3_client()
+            try:
+                await s3_client.head_object(Bucket=self.container, Key=filepath)
+                return True
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "404":
+                    return False
         else:  # Azure blob
             blob_client = self.get_blob_client(filepath)
             return await blob_client.exists()
 
     async def get_file_length(self, filepath):
+        size = blob_info_cache.get_size(self.account, self.container, filepath)
+        if size is None:
+            if self.account != "local" and filepath.endswith(".sigmf-data"):
+                size = await self.get_file_length_from_metadata(filepath)
+            if size is None:
+                size = await self._get_file_length(filepath)
+            blob_info_cache.set_size(self.account, self.container, filepath, size)
+        return size
+
+    async def get_file_length_from_metadata(self, filepath) -> Optional[int]:
+        # Sync stores the size of every data file it listed, which saves asking storage. Only sync writes that field,
+        # sample_length can come from clients so it isn't trusted for this
+        try:
+            metadata = await db().metadata.find_one(
+                {
+                    "global.traceability:origin.account": self.account,
+                    "global.traceability:origin.container": self.container,
+                    "global.traceability:origin.file_path": filepath[: -len(".sigmf-data")],
+                },
+                {"global.traceability:data_size": 1},
+            )
+            if not metadata or not isinstance(metadata["global"].get("traceability:data_size"), int):
+                return None
+            return metadata["global"]["traceability:data_size"]
+        except Exception as e:
+            print(f"[AzureBlobClient] Couldn't get the size of {filepath} from its metadata: {e}")
+            return None
+
+    @timed_storage_call("size")
+    async def _get_file_length(self, filepath):
         if self.account == "local":
-            return os.path.getsize(os.path.join(self.base_filepath, filepath))
+            return await run_local_io(os.path.getsize, os.path.join(self.base_filepath, filepath))
         elif self.awsAccessKeyId:  # S3
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=self.awsAccessKeyId,
-                aws_secret_access_key=self.awsSecretAccessKey.get_secret_value(),
-                region_name=self.account,
-            )
-            response = s3_client.head_object(Bucket=self.container, Key=filepath)
+            s3_client = await self.get_s3_client()
+            response = await s3_client.head_object(Bucket=self.container, Key=filepath)
             return response["ContentLength"]
         else:
             blob_client = self.get_blob_client(filepath)
@@ -227,8 +322,12 @@ class AzureBlobClient:
             return None
         elif self.awsAccessKeyId:  # S3
             return None
+        key = (self.account, self.container, filepath, include_write, client_pool.credential_hash(account_key))
+        sas_token = _sas_tokens.get(key)
+        if sas_token is not None:
+            return sas_token
         start_time = datetime.datetime.now(datetime.timezone.utc)
-        expiry_time = start_time + datetime.timedelta(hours=1)
+        expiry_time = start_time + SAS_TOKEN_LIFETIME
         try:
             sas_token = generate_blob_sas(
                 account_name=self.account,
@@ -241,4 +340,5 @@ class AzureBlobClient:
             )
         except Exception as e:
             raise Exception(f"Error generating SAS token: {e}")
+        _sas_tokens[key] = sas_token
         return sas_token
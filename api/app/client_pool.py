@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import os
+from typing import Optional
+
+import aioboto3
+from azure.core.credentials import AzureNamedKeyCredential
+from azure.storage.blob.aio import ContainerClient
+
+# Long-lived storage clients shared by every request in this worker, keyed by datasource and credential.
+# Creating a client per call meant paying TLS and session setup for each of the hundreds of range reads behind
+# one spectrogram scroll. Everything in here gets closed by close_client_pool() on shutdown.
+
+_container_clients: dict[tuple, ContainerClient] = {}
+_s3_clients: dict[tuple, tuple] = {}  # key -> (client context manager, client)
+_s3_session: Optional[aioboto3.Session] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def credential_hash(credential: Optional[str]) -> str:
+    # Never keep the plain text secret in the key
+    if not credential:
+        return ""
+    return hashlib.sha256(credential.encode("utf-8")).hexdigest()
+
+
+def _check_loop():
+    # aiohttp sessions are bound to the event loop that created them, so start over if the loop changed
+    # (e.g. the test client runs each app instance on a new loop)
+    global _loop
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        stale_clients = _take_clients()
+        if _loop is not None and _loop.is_running() and not _loop.is_closed():
+            # their sessions can only be closed on their own loop, which is still going in another thread
+            asyncio.run_coroutine_threadsafe(_close_clients(*stale_clients), _loop)
+        # Otherwise the old loop is closed and its transports can't be closed from here anymore. A worker only ever
+        # runs one loop and closes the pool on shutdown, so this is only clients a test left behind, their sockets are
+        # released when they're garbage collected
+        _loop = loop
+
+
+def get_container_client(
+    account: str,
+    container: str,
+    sas_token: Optional[str] = None,
+    account_key: Optional[str] = None,
+) -> ContainerClient:
+    _check_loop()
+    key = (account, container, credential_hash(sas_token), credential_hash(account_key))
+    container_client = _container_clients.get(key)
+    if container_client is None:
+        url = f"https://{account}.blob.core.windows.net/{container}"
+        if account_key:
+            credential = AzureNamedKeyCredential(account, account_key)
+        else:
+            credential = sas_token or None
+        container_client = ContainerClient.from_container_url(url, credential=credential)
+        _container_clients[key] = container_client
+    return container_client
+
+
+async def get_s3_client(region: str, aws_access_key_id: str, aws_secret_access_key: str):
+    global _s3_session
+    _check_loop()
+    key = (region, aws_access_key_id, credential_hash(aws_secret_access_key))
+    if key in _s3_clients:
+        return _s3_clients[key][1]
+    if _s3_session is None:
+        _s3_session = aioboto3.Session()
+    client_context = _s3_session.client(
+        "s3",
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=region,
+        endpoint_url=os.getenv("IQENGINE_S3_ENDPOINT_URL") or None,  # S3 compatible storage (MinIO, moto) instead of AWS
+    )
+    s3_client = await client_context.__aenter__()
+    if key in _s3_clients:  # another request created one while we were awaiting
+        await client_context.__aexit__(None, None, None)
+        return _s3_clients[key][1]
+    _s3_clients[key] = (client_context, s3_client)
+    return s3_client
+
+
+def stats() -> dict:
+    return {"azure_container_clients": len(_container_clients), "s3_clients": len(_s3_clients)}
+
+
+def _take_clients() -> tuple[list, list]:
+    container_clients = list(_container_clients.values())
+    s3_clients = list(_s3_clients.values())
+    _container_clients.clear()
+    _s3_clients.clear()
+    return container_clients, s3_clients
+
+
+async def _close_clients(container_clients: list, s3_clients: list):
+    for container_client in container_clients:
+        try:
+            await container_client.close()
+        except Exception as e:
+            print(f"Error closing container client: {e}")
+    for client_context, _ in s3_clients:
+        try:
+            await client_context.__aexit__(None, None, None)
+        except Exception as e:
+            print(f"Error closing S3 client: {e}")
+
+
+async def close_client_pool():
+    await _close_clients(*_take_clients())
@@ -1,8 +1,10 @@
 import os
 
 import pymongo_inmemory
+from helpers.metrics import mongo_command_duration, mongo_commands
 from motor.core import AgnosticDatabase
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 
 # IQEngine supports either connecting to an existing MongoDB instance or using an in-memory database (meant primarily for testing or local dev)
 
@@ -10,17 +12,35 @@ _db: AgnosticDatabase = None
 in_memory_db: pymongo_inmemory.MongoClient = None
 
 
+class CommandMetrics(monitoring.CommandListener):
+    # Times every command the API sends to mongo (find, aggregate, update, ...) for /api/metrics. Called from
+    # pymongo's threads, so it only records the numbers
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_commands.inc(command=event.command_name, outcome="ok")
+        mongo_command_duration.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_commands.inc(command=event.command_name, outcome="error")
+        mongo_command_duration.observe(event.duration_micros / 1e6, command=event.command_name)
+
+
+command_metrics = CommandMetrics()
+
+
 def create_db_client() -> AgnosticDatabase:
     global _db
     connection_string = os.getenv("IQENGINE_METADATA_DB_CONNECTION_STRING")
-    _db = AsyncIOMotorClient(connection_string)["IQEngine"]
+    _db = AsyncIOMotorClient(connection_string, event_listeners=[command_metrics])["IQEngine"]
     return _db
 
 
 def create_in_memory_db_client() -> AgnosticDatabase:
     global _db, in_memory_db
     in_memory_db = pymongo_inmemory.MongoClient()["IQEngine"]
-    _db = AsyncIOMotorClient()["IQEngine"]
+    _db = AsyncIOMotorClient(event_listeners=[command_metrics])["IQEngine"]
     return _db
 
 
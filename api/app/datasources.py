@@ -1,30 +1,36 @@
 import asyncio
+import datetime
 import json
+import multiprocessing
 import os
 import time
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
 
-import boto3
-import numpy as np
 from bson import encode
 from bson.raw_bson import RawBSONDocument
-from fastapi import Depends
-from helpers.cipher import decrypt, encrypt
-from helpers.datasource_access import check_access
+from helpers import fastjson
+from helpers.blobinfo import blob_info_cache
+from helpers.blockcache import block_cache
+from helpers.cipher import encrypt
+from helpers.datasource_access import datasource_cache
+from helpers.localio import read_local_file, run_local_io
+from helpers.metrics import sync_phase_duration
+from helpers.querycache import query_cache
 from helpers.samples import get_bytes_per_iq_sample
 from pydantic import SecretStr
+from pymongo.errors import BulkWriteError
 from pymongo.operations import ReplaceOne
 
 from .azure_client import AzureBlobClient
 from .database import db
-from .metadata import create, validate_metadata
+from .metadata import validate_metadata, versions_collection
 from .models import DataSource
 
 
 async def get(account, container) -> DataSource | None:
-    # Get a datasource by account and container
-    datasource_collection = db().datasources
-    datasource = await datasource_collection.find_one({"account": account, "container": container})
+    # Get a datasource by account and container, through the same cache check_access uses
+    datasource = await datasource_cache.get(account, container)
     if datasource is None:
         return None
     return DataSource(**datasource)
@@ -34,174 +40,347 @@ async def datasource_exists(account, container) -> bool:
     return await get(account, container) is not None
 
 
-async def sync(account: str, container: str, awsAccessKeyId: Optional[str]):
-    print(f"[SYNC] Starting sync for {account}/{container} on PID {os.getpid()} at {time.time()}")
-    azure_blob_client = AzureBlobClient(account, container, awsAccessKeyId)
+# Sync pipeline sizing: how many metas are downloaded and parsed at once, and how many docs go in each bulk upsert
+SYNC_WORKERS = int(os.getenv("IQENGINE_SYNC_WORKERS", "200"))
+SYNC_BATCH_SIZE = int(os.getenv("IQENGINE_SYNC_BATCH_SIZE", "1000"))
+# Whether syncing a local datasource records a version (audit doc) for every new or changed meta
+SYNC_VERSION_AUDIT = os.getenv("IQENGINE_SYNC_VERSION_AUDIT", "1") not in ("", "0", "false", "False")
+
+# Metas at least this big are parsed and BSON encoded in a separate process, so a few multi-MB annotation files
+# don't hold the event loop (and the GIL) for seconds at a time, IQENGINE_SYNC_PROCESSES=0 keeps everything in-process
+SYNC_PROCESSES = int(os.getenv("IQENGINE_SYNC_PROCESSES", str(min(4, os.cpu_count() or 1))))
+SYNC_PROCESS_MIN_BYTES = int(os.getenv("IQENGINE_SYNC_PROCESS_MIN_BYTES", str(1024 * 1024)))
+MAX_METADATA_BSON_SIZE = 16793600  # MongoDB's 16MB limit per doc
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+# (account, container) -> progress of the running sync, or the summary of the last one, in this worker
+sync_status: dict[tuple, dict] = {}
+
+
+class BlobVersion(NamedTuple):
+    # What sync compares against the metadata doc to tell whether a .sigmf-meta changed since it was last synced
+    etag: Optional[str]  # None for local files
+    last_modified: str  # ISO 8601
+    size: int
+
+
+def origin_filter(account: str, container: str) -> dict:
+    return {"global.traceability:origin.account": account, "global.traceability:origin.container": container}
+
+
+async def get_synced_versions(account: str, container: str) -> dict:
+    # file_path -> the globals needed to decide if a recording is unchanged, for every doc in the datasource
+    projection = {
+        "global.traceability:origin.file_path": 1,
+        "global.traceability:etag": 1,
+        "global.traceability:last_modified": 1,
+        "global.traceability:size": 1,
+        "global.traceability:data_size": 1,
+        "global.core:datatype": 1,
+    }
+    synced = {}
+    async for doc in db().metadata.find(origin_filter(account, container), projection):
+        synced[doc["global"]["traceability:origin"]["file_path"]] = doc["global"]
+    return synced
+
+
+def is_unchanged(synced_global: Optional[dict], version: BlobVersion, data_size: int) -> bool:
+    if synced_global is None:
+        return False
+    if (
+        synced_global.get("traceability:etag") != version.etag
+        or synced_global.get("traceability:last_modified") != version.last_modified
+        or synced_global.get("traceability:size") != version.size
+    ):
+        return False
+    # the data file can be replaced without touching the meta, docs synced before its size was stored get re-synced once
+    return synced_global.get("traceability:data_size") == data_size
+
+
+def scan_local_datasource(base_filepath: str) -> list:
+    # os.scandir hands back the file type with each entry, so unlike os.walk + os.stat only the recordings get stat'd
+    blobs = []
+    directories = [base_filepath]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".sigmf-meta") or entry.name.endswith(".sigmf-data"):
+                    if ".." in entry.path:
+                        raise Exception("Invalid filepath")
+                    st = entry.stat()
+                    last_modified = datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc).isoformat()
+                    blobs.append((os.path.relpath(entry.path, base_filepath), BlobVersion(None, last_modified, st.st_size)))
+    return blobs
+
+
+def encode_metadata_file(content: bytes, traceability: dict, data_size: int) -> tuple[bytes, str]:
+    """
+    Parses a .sigmf-meta, fills in the defaults and traceability globals, and returns it BSON encoded along with its
+    datatype. The result is stored as is, so the document is only ever walked by the JSON decoder and the BSON
+    encoder. This is a plain function of bytes so it can run in the sync process pool.
+    """
+    metadata = validate_metadata(fastjson.loads(content))
+    metadata["global"].update(traceability)
+    datatype = metadata["global"]["core:datatype"]
+    metadata["global"]["traceability:sample_length"] = data_size / get_bytes_per_iq_sample(datatype)
+    metadata_bson = encode(metadata)
+    if len(metadata_bson) > MAX_METADATA_BSON_SIZE:
+        raise ValueError("too large to store in MongoDB (16MB limit per doc)")
+    return metadata_bson, datatype
+
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    global _process_pool
+    if _process_pool is None and SYNC_PROCESSES > 0:
+        # never fork, the API process has the event loop, mongo and storage client threads running that a forked
+        # child would inherit mid-flight. forkserver children start from a clean process (not on Windows, so spawn)
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _process_pool = ProcessPoolExecutor(max_workers=SYNC_PROCESSES, mp_context=multiprocessing.get_context(start_method))
+    return _process_pool
+
+
+def close_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+async def run_encode_metadata_file(content: bytes, traceability: dict, data_size: int) -> tuple[bytes, str]:
+    process_pool = get_process_pool() if len(content) >= SYNC_PROCESS_MIN_BYTES else None
+    if process_pool is not None:
+        return await asyncio.get_running_loop().run_in_executor(process_pool, encode_metadata_file, content, traceability, data_size)
+    return await asyncio.to_thread(encode_metadata_file, content, traceability, data_size)
+
+
+async def iter_datasource_blobs(azure_blob_client: AzureBlobClient):
+    # Yields (blob name, BlobVersion) for every .sigmf-meta and .sigmf-data file, a page at a time for the cloud backends
+    if azure_blob_client.account == "local":
+        # big archives take a while to scan, so it happens on the local I/O pool rather than the event loop
+        for blob_name, version in await run_local_io(scan_local_datasource, azure_blob_client.base_filepath):
+            yield blob_name, version
+    elif azure_blob_client.awsAccessKeyId:  # S3
+        s3_client = await azure_blob_client.get_s3_client()
+        paginator = s3_client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=azure_blob_client.container):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".sigmf-meta") or obj["Key"].endswith(".sigmf-data"):
+                    yield obj["Key"], BlobVersion(obj.get("ETag"), obj["LastModified"].isoformat(), obj["Size"])
+    else:  # Azure blob
+        container_client = azure_blob_client.get_container_client()
+        async for blob in container_client.list_blobs():  # cant use list_blob_names because we also need data file length
+            if blob.name.endswith(".sigmf-meta") or blob.name.endswith(".sigmf-data"):
+                yield blob.name, BlobVersion(blob.etag, blob.last_modified.isoformat(), blob.size)
+
+
+async def sync(account: str, container: str, awsAccessKeyId: Optional[str] = None):
+    """
+    Brings the metadata collection in line with the .sigmf-meta files in the datasource. Metas whose ETag, last
+    modified time and size (and data file size) match what was stored at the last sync are skipped, new and changed
+    ones are downloaded, parsed and upserted, and docs of metas that were removed are deleted.
+
+    This runs as a pipeline so memory stays flat for huge containers, the listing feeds a bounded queue worked by
+    SYNC_WORKERS fetch+parse tasks, which feed a single writer doing bulk upserts of SYNC_BATCH_SIZE docs. Progress
+    and then the summary of what changed are kept in sync_status, the summary is also returned.
+    """
+    start_sync = time.time()
+    print(f"[SYNC] Starting sync for {account}/{container} on PID {os.getpid()} at {start_sync}")
     datasource = await get(account, container)
     if datasource is None:
         print(f"[SYNC] Datasource {account}/{container} does not exist")  # dont raise exception or it will cause unclosed connection errors
         return
-    if datasource.sasToken:
-        azure_blob_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
-    if datasource.awsSecretAccessKey:
-        azure_blob_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
+    if awsAccessKeyId:
+        datasource = datasource.model_copy(update={"awsAccessKeyId": awsAccessKeyId})
+    azure_blob_client = AzureBlobClient.from_datasource(datasource)
+    block_cache.invalidate(account, container)  # recordings may have been replaced since they were cached
+    blob_info_cache.invalidate(account, container)
 
-    #######################################
-    # Reading and Parsing Local Metafiles #
-    #######################################
-    if azure_blob_client.account == "local":
-        metadatas = []
-        for path, subdirs, files in os.walk(azure_blob_client.base_filepath):
-            for name in files:
-                if name.endswith(".sigmf-meta"):
-                    filepath = os.path.join(path, name)
-                    if ".." in filepath:
-                        raise Exception("Invalid filepath")
-                    with open(filepath, "r") as f:
-                        content = f.read()
-                    try:
-                        metadata = json.loads(content)
-                        metadata = validate_metadata(metadata)
-                    except Exception as e:
-                        # this will give specific reasons parsing failed, it eventually needs to get put in a log or something
-                        print(f"[SYNC] Error parsing metadata file {filepath}: {e}")
-                        continue
-                    if metadata:
-                        metadatas.append((os.path.join(path, name).replace(azure_blob_client.base_filepath, "")[1:], metadata))
-        # Even though the below code is similar to Azure version, the Azure version had to be tweaked to parallelize it
-        for metadata in metadatas:
-            filepath = metadata[0].replace(".sigmf-meta", "")  # TODO: clean up the tuple messiness
-            try:
-                if not await azure_blob_client.blob_exist(filepath + ".sigmf-data"):
-                    print(f"[SYNC] Data file {filepath} does not exist for metadata file")
-                    continue
-                metadata = metadata[1]
-                metadata["global"]["traceability:origin"] = {
-                    "type": "api",
-                    "account": account,
-                    "container": container,
-                    "file_path": filepath,
-                }
-                metadata["global"]["traceability:revision"] = 0
-                file_length = await azure_blob_client.get_file_length(filepath + ".sigmf-data")
-                metadata["global"]["traceability:sample_length"] = file_length / get_bytes_per_iq_sample(metadata["global"]["core:datatype"])
-                await create(metadata, user=None)  # creates or updates the metadata object
-                # print(f"[SYNC] Created metadata for {filepath}") # commented out, caused too much spam
-            except Exception as e:
-                print(f"[SYNC] Error creating metadata for {filepath}: {e}")
+    synced = await get_synced_versions(account, container)
+    status = {
+        "phase": "syncing",
+        "listed": 0,  # metas with a data file
+        "fetched": 0,
+        "added": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "deleted": 0,
+        "failed": 0,
+        "started": start_sync,
+        "finished": None,
+    }
+    sync_status[(account, container)] = status
+    recordings = []  # (filepath, datatype) of everything in the datasource, for the overview stage
+    present = set()  # filepaths of the metas that have a data file
+    data_blob_sizes = {}  # holds the names and sizes of sigmf-data files
+    waiting_for_data = {}  # metas listed before their data file, cloud listings are sorted so this is rare
+    fetch_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, SYNC_WORKERS) * 2)  # backpressure on the listing
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, SYNC_BATCH_SIZE) * 2)
 
-    #########################################################
-    # Reading and Parsing Azure or S3 Metafiles in Parallel #
-    #########################################################
-    else:
-        if azure_blob_client.awsAccessKeyId:  # S3
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=azure_blob_client.awsAccessKeyId,
-                aws_secret_access_key=azure_blob_client.awsSecretAccessKey.get_secret_value(),
-                region_name=azure_blob_client.account,
-            )
-            paginator = s3_client.get_paginator("list_objects_v2")
-            meta_blob_names = []
-            data_blob_sizes = {}  # holds the names and sizes of sigmf-data files
-            start_t = time.time()
-            for page in paginator.paginate(Bucket=azure_blob_client.container):
-                for obj in page.get("Contents", []):
-                    blob_name = obj["Key"]
-                    if blob_name.endswith(".sigmf-meta"):
-                        meta_blob_names.append(blob_name)
-                    elif blob_name.endswith(".sigmf-data"):
-                        data_blob_sizes[blob_name] = obj["Size"]  # bytes
-
-        else:  # Azure blob
-            container_client = azure_blob_client.get_container_client()
-            blobs = container_client.list_blobs(include=["metadata"])  # cant use list_blob_names because we also need data file length
-            meta_blob_names = []
-            data_blob_sizes = {}  # holds the names and sizes of sigmf-data files
-            start_t = time.time()
-            async for blob in blobs:
-                if blob.name.endswith(".sigmf-meta"):
-                    meta_blob_names.append(blob.name)
-                elif blob.name.endswith(".sigmf-data"):
-                    data_blob_sizes[blob.name] = blob.size
-
-        print("[SYNC] getting list of metas took", time.time() - start_t, "seconds")  # 30s for MIT
-        print("[SYNC] found", len(meta_blob_names), "meta files")  # the process above took about 15s for 36318 metas
-
-        async def get_metadata(meta_blob_name):
-            if meta_blob_name.replace(".sigmf-meta", ".sigmf-data") not in data_blob_sizes:  # bail early if data file doesnt exist
-                print(f"[SYNC] Data file for {meta_blob_name} wasn't found")
-                return None
-
-            # Grab meta contents
+    async def add_meta(meta_blob_name: str, version: BlobVersion, data_size: int):
+        filepath = meta_blob_name[: -len(".sigmf-meta")]
+        present.add(filepath)
+        status["listed"] += 1
+        if is_unchanged(synced.get(filepath), version, data_size):
+            status["unchanged"] += 1
+            recordings.append((filepath, synced[filepath]["core:datatype"]))
+        else:
+            await fetch_queue.put((meta_blob_name, filepath, version, data_size))
+
+    async def get_metadata(meta_blob_name, filepath, version, data_size):
+        # Returns (filepath, datatype, BSON encoded doc), or None if the meta couldn't be parsed
+        if azure_blob_client.account == "local":
+            content = await run_local_io(read_local_file, os.path.join(azure_blob_client.base_filepath, meta_blob_name))
+        else:  # Grab meta contents
             content = await azure_blob_client.get_blob_content(meta_blob_name)
+        traceability = {
+            "traceability:origin": {
+                "type": "api",
+                "account": account,
+                "container": container,
+                "file_path": filepath,
+            },
+            "traceability:revision": 0,
+            "traceability:etag": version.etag,
+            "traceability:last_modified": version.last_modified,
+            "traceability:size": version.size,
+            "traceability:data_size": data_size,  # what the data file size lookups trust, the API never takes it from clients
+        }
+        try:
+            metadata_bson, datatype = await run_encode_metadata_file(content, traceability, data_size)
+        except Exception as e:
+            # this will give specific reasons parsing failed, it eventually needs to get put in a log or something
+            print(f"[SYNC] Error parsing metadata file {meta_blob_name}: {e}")
+            return None
+        return filepath, datatype, metadata_bson
+
+    async def fetch_worker():
+        while True:
+            item = await fetch_queue.get()
+            if item is None:
+                return
             try:
-                metadata = json.loads(content)
-                metadata = validate_metadata(metadata)
+                metadata = await get_metadata(*item)
             except Exception as e:
-                # this will give specific reasons parsing failed, it eventually needs to get put in a log or something
-                print(f"[SYNC] Error parsing metadata file {meta_blob_name}: {e}")
-                return None
-            if metadata:
-                filepath = meta_blob_name.replace(".sigmf-meta", "")
-                # add traceability:origin
-                metadata["global"]["traceability:origin"] = {
-                    "type": "api",
-                    "account": account,
-                    "container": container,
-                    "file_path": filepath,
-                }
-                metadata["global"]["traceability:revision"] = 0
-                file_length = data_blob_sizes[filepath + ".sigmf-data"]
-                bytes_per_iq_sample = get_bytes_per_iq_sample(metadata["global"]["core:datatype"])
-                metadata["global"]["traceability:sample_length"] = file_length / bytes_per_iq_sample
-                return metadata
-
-        # Running all coroutines at once failed for datasets with 10k's metas, so we need to break it up into batches
-        start_t = time.time()
-        batch_size = 1000  # manually tweaked, above 1000 it doesnt seem to speed up by much
-        num_batches = int(np.ceil(len(meta_blob_names) / batch_size))
-        metadatas = []
-        for i in range(num_batches):
-            coroutines = []
-            for meta_blob_name in meta_blob_names[i * batch_size : (i + 1) * batch_size]:
-                coroutines.append(get_metadata(meta_blob_name))
-            ret = await asyncio.gather(*coroutines)  # Wait for all the coroutines to finish
-            metadatas.extend([x for x in ret if x is not None])  # remove the Nones
-        print("[SYNC] getting and parsing all metas took", time.time() - start_t, "seconds")
-
-        if Depends(check_access) is None:
-            return False
+                print(f"[SYNC] Error reading metadata file {item[0]}: {e}")
+                metadata = None
+            if metadata is None:
+                status["failed"] += 1
+                continue
+            status["fetched"] += 1
+            await write_queue.put(metadata)
 
+    # local syncs have always kept a version per synced file, cloud syncs never did
+    audit_versions = azure_blob_client.account == "local" and SYNC_VERSION_AUDIT
+
+    async def write_batch(metadatas):
         bulk_writes = []
-        for metadata in metadatas:
-            meta_name = metadata["global"]["traceability:origin"]["file_path"]
-            filter = {
-                "global.traceability:origin.account": account,
-                "global.traceability:origin.container": container,
-                "global.traceability:origin.file_path": meta_name,
-            }
-            metadata_bson = encode(metadata)
-            if len(metadata_bson) > 16793600:
-                print(f"[SYNC] Metadata for {meta_name} is too large to store in MongoDB (16MB limit per doc), skipping")
+        written = []
+        for meta_name, datatype, metadata_bson in metadatas:
+            filter = {**origin_filter(account, container), "global.traceability:origin.file_path": meta_name}
+            metadata = RawBSONDocument(metadata_bson)  # already encoded, pymongo sends the bytes as they are
+            bulk_writes.append(ReplaceOne(filter=filter, replacement=metadata, upsert=True))
+            written.append((meta_name, datatype, metadata))
+        if not bulk_writes:
+            return
+        failed_indexes = set()
+        try:
+            await db().metadata.bulk_write(bulk_writes, ordered=False)
+        except BulkWriteError as e:
+            # the writes are unordered, so everything that isn't listed as an error went through
+            failed_indexes = {error["index"] for error in e.details.get("writeErrors", [])}
+            print(f"[SYNC] Error writing {len(failed_indexes)} of {len(bulk_writes)} metadata docs: {e}")
+        except Exception as e:
+            print(f"[SYNC] Error writing {len(bulk_writes)} metadata docs: {e}")
+            failed_indexes = set(range(len(written)))
+        status["failed"] += len(failed_indexes)
+
+        audit_documents = []
+        for i, (meta_name, datatype, metadata) in enumerate(written):
+            if i in failed_indexes:
                 continue
-            bulk_writes.append(ReplaceOne(filter=filter, replacement=RawBSONDocument(metadata_bson), upsert=True))
-        metadata_collection = db().metadata
-        metadata_collection.bulk_write(bulk_writes)
-
-        """ At some point we may remove the versions thing
-        # audit document
-        audit_document = {
-            "metadata": metadata,
-            "user": None,
-            "action": "create",
-        }
-        versions: AgnosticCollection = versions_collection()
-        await versions.insert_one(audit_document)
-        """
+            status["updated" if meta_name in synced else "added"] += 1
+            recordings.append((meta_name, datatype))
+            if audit_versions:
+                audit_documents.append({"metadata": metadata, "user": None, "action": "create"})
+        # the metadata is already written, a failed audit doesn't make the sync of those files fail
+        if audit_documents:
+            try:
+                await versions_collection().insert_many(audit_documents, ordered=False)
+            except Exception as e:
+                print(f"[SYNC] Error writing {len(audit_documents)} version audit docs: {e}")
+
+    async def writer():
+        batch = []
+        while True:
+            metadata = await write_queue.get()
+            if metadata is not None:
+                batch.append(metadata)
+            if batch and (metadata is None or len(batch) >= SYNC_BATCH_SIZE):
+                await write_batch(batch)
+                batch = []
+            if metadata is None:
+                return
 
-    print(f"[SYNC] Finished syncing {account}/{container}")
-    await azure_blob_client.close_blob_clients()  # Close all the blob clients to avoid unclosed connection errors
+    workers = [asyncio.create_task(fetch_worker()) for _ in range(max(1, SYNC_WORKERS))]
+    writer_task = asyncio.create_task(writer())
+    try:
+        async for blob_name, version in iter_datasource_blobs(azure_blob_client):
+            if blob_name.endswith(".sigmf-data"):
+                data_blob_sizes[blob_name] = version.size
+                # the listing already has every data file's size, no need to HEAD them again when they're viewed
+                blob_info_cache.set_size(account, container, blob_name, version.size)
+                meta_blob_name = blob_name[: -len(".sigmf-data")] + ".sigmf-meta"
+                if meta_blob_name in waiting_for_data:
+                    await add_meta(meta_blob_name, waiting_for_data.pop(meta_blob_name), version.size)
+            elif blob_name[: -len(".sigmf-meta")] + ".sigmf-data" in data_blob_sizes:
+                await add_meta(blob_name, version, data_blob_sizes[blob_name[: -len(".sigmf-meta")] + ".sigmf-data"])
+            else:
+                waiting_for_data[blob_name] = version
+        for meta_blob_name in waiting_for_data:  # bail if data file doesnt exist
+            print(f"[SYNC] Data file for {meta_blob_name} wasn't found")
+        print(f"[SYNC] listing took {time.time() - start_sync} seconds, found {status['listed']} recordings")  # 15s for 36318 metas
+        sync_phase_duration.observe(time.time() - start_sync, phase="listing")
+        # fetching and writing overlap the listing, these are how long they ran on after it
+        with sync_phase_duration.time(phase="fetch"):
+            for _ in workers:
+                await fetch_queue.put(None)
+            await asyncio.gather(*workers)
+        with sync_phase_duration.time(phase="write"):
+            await write_queue.put(None)
+            await writer_task
+    finally:
+        for task in workers + [writer_task]:
+            task.cancel()  # no-op unless the listing failed
+
+    # Only docs that came from an earlier sync are removed, ones created through the API don't have a meta file
+    removed = [filepath for filepath, synced_global in synced.items() if filepath not in present and "traceability:last_modified" in synced_global]
+    with sync_phase_duration.time(phase="delete"):
+        for i in range(0, len(removed), SYNC_BATCH_SIZE):
+            result = await db().metadata.delete_many(
+                {**origin_filter(account, container), "global.traceability:origin.file_path": {"$in": removed[i : i + SYNC_BATCH_SIZE]}}
+            )
+            status["deleted"] += result.deleted_count
+    query_cache.invalidate(account, container)
+
+    status["phase"] = "done"
+    status["finished"] = time.time()
+    status["seconds"] = round(status["finished"] - start_sync, 3)
+    sync_phase_duration.observe(status["finished"] - start_sync, phase="total")
+    print(
+        f"[SYNC] Finished syncing {account}/{container} in {status['seconds']} seconds: {status['added']} added, "
+        f"{status['updated']} updated, {status['unchanged']} unchanged, {status['deleted']} deleted, {status['failed']} failed"
+    )
+    # imported here because overviews depends on iq_router, which depends on this module
+    from .overviews import precompute_enabled, start_overviews
+
+    if precompute_enabled():
+        start_overviews(azure_blob_client, recordings)  # closes the blob clients once it's done
+    else:
+        await azure_blob_client.close_blob_clients()  # Close all the blob clients to avoid unclosed connection errors
+    return status
 
 
 async def create_datasource(datasource: DataSource, user: Optional[dict]) -> bool:
@@ -234,6 +413,7 @@ async def create_datasource(datasource: DataSource, user: Optional[dict]) -> boo
         datasource_dict["public"] = True
 
     await datasource_collection.insert_one(datasource_dict)
+    datasource_cache.invalidate(datasource.account, datasource.container)
     return True
 
 
@@ -246,12 +426,28 @@ async def import_datasources_from_env():
     if not connection_info and not base_filepath:
         return
 
-    # Clear the db
+    # Drop the metadata of datasources that are no longer configured. The rest is kept so the syncs below only have to
+    # pick up what changed since the last start
+    configured = set()
+    if base_filepath and os.path.exists(base_filepath):
+        configured.add(("local", "local"))
+    if connection_info:
+        for connection in json.loads(connection_info).get("settings", []):
+            configured.add((connection.get("accountName"), connection.get("containerName")))
     metadata_collection = db().metadata
-    await metadata_collection.delete_many({})  # clears the metadata db
+    stale = []
+    async for group in metadata_collection.aggregate(
+        [{"$group": {"_id": {"account": "$global.traceability:origin.account", "container": "$global.traceability:origin.container"}}}]
+    ):
+        if (group["_id"].get("account"), group["_id"].get("container")) not in configured:
+            stale.append(origin_filter(group["_id"].get("account"), group["_id"].get("container")))
+    if stale:
+        await metadata_collection.delete_many({"$or": stale})
+        query_cache.clear()
 
     datasource_collection = db().datasources
     await datasource_collection.delete_many({})  # clears the datasource db
+    datasource_cache.clear()
 
     # Add datasource corresponding to the local backend storage
     if base_filepath and os.path.exists(base_filepath):
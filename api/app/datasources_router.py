@@ -1,16 +1,20 @@
 import json
 import os
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
 from fastapi.responses import StreamingResponse
 from helpers.authorization import get_current_user
+from helpers.blobinfo import blob_info_cache
 from helpers.cipher import decrypt, encrypt
-from helpers.datasource_access import check_access
+from helpers.datasource_access import accessible_datasources_filter, check_access, check_access_many, datasource_cache
+from helpers.listing import LISTING_MAX_LIMIT, after_filter, listing_response
+from helpers.querycache import query_cache
 from helpers.urlmapping import ApiType, get_content_type, get_file_name
 from motor.core import AgnosticCollection
 from pydantic import SecretStr
+from pymongo.errors import DuplicateKeyError
 
 from . import aiquery, datasources
 from .azure_client import AzureBlobClient
@@ -18,12 +22,14 @@ from .database import db
 from .datasources import create_datasource, datasource_exists
 from .metadata import (
     InvalidGeolocationFormat,
+    UnsupportedQuery,
+    cached_query_metadata,
     collection,
     get_metadata,
-    query_metadata,
     versions_collection,
 )
 from .models import Configuration, DataSource, DataSourceReference, TrackMetadata
+from .overviews import overview_progress
 
 router = APIRouter()
 
@@ -40,13 +46,25 @@ async def create_datasource_endpoint(
 
 
 @router.get("/api/datasources", response_model=list[DataSource])
-async def get_datasources(current_user: Optional[dict] = Depends(get_current_user)):
-    datasources = db().datasources.find()
-    result = []
-    async for datasource_item in datasources:
-        if await check_access(datasource_item["account"], datasource_item["container"], current_user) is not None:
-            result.append(datasource_item)
-    return result
+async def get_datasources(
+    limit: Optional[int] = Query(None, ge=1, le=LISTING_MAX_LIMIT),
+    after: Optional[str] = Query(None),
+    format: Literal["json", "ndjson"] = Query("json"),
+    current_user: Optional[dict] = Depends(get_current_user),
+):
+    # Only the datasources the user has access to, paged on (account, container)
+    query = accessible_datasources_filter(current_user)
+    if after is not None:
+        query = {"$and": [query, after_filter(["account", "container"], after)]}
+    cursor = db().datasources.find(query).sort([("account", 1), ("container", 1)])
+    if limit is not None:
+        cursor = cursor.limit(limit + 1)
+
+    async def datasources():
+        async for datasource_item in cursor:
+            yield DataSource(**datasource_item).model_dump(mode="json")  # secrets come out masked
+
+    return await listing_response(datasources(), lambda d: [d["account"], d["container"]], limit, format)
 
 
 @router.put("/api/datasources/syncAll", status_code=204)
@@ -57,18 +75,12 @@ async def sync_all_datasources(background_tasks: BackgroundTasks):
         configuration = Configuration()
         configuration.feature_flags = json.loads(feature_flags)
         if configuration.feature_flags.get("allowRefreshing", False):
-            # First wipe out all the metadata
-            from .metadata import collection
-
-            metadata_collection = collection()
-            await metadata_collection.delete_many({})  # deletes all docs in the collection
-
-            # Now sync all the datasources
+            # Syncs are incremental, each one updates/removes the metadata of its own datasource
             all_datasources = db().datasources.find()
             all_datasources_list = await all_datasources.to_list(length=100)
             for datasource in all_datasources_list:
-                print("Syncing-", datasource)
-                background_tasks.add_task(datasources.sync, datasource["account"], datasource["container"])
+                print("Syncing-", datasource["account"], datasource["container"])
+                background_tasks.add_task(datasources.sync, datasource["account"], datasource["container"], datasource.get("awsAccessKeyId"))
         else:
             raise HTTPException(status_code=404, detail="allowRefreshing wasn't set to true in env vars")
     return {"message": "Syncing All"}
@@ -125,6 +137,7 @@ async def update_datasource(
         {"account": account, "container": container},
         {"$set": datasource_dict},
     )
+    datasource_cache.invalidate(account, container)
     return
 
 
@@ -151,10 +164,40 @@ async def sync_datasource(
     if not existing_datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
 
-    background_tasks.add_task(datasources.sync, account, container)
+    background_tasks.add_task(datasources.sync, account, container, existing_datasource.get("awsAccessKeyId"))
     return {"message": "Syncing"}
 
 
+@router.get("/api/datasources/{account}/{container}/sync")
+async def get_sync_status(
+    account: str,
+    container: str,
+    access_allowed=Depends(check_access),
+):
+    # Progress of the running sync of this datasource, or what the last one changed, only known to the worker that ran it
+    if access_allowed is None:
+        raise HTTPException(status_code=403, detail="No Access")
+    status = datasources.sync_status.get((account, container))
+    if status is None:
+        raise HTTPException(status_code=404, detail="No sync has run for this datasource")
+    return status
+
+
+@router.get("/api/datasources/{account}/{container}/overviews")
+async def get_overview_progress(
+    account: str,
+    container: str,
+    access_allowed=Depends(check_access),
+):
+    # Progress of the overview precompute stage of the last sync, only known to the worker that ran the sync
+    if access_allowed is None:
+        raise HTTPException(status_code=403, detail="No Access")
+    progress = overview_progress.get((account, container))
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No overview build has run for this datasource")
+    return progress
+
+
 @router.get("/api/datasources/{account}/{container}/{file_path}/sas")
 async def generate_sas_token(
     account: str,
@@ -165,15 +208,22 @@ async def generate_sas_token(
 ):
     if (access_allowed != "owner" and write) or access_allowed is None:
         raise HTTPException(status_code=403, detail="No Access")
+    if write:
+        # the client is about to upload it straight to storage, so forget the size we know until the next sync
+        blob_info_cache.invalidate(account, container, file_path)
+        if file_path.endswith(".sigmf-data"):
+            await db().metadata.update_many(
+                {
+                    "global.traceability:origin.account": account,
+                    "global.traceability:origin.container": container,
+                    "global.traceability:origin.file_path": file_path[: -len(".sigmf-data")],
+                },
+                {"$unset": {"global.traceability:data_size": ""}},
+            )
     if account == "local":
         return {"sasToken": None}
     token: str = ""
-    existing_datasource = await db().datasources.find_one(
-        {
-            "account": account,
-            "container": container,
-        }
-    )
+    existing_datasource = await datasource_cache.get(account, container)
     if not existing_datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
     if not existing_datasource.get("accountKey", None):
@@ -205,24 +255,41 @@ async def generate_sas_token(
 async def get_all_meta(
     account,
     container,
+    limit: Optional[int] = Query(None, ge=1, le=LISTING_MAX_LIMIT),
+    after: Optional[str] = Query(None),
+    fields: Literal["all", "global", "summary"] = Query("all"),
+    format: Literal["json", "ndjson"] = Query("json"),
     metadatas: AgnosticCollection = Depends(collection),
     access_allowed=Depends(check_access),
 ):
+    """
+    All metadata for this datasource (could be an empty list), ordered by file path. fields=global leaves out the
+    captures and annotations, fields=summary keeps the captures and replaces the annotations with annotation_count.
+    """
     if access_allowed is None:
         return []
 
-    # Return all metadata for this datasource, could be an empty list
-    metadata = metadatas.find(
-        {
-            "global.traceability:origin.account": account,
-            "global.traceability:origin.container": container,
-        }
+    match = {
+        "global.traceability:origin.account": account,
+        "global.traceability:origin.container": container,
+        **after_filter(["global.traceability:origin.file_path"], after),
+    }
+    pipeline: list[dict] = [{"$match": match}, {"$sort": {"global.traceability:origin.file_path": 1}}]
+    if limit is not None:
+        pipeline.append({"$limit": limit + 1})
+    if fields == "global":
+        pipeline.append({"$project": {"_id": 0, "global": 1}})
+    elif fields == "summary":
+        pipeline.append({"$project": {"_id": 0, "global": 1, "captures": 1, "annotation_count": {"$size": {"$ifNull": ["$annotations", []]}}}})
+    else:
+        pipeline.append({"$project": {"_id": 0}})  # _id isn't json serializable and doesnt matter to client
+
+    return await listing_response(
+        metadatas.aggregate(pipeline),
+        lambda datum: [datum["global"]["traceability:origin"]["file_path"]],
+        limit,
+        format,
     )
-    result = []
-    async for datum in metadata:
-        del datum["_id"]  # remove the _id field since its not json serializable and doesnt matter to client
-        result.append(datum)
-    return result
 
 
 @router.get(
@@ -305,19 +372,7 @@ async def get_meta_thumbnail(
     if not datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
 
-    azure_client = AzureBlobClient(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
-
-    sas_token = datasource.sasToken.get_secret_value() if datasource.sasToken else None
-    if sas_token is not None:
-        azure_client.set_sas_token(decrypt(sas_token))
-
-    account_key = datasource.accountKey.get_secret_value() if datasource.accountKey else None
-    if account_key is not None:
-        azure_client.set_account_key(decrypt(account_key))
-
-    aws_secret_access_key = datasource.awsSecretAccessKey.get_secret_value() if datasource.awsSecretAccessKey else None
-    if aws_secret_access_key is not None:
-        azure_client.set_aws_secret_access_key(decrypt(aws_secret_access_key))
+    azure_client = AzureBlobClient.from_datasource(datasource)
 
     thumbnail_path = get_file_name(filepath, ApiType.THUMB)
     content_type = get_content_type(ApiType.THUMB)
@@ -345,6 +400,7 @@ async def get_meta_thumbnail(
     response_model=list[DataSourceReference],
 )
 async def query_meta(
+    response: Response,
     account: Optional[List[str]] = Query([]),
     container: Optional[List[str]] = Query([]),
     database_id: Optional[List[str]] = Query([]),
@@ -359,10 +415,18 @@ async def query_meta(
     text: Optional[str] = Query(None),
     captures_geo: Optional[str] = Query(None),
     annotations_geo: Optional[str] = Query(None),
+    search_mode: Literal["regex", "text"] = Query("regex"),
+    match_mode: Literal["regex", "exact", "prefix"] = Query("regex"),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=LISTING_MAX_LIMIT),
     current_user: Optional[dict] = Depends(get_current_user),
 ):
+    """
+    Searches the metadata of every datasource the user can access. Recent identical searches are answered from the
+    query cache, X-Total-Count has the number of results and offset/limit page through them.
+    """
     try:
-        result = await query_metadata(
+        result = await cached_query_metadata(
             account=account,
             container=container,
             database_id=database_id,
@@ -377,26 +441,17 @@ async def query_meta(
             min_datetime=min_datetime,
             max_datetime=max_datetime,
             text=text,
+            search_mode=search_mode,
+            match_mode=match_mode,
         )
 
-        if not result:
-            return []
-
         # Process result to remove metadata from unauthorized datasources
-        access_cache = {}
-        filtered_result = []
-
-        for item in result:
-            key = (item.account, item.container)
-            if key not in access_cache:
-                access_cache[key] = await check_access(item.account, item.container, current_user)
-
-            if access_cache[key] is not None:
-                filtered_result.append(item)
+        access = await check_access_many([(item.account, item.container) for item in result], current_user)
+        filtered_result = [item for item in result if access[(item.account, item.container)] is not None]
+        response.headers["X-Total-Count"] = str(len(filtered_result))
+        return filtered_result[offset : None if limit is None else offset + limit]
 
-        return filtered_result
-
-    except InvalidGeolocationFormat as e:
+    except (InvalidGeolocationFormat, UnsupportedQuery) as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     except Exception as e:
@@ -443,7 +498,7 @@ async def open_query_meta(
         max_datetime = datetime.fromisoformat(max_datetime.replace("Z", "+00:00"))
 
     try:
-        result = await query_metadata(
+        result = await cached_query_metadata(
             account=account,
             container=container,
             database_id=database_id,
@@ -468,16 +523,8 @@ async def open_query_meta(
             return {"parameters": jsonParameters, "results": []}
 
         # Process result to remove metadata from unauthorized datasources
-        access_cache = {}
-        filtered_result = []
-
-        for item in result:
-            key = (item.account, item.container)
-            if key not in access_cache:
-                access_cache[key] = await check_access(item.account, item.container, current_user)
-
-            if access_cache[key] is not None:
-                filtered_result.append(item)
+        access = await check_access_many([(item.account, item.container) for item in result], current_user)
+        filtered_result = [item for item in result if access[(item.account, item.container)] is not None]
 
         return {"parameters": jsonParameters, "results": filtered_result}
 
@@ -527,7 +574,12 @@ async def create_meta(
         "file_path": filepath,
     }
     metadata["global"]["traceability:revision"] = 0
-    await db().metadata.insert_one(metadata)
+    metadata["global"].pop("traceability:data_size", None)  # only sync knows the data file size, see get_file_length
+    try:
+        await db().metadata.insert_one(metadata)
+        query_cache.invalidate(account, container)
+    except DuplicateKeyError:  # created by a concurrent request since the check above, the origin index is unique
+        raise HTTPException(status_code=409, detail="Metadata already exists")
 
     # audit document
     audit_document = {
@@ -569,6 +621,10 @@ async def update_meta(
         version_number = version + 1
         metadata["global"]["traceability:revision"] = version_number
         metadata["global"]["traceability:origin"] = current["global"]["traceability:origin"]
+        # clients send back the global they fetched, the data file size is always the one sync stored
+        metadata["global"].pop("traceability:data_size", None)
+        if "traceability:data_size" in current["global"]:
+            metadata["global"]["traceability:data_size"] = current["global"]["traceability:data_size"]
         # audit document
         audit_document = {"metadata": metadata, "user": current_user["preferred_username"], "action": "update"}
         try:
@@ -580,4 +636,5 @@ async def update_meta(
             {"_id": id},
             {"$set": metadata},
         )
+        query_cache.invalidate(account, container)
         return
@@ -0,0 +1,83 @@
+from typing import List, NamedTuple, Optional
+
+from pymongo.errors import OperationFailure
+
+from .database import db
+
+ORIGIN_ACCOUNT = "global.traceability:origin.account"
+ORIGIN_CONTAINER = "global.traceability:origin.container"
+ORIGIN_FILE_PATH = "global.traceability:origin.file_path"
+
+
+class IndexSpec(NamedTuple):
+    name: str
+    keys: list
+    unique: bool = False
+    options: Optional[dict] = None
+
+
+# Fields covered by the text index, which query_metadata's search_mode="text" searches
+TEXT_SEARCH_FIELDS = ["global.core:author", "global.core:description", "annotations.core:label", "annotations.core:description"]
+
+# Every /meta, track, thumbnail and plugin request looks a recording up by its origin, and query_metadata filters on
+# the origin, capture frequency, datetime and geolocation ($near needs a 2dsphere index to work at all)
+METADATA_INDEXES: List[IndexSpec] = [
+    IndexSpec("origin", [(ORIGIN_ACCOUNT, 1), (ORIGIN_CONTAINER, 1), (ORIGIN_FILE_PATH, 1)], unique=True),
+    IndexSpec("origin_container", [(ORIGIN_CONTAINER, 1)]),  # the origin index covers account-only matches
+    IndexSpec("captures_geolocation", [("captures.core:geolocation", "2dsphere")]),
+    IndexSpec("annotations_geolocation", [("annotations.core:geolocation", "2dsphere")]),
+    IndexSpec("captures_frequency", [("captures.core:frequency", 1)]),
+    IndexSpec("captures_datetime", [("captures.core:datetime", 1)]),
+    # no stemming or stop words, labels like "LTE" or "on" should match as written. The language override points at a
+    # field nobody uses, by default a "language" field in a meta would pick the language and could fail the insert
+    IndexSpec(
+        "search_text",
+        [(field, "text") for field in TEXT_SEARCH_FIELDS],
+        options={"default_language": "none", "language_override": "iqengine:text_language"},
+    ),
+]
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def ensure_indexes() -> dict:
+    """
+    Creates the metadata indexes that don't exist yet, run at startup by every worker (creating an index that already
+    exists is a no-op). Failures are printed rather than raised so a database with bad data still starts, if the
+    origin index can't be unique because of duplicate recordings it's created non-unique so lookups are still fast.
+    Returns index name -> "ok", "non-unique" or the error.
+    """
+    results = {}
+    try:
+        metadata_collection = db().metadata
+        for spec in METADATA_INDEXES:
+            try:
+                await metadata_collection.create_index(spec.keys, name=spec.name, unique=spec.unique, **(spec.options or {}))
+                results[spec.name] = "ok"
+            except OperationFailure as e:
+                if spec.unique and e.code == DUPLICATE_KEY_ERROR:
+                    print(f"[INDEXES] Duplicate recordings in the metadata collection, creating {spec.name} non-unique: {e}")
+                    await metadata_collection.create_index(spec.keys, name=spec.name)
+                    results[spec.name] = "non-unique"
+                else:
+                    print(f"[INDEXES] Failed to create index {spec.name}: {e}")
+                    results[spec.name] = str(e)
+    except Exception as e:
+        print(f"[INDEXES] Failed to create indexes: {e}")
+        results["error"] = str(e)
+    return results
+
+
+async def get_index_usage() -> List[dict]:
+    # How often each metadata index was used since the server started (or the index was created), from $indexStats
+    usage = []
+    async for stats in db().metadata.aggregate([{"$indexStats": {}}]):
+        usage.append(
+            {
+                "name": stats["name"],
+                "key": dict(stats["key"]),
+                "ops": stats["accesses"]["ops"],
+                "since": stats["accesses"]["since"],
+            }
+        )
+    return sorted(usage, key=lambda index: index["name"])
@@ -2,26 +2,37 @@ import asyncio
 import io
 import math
 import os
-from typing import List
+from collections import deque
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import FileResponse, StreamingResponse
-from helpers.apidisconnect import CancelOnDisconnectRoute, cancel_on_disconnect
-from helpers.cipher import decrypt
-from helpers.conversions import find_smallest_and_largest_next_to_each_other
+from helpers.apidisconnect import CancelOnDisconnectRoute, cancel_on_disconnect, disconnect_stats
 from helpers.datasource_access import check_access
+from helpers.rangeplanner import plan_reads
 from helpers.samples import get_bytes_per_iq_sample
-from helpers.urlmapping import ApiType, get_content_type, get_file_name
+from helpers.urlmapping import ApiType, get_content_type, get_file_name, get_tile_file_name
 from pydantic import BaseModel
 
 from . import datasources
 from .azure_client import AzureBlobClient
 from .models import DataSource
+from .tiles import MAX_FFT_SIZE, build_tile_row, tile_cache
 
 # Why is this needed here and in main.py?
 router = APIRouter(route_class=CancelOnDisconnectRoute)
 
 
+MINIMAP_FFT_SIZE = 64  # needs to match MINIMAP_FFT_SIZE on the client side!
+MINIMAP_NUM_FFTS = 200
+
+
+class LocalFileResponse(FileResponse):
+    # Starlette reads 64KB per chunk, recordings are big enough that larger chunks go a lot faster. Servers that
+    # support the pathsend extension skip the chunking and send the file directly.
+    chunk_size = 1024 * 1024
+
+
 class IQData(BaseModel):
     indexes: List[int]
     tile_size: int
@@ -44,14 +55,7 @@ async def get_iq_data(
     if not datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
 
-    azure_client = AzureBlobClient(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
-
-    if hasattr(datasource, "sasToken"):
-        if datasource.sasToken:
-            azure_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
-    if hasattr(datasource, "awsSecretAccessKey"):
-        if datasource.awsSecretAccessKey:
-            azure_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
+    azure_client = AzureBlobClient.from_datasource(datasource)
 
     try:
         block_indexes = [int(num) for num in block_indexes_str.split(",")]
@@ -75,75 +79,124 @@ async def get_iq_data(
 async def calculate_iq_data(
     block_indexes,
     block_size,
-    format,
+    bytes_per_iq_sample,
     iq_file,
     azure_client,
     request,
 ):
-    iq_data_list = await get_byte_streams(
-        block_indexes,
-        block_size,
-        format,
-        iq_file,
-        azure_client,
-        request,
-    )
-    for iq_data in iq_data_list:
-        yield iq_data
-
-
-async def get_byte_streams(block_indexes, block_size, bytes_per_iq_sample, iq_file, azure_client, request):
+    # Yields the requested blocks in order as soon as each read lands, rather than waiting on the slowest one.
+    # Reads are started ahead of what has been sent so far, bounded by count and by bytes so a huge
+    # block_indexes_str can't pull the whole window into memory at once.
     max_concurrent_requests = 100
-    chunk_size = 100 * 1024 // block_size
-    block_indexes_arrs = find_smallest_and_largest_next_to_each_other(block_indexes)
-
-    block_indexes_chunks = []
-    for i in block_indexes_arrs:
-        if i[1] - i[0] > chunk_size:
-            indexes = [[j, min(j + chunk_size - 1, i[1])] for j in range(i[0], i[1] + 1, chunk_size)]
-            block_indexes_chunks.extend(indexes)
-        else:
-            block_indexes_chunks.append(i)
-
+    max_read_ahead_bytes = 32 * 1024 * 1024
     blob_size = await azure_client.get_file_length(iq_file)
+    reads = plan_reads(block_indexes, block_size, bytes_per_iq_sample, blob_size, azure_client.backend)
 
-    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    in_flight = deque()  # (range_read, task) in the order they need to be sent
+    in_flight_bytes = 0
+    next_read = 0
+    try:
+        while next_read < len(reads) or in_flight:
+            while next_read < len(reads) and (
+                not in_flight or (len(in_flight) < max_concurrent_requests and in_flight_bytes + reads[next_read].length <= max_read_ahead_bytes)
+            ):
+                range_read = reads[next_read]
+                task = asyncio.ensure_future(azure_client.get_blob_content(filepath=iq_file, offset=range_read.offset, length=range_read.length))
+                in_flight.append((range_read, task))
+                in_flight_bytes += range_read.length
+                next_read += 1
+            range_read, task = in_flight[0]
+            content = await task
+            in_flight.popleft()
+            in_flight_bytes -= range_read.length
+            for chunk in range_read.split(content):
+                # local reads are memoryviews into the mapped file, StreamingResponse only sends bytes
+                yield bytes(chunk) if isinstance(chunk, memoryview) else chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # the response was cancelled (client disconnected) or closed part way through
+        disconnect_stats.record_stream(len(in_flight), in_flight_bytes, sum(r.length for r in reads[next_read:]))
+        raise
+    finally:
+        # the client went away or a read failed, don't leave the remaining reads running
+        for _, task in in_flight:
+            task.cancel()
+
+
+async def build_minimap(azure_client, filepath, datatype, request=None) -> bytes:
+    # The minimap is MINIMAP_NUM_FFTS blocks of MINIMAP_FFT_SIZE samples, equally spaced out over the recording
+    file_name = get_file_name(filepath, ApiType.IQDATA)
+    bytes_per_iq_sample = get_bytes_per_iq_sample(datatype)
+    blob_size = await azure_client.get_file_length(file_name)
+    total_ffts = math.floor(blob_size / (bytes_per_iq_sample * MINIMAP_FFT_SIZE))
+    block_indexes = [math.floor(i * total_ffts / MINIMAP_NUM_FFTS) for i in range(MINIMAP_NUM_FFTS)]
+    # make sure that no block index is larger than the total number of ffts
+    block_indexes = [i for i in block_indexes if i < total_ffts]
+    content = io.BytesIO()
+    async for chunk in calculate_iq_data(block_indexes, MINIMAP_FFT_SIZE, bytes_per_iq_sample, file_name, azure_client, request):
+        content.write(chunk)
+    return content.getvalue()
 
-    async def get_byte_stream_wrapper(block_index_chunk):
-        async with semaphore:
-            return await get_byte_stream(
-                request,
-                block_index_chunk,
-                block_size,
-                bytes_per_iq_sample,
-                iq_file,
-                azure_client,
-                blob_size,
-            )
 
-    tasks = [get_byte_stream_wrapper(block_index_chunk) for block_index_chunk in block_indexes_chunks]
-    return await asyncio.gather(*tasks)
+@router.get(
+    "/api/datasources/{account}/{container}/{filepath:path}/spectrogram-tile",
+    status_code=200,
+)
+async def get_spectrogram_tile(
+    filepath: str,
+    format: str,
+    zoom: int,
+    x: int,
+    y: int,
+    background_tasks: BackgroundTasks,
+    fft_size: int = Query(1024, gt=0, le=MAX_FFT_SIZE),
+    db_min: Optional[float] = None,
+    db_max: Optional[float] = None,
+    access_allowed=Depends(check_access),
+    datasource: DataSource = Depends(datasources.get),
+):
+    """
+    Returns one 8 bit greyscale PNG tile of the spectrogram pyramid described in app/tiles.py. Tiles are kept in memory
+    and, when using the default dB range on a writable datasource, stored next to the recording like the minimap.
+    """
+    if access_allowed is None:
+        raise HTTPException(status_code=403, detail="No Access")
+    if not datasource:
+        raise HTTPException(status_code=404, detail="Datasource not found")
+    azure_client = AzureBlobClient.from_datasource(datasource)
+
+    content_type = get_content_type(ApiType.TILE)
 
+    # the datatype changes how the bytes are read, so it's part of the key just like the fft size
+    def get_cache_key(tile_x: int):
+        return (datasource.account, datasource.container, filepath, format, fft_size, zoom, tile_x, y, db_min, db_max)
 
-async def get_byte_stream(
-    request,
-    block_indexes_chunk,
-    block_size,
-    bytes_per_iq_sample,
-    iq_file,
-    azure_client,
-    blob_size,
-):
-    offsetBytes = block_indexes_chunk[0] * block_size * bytes_per_iq_sample  # FYI, bytes_per_iq_sample includes the *2 for I+Q
-    countBytes = (block_indexes_chunk[1] - block_indexes_chunk[0] + 1) * block_size * bytes_per_iq_sample
+    tile = tile_cache.get(get_cache_key(x))
+    if tile is not None:
+        return Response(content=tile, media_type=content_type)
 
-    if blob_size < offsetBytes:
-        return b""
-    if blob_size < offsetBytes + countBytes:
-        countBytes = blob_size - offsetBytes
-    content = await azure_client.get_blob_content(filepath=iq_file, offset=offsetBytes, length=countBytes)
+    persist = db_min is None and db_max is None and (azure_client.can_write() or azure_client.awsAccessKeyId)
+    if persist and await azure_client.blob_exist(get_tile_file_name(filepath, format, fft_size, zoom, x, y)):
+        tile = await azure_client.get_blob_content(get_tile_file_name(filepath, format, fft_size, zoom, x, y))
+        tile_cache.put(get_cache_key(x), tile)
+        return Response(content=tile, media_type=content_type)
 
-    return content
+    try:
+        tiles = await build_tile_row(azure_client, get_file_name(filepath, ApiType.IQDATA), format, fft_size, zoom, y, db_min, db_max)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if x < 0 or x >= len(tiles):
+        raise HTTPException(status_code=404, detail="Tile not found")
+
+    # every tile in the row came out of the same FFTs, so keep all of them for when the neighbours get requested
+    for tile_x, tile_png in enumerate(tiles):
+        tile_cache.put(get_cache_key(tile_x), tile_png)
+        if persist:
+            background_tasks.add_task(
+                azure_client.upload_blob, filepath=get_tile_file_name(filepath, format, fft_size, zoom, tile_x, y), data=tile_png
+            )
+        if tile_x == x:
+            tile = tile_png
+    return Response(content=tile, media_type=content_type)
 
 
 @router.get(
@@ -160,7 +213,7 @@ async def get_iqfile(
         raise HTTPException(status_code=403, detail="No Access")
     if not datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
-    azure_client = AzureBlobClient(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
+    azure_client = AzureBlobClient.from_datasource(datasource)
     iq_path = get_file_name(filepath, ApiType.IQDATA)
 
     if account == "local":
@@ -168,16 +221,9 @@ async def get_iqfile(
         full_path = os.path.normpath(os.path.join(base_path, iq_path))
         if not full_path.startswith(base_path):
             raise HTTPException(status_code=400, detail="Invalid file path")
-        return FileResponse(full_path)
+        return LocalFileResponse(full_path)
 
-    if hasattr(datasource, "sasToken"):
-        if datasource.sasToken:
-            azure_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
-    if hasattr(datasource, "awsSecretAccessKey"):
-        if datasource.awsSecretAccessKey:
-            azure_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
-
-    if not azure_client.blob_exist(iq_path):
+    if not await azure_client.blob_exist(iq_path):
         raise HTTPException(status_code=404, detail="File not found")
 
     response = await azure_client.get_blob_stream(iq_path)
@@ -198,7 +244,7 @@ async def get_metafile(
         raise HTTPException(status_code=403, detail="No Access")
     if not datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
-    azure_client = AzureBlobClient(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
+    azure_client = AzureBlobClient.from_datasource(datasource)
     meta_path = get_file_name(filepath, ApiType.METADATA)
 
     if account == "local":
@@ -206,16 +252,9 @@ async def get_metafile(
         full_path = os.path.normpath(os.path.join(base_path, meta_path))
         if not full_path.startswith(base_path):
             raise HTTPException(status_code=400, detail="Invalid file path")
-        return FileResponse(full_path)
-
-    if hasattr(datasource, "sasToken"):
-        if datasource.sasToken:
-            azure_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
-    if hasattr(datasource, "awsSecretAccessKey"):
-        if datasource.awsSecretAccessKey:
-            azure_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
+        return LocalFileResponse(full_path)
 
-    if not azure_client.blob_exist(meta_path):
+    if not await azure_client.blob_exist(meta_path):
         raise HTTPException(status_code=404, detail="File not found")
 
     response = await azure_client.get_blob_stream(meta_path)
@@ -233,53 +272,23 @@ async def get_minimap_iq(
     access_allowed=Depends(check_access),
     datasource: DataSource = Depends(datasources.get),
 ):
-    fft_size = 64  # needs to match MINIMAP_FFT_SIZE on the client side!
     if access_allowed is None:
         raise HTTPException(status_code=403, detail="No Access")
     if not datasource:
         raise HTTPException(status_code=404, detail="Datasource not found")
-    azure_client = AzureBlobClient(account=datasource.account, container=datasource.container, awsAccessKeyId=datasource.awsAccessKeyId)
+    azure_client = AzureBlobClient.from_datasource(datasource)
     try:
-        if datasource.sasToken:
-            azure_client.set_sas_token(decrypt(datasource.sasToken.get_secret_value()))
-        if datasource.accountKey:
-            azure_client.set_account_key(decrypt(datasource.accountKey.get_secret_value()))
-        if datasource.awsSecretAccessKey:
-            azure_client.set_aws_secret_access_key(decrypt(datasource.awsSecretAccessKey.get_secret_value()))
         minimap_iq_file = get_file_name(filepath, ApiType.MINIMAP)
         # If minimap has already been generated
         if await azure_client.blob_exist(minimap_iq_file):
             blob = await azure_client.get_blob_content(filepath=minimap_iq_file)
             return Response(content=blob, media_type="application/octet-stream")
         else:
-            file_name = get_file_name(filepath, ApiType.IQDATA)
-            bytes_per_iq_sample = get_bytes_per_iq_sample(format)
-            blob_size = await azure_client.get_file_length(file_name)
-            total_ffts = math.floor(blob_size / (bytes_per_iq_sample * fft_size))
-            # get N ffts equally spaced out
-            N = 200
-            block_indexes = [math.floor(i * total_ffts / N) for i in range(N)]
-            # make sure that no block index is larger than the total number of ffts
-            block_indexes = [i for i in block_indexes if i < total_ffts]
-            data = calculate_iq_data(
-                block_indexes,
-                fft_size,  # default minimap fft size
-                get_bytes_per_iq_sample(format),
-                file_name,
-                azure_client,
-                request,
-            )
-            content = io.BytesIO()
-            async for chunk in data:
-                content.write(chunk)
-            content.seek(0)
-            if azure_client.can_write():
-                await azure_client.upload_blob(filepath=minimap_iq_file, data=content.getvalue())
-            elif azure_client.awsAccessKeyId:  # S3:
-                await azure_client.upload_blob(minimap_iq_file, content.getvalue())
-            content.seek(0)
+            content = await build_minimap(azure_client, filepath, format, request)
+            if azure_client.can_write() or azure_client.awsAccessKeyId:  # S3 creds are assumed to be writable
+                await azure_client.upload_blob(filepath=minimap_iq_file, data=content)
             return Response(
-                content=content.getvalue(),
+                content=content,
                 media_type="application/octet-stream",
             )
     except Exception as e:
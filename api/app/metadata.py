@@ -1,26 +1,32 @@
 import json
+import re
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 from fastapi import Depends
 from helpers.datasource_access import check_access
+from helpers.querycache import query_cache
 from motor.core import AgnosticCollection
 
+from .indexes import ORIGIN_ACCOUNT, ORIGIN_CONTAINER, ORIGIN_FILE_PATH
 from .models import DataSourceReference
 
 
-# This defines how IQEngine deals with missing/optional fields
+# This defines how IQEngine deals with missing/optional fields. It fills in the defaults in place rather than
+# building a new dict, so it costs the same for a meta with a million annotations as for one with none
 def validate_metadata(metadata: dict):
-    if metadata.get("global") is None:
+    global_section = metadata.get("global")
+    if global_section is None:
         raise Exception("Metadata must have global section")
-    if metadata["global"].get("core:datatype") is None:
+    if global_section.get("core:datatype") is None:
         raise Exception("Metadata must have global -> core:datatype")
-    if metadata["global"].get("core:sample_rate") is None:
-        metadata["global"]["core:sample_rate"] = 1
-    if metadata.get("captures") is None or (isinstance(metadata.get("captures"), list) and len(metadata.get("captures")) == 0):
+    if global_section.get("core:sample_rate") is None:
+        global_section["core:sample_rate"] = 1
+    captures = metadata.get("captures")
+    if captures is None or (isinstance(captures, list) and len(captures) == 0):
         metadata["captures"] = [{"core:sample_start": 0, "core:frequency": 0}]
-    if isinstance(metadata["global"].get("core:extensions", None), dict):
-        metadata["global"]["core:extensions"] = []  # empty list instead of whatever dict they provided
+    if isinstance(global_section.get("core:extensions", None), dict):
+        global_section["core:extensions"] = []  # empty list instead of whatever dict they provided
     return metadata
 
 
@@ -87,6 +93,7 @@ async def create(metadata: dict, user: str):
 
     versions: AgnosticCollection = versions_collection()
     await versions.insert_one(audit_document)
+    query_cache.invalidate(filter["global.traceability:origin.account"], filter["global.traceability:origin.container"])
 
 
 class InvalidGeolocationFormat(Exception):
@@ -95,6 +102,12 @@ class InvalidGeolocationFormat(Exception):
         super().__init__(self.message)
 
 
+class UnsupportedQuery(Exception):
+    def __init__(self, message="Unsupported combination of query parameters"):
+        self.message = message
+        super().__init__(self.message)
+
+
 async def process_geolocation(target: str, geolocation: str):
     try:
         geo_long_str, geo_lat_str, geo_radius_str = geolocation.split(",")
@@ -123,6 +136,38 @@ async def process_geolocation(target: str, geolocation: str):
         raise InvalidGeolocationFormat()
 
 
+def origin_match(value: str, match_mode: str):
+    # How an account or container is compared. exact and prefix (case sensitive, anchored) can use the origin indexes,
+    # regex is the original unanchored case-insensitive match, which has to look at every doc
+    if match_mode == "exact":
+        return value
+    if match_mode == "prefix":
+        return re.compile("^" + re.escape(value))
+    return {"$regex": value, "$options": "i"}
+
+
+def origin_condition(field: str, values: List[str], match_mode: str) -> dict:
+    if match_mode == "regex":
+        return {"$or": [{field: origin_match(value, match_mode)} for value in values]}
+    return {field: {"$in": [origin_match(value, match_mode) for value in values]}}
+
+
+def text_search_condition(text: Optional[str], fields: Dict[str, Optional[str]]) -> dict:
+    """
+    The search_mode="text" version of the text, author, description, label and comment filters. The text index
+    narrows it down to the docs containing every term as a phrase, then the field specific terms are checked against
+    their own field, which only has to look at those candidates.
+    """
+    phrases = [value for value in [text, *fields.values()] if value]
+    if not phrases:
+        return {}
+    condition: Dict[str, Any] = {"$text": {"$search": " ".join('"' + phrase.replace('"', " ") + '"' for phrase in phrases)}}
+    for field, value in fields.items():
+        if value:
+            condition[field] = {"$regex": re.escape(value), "$options": "i"}
+    return condition
+
+
 async def query_metadata(
     account: Optional[List[str]] = [],
     container: Optional[List[str]] = [],
@@ -142,6 +187,8 @@ async def query_metadata(
     captures_radius: Optional[float] = None,
     annotations_geo_json: Optional[str] = None,
     annotations_radius: Optional[float] = None,
+    search_mode: str = "regex",
+    match_mode: str = "regex",
 ) -> List[DataSourceReference]:
     """
     This function is responsible for querying metadata from the specified MongoDB collection based on various
@@ -165,6 +212,10 @@ async def query_metadata(
     - min_datetime (Optional[datetime]): The minimum datetime value to filter the metadata by.
     - max_datetime (Optional[datetime]): The maximum datetime value to filter the metadata by.
     - text (Optional[str]): A keyword to search for in various description fields to filter the metadata by.
+    - search_mode (str): "regex" matches author, description, label, comment and text as case-insensitive
+    substrings, "text" uses the metadata text index (whole words, see text_search_condition).
+    - match_mode (str): "regex" matches account, container and database_id as case-insensitive substrings,
+    "exact" and "prefix" are case sensitive and use the origin indexes.
 
     Returns:
     - A list of dictionaries, each containing the metadata information for a specific data source.
@@ -186,6 +237,10 @@ async def query_metadata(
     This example queries the metadata with specified filter criteria and returns a list of data source
     references that match the search.
     """
+    if search_mode not in ("regex", "text"):
+        raise ValueError(f"Unknown search_mode {search_mode}")
+    if match_mode not in ("regex", "exact", "prefix"):
+        raise ValueError(f"Unknown match_mode {match_mode}")
     metadataSet: AgnosticCollection = collection()
     query_condition: Dict[str, Any] = {}
     if database_id:
@@ -195,64 +250,45 @@ async def query_metadata(
             database_id_conditions.append(
                 {
                     "$and": [
-                        {
-                            "global.traceability:origin.account": {
-                                "$regex": account_part,
-                                "$options": "i",
-                            }
-                        },
-                        {
-                            "global.traceability:origin.container": {
-                                "$regex": container_part,
-                                "$options": "i",
-                            }
-                        },
+                        {"global.traceability:origin.account": origin_match(account_part, match_mode)},
+                        {"global.traceability:origin.container": origin_match(container_part, match_mode)},
                     ]
                 }
             )
         query_condition.update({"$or": database_id_conditions})
     if account:
-        query_condition.update(
-            {
-                "$or": [
-                    {
-                        "global.traceability:origin.account": {
-                            "$regex": a,
-                            "$options": "i",
-                        }
-                    }
-                    for a in account
-                ]
-            }
-        )
+        query_condition.update(origin_condition("global.traceability:origin.account", account, match_mode))
     if container:
-        query_condition.update(
-            {
-                "$or": [
-                    {
-                        "global.traceability:origin.container": {
-                            "$regex": c,
-                            "$options": "i",
-                        }
-                    }
-                    for c in container
-                ]
-            }
-        )
+        query_condition.update(origin_condition("global.traceability:origin.container", container, match_mode))
     if min_frequency is not None:
         query_condition.update({"captures.core:frequency": {"$gte": min_frequency}})
     if max_frequency is not None:
         query_condition.update({"captures.core:frequency": {"$lte": max_frequency}})
-    if author is not None:
+    if search_mode == "text":
+        query_condition.update(
+            text_search_condition(
+                text,
+                {
+                    "global.core:author": author,
+                    "global.core:description": description,
+                    "annotations.core:label": label,
+                    "annotations.core:description": comment,
+                },
+            )
+        )
+    if search_mode == "regex" and author is not None:
         query_condition.update({"global.core:author": {"$regex": author, "$options": "i"}})
     # global description
-    if description is not None:
+    if search_mode == "regex" and description is not None:
         query_condition.update({"global.core:description": {"$regex": description, "$options": "i"}})
-    if label is not None:
+    if search_mode == "regex" and label is not None:
         query_condition.update({"annotations.core:label": {"$regex": label, "$options": "i"}})
-    if comment is not None:
+    if search_mode == "regex" and comment is not None:
         query_condition.update({"annotations.core:description": {"$regex": comment, "$options": "i"}})
 
+    # MongoDB can't combine $text with the $near the geo filters use
+    if "$text" in query_condition and (captures_geo or annotations_geo or captures_geo_json or annotations_geo_json):
+        raise UnsupportedQuery("search_mode=text can't be combined with the geolocation filters")
     if captures_geo:
         query_condition.update(await process_geolocation("captures", captures_geo))
     if annotations_geo:
@@ -280,7 +316,7 @@ async def query_metadata(
             }
         )
 
-    if text is not None:
+    if search_mode == "regex" and text is not None:
         or_condition = [
             {"global.core:description": {"$regex": text, "$options": "i"}},
             {"annotations.core:label": {"$regex": text, "$options": "i"}},
@@ -298,6 +334,7 @@ async def query_metadata(
             datetime_query.update({"$lte": max_datetime_formatted})
         query_condition.update({"captures.core:datetime": datetime_query})
 
+    # a stable order (the origin index's) so offset/limit pages don't skip or repeat recordings between searches
     metadata = metadataSet.find(
         query_condition,
         {
@@ -307,7 +344,7 @@ async def query_metadata(
             "global.traceability:origin.file_path": 1,
             "_id": 0,
         },
-    )
+    ).sort([(ORIGIN_ACCOUNT, 1), (ORIGIN_CONTAINER, 1), (ORIGIN_FILE_PATH, 1)])
 
     result = []
     async for datum in metadata:
@@ -320,3 +357,13 @@ async def query_metadata(
         )
         result.append(ds_reference)
     return result
+
+
+async def cached_query_metadata(**params) -> List[DataSourceReference]:
+    # query_metadata through the query cache, the results are shared so callers must not modify the list
+    generation = query_cache.generation
+    results = query_cache.get(params)
+    if results is None:
+        results = await query_metadata(**params)
+        query_cache.put(params, results, generation)
+    return results
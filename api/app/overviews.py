@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from typing import List, Optional, Tuple
+
+from helpers.metrics import sync_phase_duration
+from helpers.urlmapping import ApiType, get_file_name, get_tile_file_name
+
+from .azure_client import AzureBlobClient
+from .iq_router import build_minimap
+from .tiles import build_tile_row, get_max_zoom, get_num_tile_rows
+
+# Optional sync stage that precomputes the per-recording overview artifacts (minimap, thumbnail and the zoomed out
+# levels of the spectrogram tile pyramid) and stores them next to the data, so the first person to open a recording
+# doesn't pay for generating them. Anything that already exists is skipped, so an interrupted run just picks up
+# where it left off next sync.
+PRECOMPUTE_WORKERS = int(os.getenv("IQENGINE_PRECOMPUTE_WORKERS", "4"))
+PRECOMPUTE_FFT_SIZE = int(os.getenv("IQENGINE_PRECOMPUTE_FFT_SIZE", "1024"))
+PRECOMPUTE_MAX_ZOOM = int(os.getenv("IQENGINE_PRECOMPUTE_MAX_ZOOM", "0"))
+
+# (account, container) -> progress of the most recent run in this worker
+overview_progress: dict[tuple, dict] = {}
+# (account, container) -> the run still going in this worker, so a newer sync can replace it and shutdown can stop it
+overview_tasks: dict[tuple, asyncio.Task] = {}
+
+
+def precompute_enabled() -> bool:
+    return os.getenv("IQENGINE_PRECOMPUTE_OVERVIEWS", "0") not in ("", "0", "false", "False")
+
+
+async def build_recording_overviews(azure_client: AzureBlobClient, filepath: str, datatype: str) -> int:
+    # Returns how many artifacts were generated, 0 means everything was already there
+    generated = 0
+    minimap_file = get_file_name(filepath, ApiType.MINIMAP)
+    if not await azure_client.blob_exist(minimap_file):
+        await azure_client.upload_blob(filepath=minimap_file, data=await build_minimap(azure_client, filepath, datatype))
+        generated += 1
+
+    thumbnail_file = get_file_name(filepath, ApiType.THUMB)
+    if not await azure_client.blob_exist(thumbnail_file):
+        await azure_client.upload_blob(filepath=thumbnail_file, data=await azure_client.get_new_thumbnail(data_type=datatype, filepath=filepath))
+        generated += 1
+
+    blob_size = await azure_client.get_file_length(get_file_name(filepath, ApiType.IQDATA))
+    for zoom in range(min(PRECOMPUTE_MAX_ZOOM, get_max_zoom(PRECOMPUTE_FFT_SIZE)) + 1):
+        for y in range(get_num_tile_rows(blob_size, datatype, PRECOMPUTE_FFT_SIZE, zoom)):
+            # a row of tiles is uploaded left to right, so the last tile existing means the row is done
+            if await azure_client.blob_exist(get_tile_file_name(filepath, datatype, PRECOMPUTE_FFT_SIZE, zoom, 2**zoom - 1, y)):
+                continue
+            tiles = await build_tile_row(azure_client, get_file_name(filepath, ApiType.IQDATA), datatype, PRECOMPUTE_FFT_SIZE, zoom, y)
+            for x, tile in enumerate(tiles):
+                tile_file = get_tile_file_name(filepath, datatype, PRECOMPUTE_FFT_SIZE, zoom, x, y)
+                await azure_client.upload_blob(filepath=tile_file, data=tile)
+                generated += 1
+    return generated
+
+
+async def build_overviews(azure_client: AzureBlobClient, recordings: List[Tuple[str, str]]):
+    """
+    Generates overviews for every (filepath, datatype) with a bounded pool of workers, progress is tracked in
+    overview_progress and printed as it goes.
+    """
+    account, container = azure_client.account, azure_client.container
+    if not (azure_client.can_write() or azure_client.awsAccessKeyId):
+        print(f"[OVERVIEWS] Skipping {account}/{container}, datasource is not writable")
+        return None
+    progress = {"total": len(recordings), "done": 0, "generated": 0, "failed": 0, "started": time.time(), "finished": None}
+    overview_progress[(account, container)] = progress
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for recording in recordings:
+        queue.put_nowait(recording)
+
+    async def worker():
+        while True:
+            try:
+                filepath, datatype = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                progress["generated"] += await build_recording_overviews(azure_client, filepath, datatype)
+            except Exception as e:
+                progress["failed"] += 1
+                print(f"[OVERVIEWS] Error building overviews for {filepath}: {e}")
+            progress["done"] += 1
+            if progress["done"] % 100 == 0:
+                print(f"[OVERVIEWS] {account}/{container} {progress['done']}/{progress['total']} recordings done")
+
+    await asyncio.gather(*[worker() for _ in range(max(1, PRECOMPUTE_WORKERS))])
+    progress["finished"] = time.time()
+    print(
+        f"[OVERVIEWS] Finished {account}/{container}, {progress['generated']} artifacts generated "
+        f"for {progress['total']} recordings ({progress['failed']} failed) in {progress['finished'] - progress['started']:.1f} seconds"
+    )
+    return progress
+
+
+def start_overviews(azure_client: AzureBlobClient, recordings: List[Tuple[str, str]]) -> Optional[asyncio.Task]:
+    """
+    Runs build_overviews as a background task so the sync that kicked it off can return right away. A run still going
+    for the same datasource is cancelled, the new one skips whatever that one already generated. The blob clients are
+    closed when the run ends.
+    """
+    key = (azure_client.account, azure_client.container)
+    previous = overview_tasks.get(key)
+    if previous is not None and not previous.done():
+        previous.cancel()
+
+    async def run():
+        try:
+            with sync_phase_duration.time(phase="overviews"):
+                await build_overviews(azure_client, recordings)
+        except Exception as e:
+            print(f"[OVERVIEWS] Error building overviews for {key[0]}/{key[1]}: {e}")
+        finally:
+            await azure_client.close_blob_clients()
+            if overview_tasks.get(key) is task:
+                del overview_tasks[key]
+
+    task = asyncio.create_task(run())
+    overview_tasks[key] = task
+    return task
+
+
+async def cancel_overview_tasks():
+    # Shutdown handler, whatever isn't done gets picked up by the next sync since existing artifacts are skipped
+    tasks = list(overview_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    overview_tasks.clear()
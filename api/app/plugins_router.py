@@ -1,7 +1,8 @@
-from typing import Optional
+from typing import Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from helpers.authorization import get_current_user
+from helpers.listing import LISTING_MAX_LIMIT, after_filter, listing_response
 
 from .database import db
 from .models import Plugin
@@ -28,8 +29,21 @@ async def create_plugin(
 
 @router.get("/api/plugins/", response_model=list[Plugin])
 @router.get("/api/plugins", response_model=list[Plugin])
-async def get_plugins(current_user: Optional[dict] = Depends(get_current_user)):
-    return list(await db().plugins.find({}).to_list(1_000_000))
+async def get_plugins(
+    limit: Optional[int] = Query(None, ge=1, le=LISTING_MAX_LIMIT),
+    after: Optional[str] = Query(None),
+    format: Literal["json", "ndjson"] = Query("json"),
+    current_user: Optional[dict] = Depends(get_current_user),
+):
+    cursor = db().plugins.find(after_filter(["name"], after)).sort("name", 1)
+    if limit is not None:
+        cursor = cursor.limit(limit + 1)
+
+    async def plugins():
+        async for plugin in cursor:
+            yield Plugin(**plugin).model_dump()
+
+    return await listing_response(plugins(), lambda plugin: [plugin["name"]], limit, format)
 
 
 @router.get("/api/plugins/{plugin_name}", response_model=Plugin)
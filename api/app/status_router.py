@@ -1,10 +1,38 @@
-from fastapi import APIRouter
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from helpers import localio
+from helpers.apidisconnect import disconnect_stats
+from helpers.authorization import required_roles, verified_tokens
+from helpers.blobinfo import blob_info_cache
+from helpers.blockcache import block_cache
+from helpers.datasource_access import datasource_cache
+from helpers.metrics import registry
+from helpers.mmapcache import mmap_cache
+from helpers.querycache import query_cache
 from pymongo.errors import ServerSelectionTimeoutError
 
+from . import client_pool
 from .database import db
+from .indexes import get_index_usage
+from .tiles import tile_cache
 
 router = APIRouter()
 
+# The per worker caches and pools count their own hits and sizes, /api/metrics reports them alongside the
+# request, storage, mongo and sync timings
+registry.register_stats("cache", blob_info_cache.stats, cache="blob_info")
+registry.register_stats("cache", block_cache.stats, cache="block")
+registry.register_stats("cache", tile_cache.stats, cache="tile")
+registry.register_stats("cache", datasource_cache.stats, cache="datasource")
+registry.register_stats("cache", query_cache.stats, cache="query")
+registry.register_stats("cache", verified_tokens.stats, cache="auth_token")
+registry.register_stats("mmap", mmap_cache.stats)
+registry.register_stats("local_io", localio.stats)
+registry.register_stats("client_pool", client_pool.stats)
+registry.register_stats("disconnect", disconnect_stats.stats)
+
 
 @router.get("/api/status")
 async def get_status():
@@ -14,3 +42,15 @@ async def get_status():
     except ServerSelectionTimeoutError:
         return "No Database Connection Available"
     return "OK"
+
+
+@router.get("/api/status/indexes")
+async def get_indexes_status(current_user: Optional[dict] = Depends(required_roles("IQEngine-Admin"))):
+    # Usage counts of the metadata indexes, to check lookups and queries are hitting them
+    return await get_index_usage()
+
+
+@router.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, the numbers are for the worker that answered the scrape
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
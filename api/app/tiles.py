@@ -0,0 +1,112 @@
+import asyncio
+import math
+import os
+from typing import List, Optional
+
+import numpy as np
+from helpers.blockcache import BlockCache
+from helpers.rangeplanner import plan_reads
+from helpers.samples import get_bytes_per_iq_sample, get_samples
+from helpers.spectrogram import block_reduce, compute_spectrogram, encode_png, to_uint8
+
+# Spectrogram tile pyramid, same layout as tools/pmtiles/create_pmtiles.py but built on demand from the recording.
+# At the deepest zoom (max_zoom) one pixel is one FFT bin of one FFT, each zoom level out max-decimates by another
+# factor of 2 in both time and frequency. Zoom z has 2**z tiles across the band (x) and as many tiles down the
+# recording (y) as it takes to cover every FFT.
+TILE_SIZE = 256
+# Upper bound on samples read for one row of tiles. Zoomed out tiles span far more FFTs than that, so only an evenly
+# spaced subset of the FFTs under each pixel row is computed instead of downloading every sample.
+MAX_SAMPLES_PER_TILE_ROW = int(os.getenv("IQENGINE_TILE_MAX_SAMPLES", str(4 * 1024 * 1024)))
+MAX_FFT_SIZE = 65536
+DYNAMIC_RANGE_DB = 100
+
+tile_cache = BlockCache(int(float(os.getenv("IQENGINE_TILE_CACHE_SIZE_MB", "64")) * 1024 * 1024))
+
+
+def get_max_zoom(fft_size: int) -> int:
+    if fft_size <= 0 or fft_size & (fft_size - 1):
+        raise ValueError("fft_size must be a power of 2")
+    if fft_size <= TILE_SIZE:
+        return 0
+    return int(math.log2(fft_size // TILE_SIZE))
+
+
+def get_db_range(fft_size: int, db_min: Optional[float], db_max: Optional[float]):
+    # Samples are normalized to +/-1 so a full scale tone peaks at 20*log10(fft_size) dB
+    if db_max is None:
+        db_max = 20 * math.log10(fft_size)
+    if db_min is None:
+        db_min = db_max - DYNAMIC_RANGE_DB
+    if db_min >= db_max:
+        raise ValueError("db_min must be less than db_max")
+    return db_min, db_max
+
+
+def get_num_tile_rows(blob_size: int, datatype: str, fft_size: int, zoom: int) -> int:
+    total_ffts = blob_size // (fft_size * get_bytes_per_iq_sample(datatype))
+    decimation = 2 ** (get_max_zoom(fft_size) - zoom)
+    return math.ceil(total_ffts / (TILE_SIZE * decimation))
+
+
+async def build_tile_row(
+    azure_client,
+    iq_file: str,
+    datatype: str,
+    fft_size: int,
+    zoom: int,
+    y: int,
+    db_min: Optional[float] = None,
+    db_max: Optional[float] = None,
+) -> List[bytes]:
+    """
+    Builds every tile in row y of the given zoom level as PNGs ordered by x, since they all come out of the same FFTs.
+    Returns an empty list if y is past the end of the recording.
+    """
+    max_zoom = get_max_zoom(fft_size)
+    if zoom < 0 or zoom > max_zoom:
+        raise ValueError(f"zoom must be between 0 and {max_zoom} for fft_size {fft_size}")
+    db_min, db_max = get_db_range(fft_size, db_min, db_max)
+    bytes_per_iq_sample = get_bytes_per_iq_sample(datatype)
+    decimation = 2 ** (max_zoom - zoom)
+
+    blob_size = await azure_client.get_file_length(iq_file)
+    total_ffts = blob_size // (fft_size * bytes_per_iq_sample)
+    first_fft = y * TILE_SIZE * decimation
+    if y < 0 or first_fft >= total_ffts:
+        return []
+    num_ffts = min(TILE_SIZE * decimation, total_ffts - first_fft)
+    num_pixel_rows = math.ceil(num_ffts / decimation)
+
+    # Pick which FFTs to compute under each pixel row, all of them when zoomed in, a spread out subset when zoomed out.
+    # Even one FFT per pixel row has to fit under the cap, anything bigger is refused rather than read anyway.
+    if num_pixel_rows * fft_size > MAX_SAMPLES_PER_TILE_ROW:
+        raise ValueError(f"a tile row with fft_size {fft_size} would read more than {MAX_SAMPLES_PER_TILE_ROW} samples")
+    ffts_per_pixel_row = min(decimation, MAX_SAMPLES_PER_TILE_ROW // (num_pixel_rows * fft_size))
+    fft_indexes = []
+    pixel_row_starts = []
+    for row in range(num_pixel_rows):
+        row_start = first_fft + row * decimation
+        row_stop = min(row_start + decimation, total_ffts)
+        pixel_row_starts.append(len(fft_indexes))
+        fft_indexes.extend(sorted(set(np.linspace(row_start, row_stop - 1, ffts_per_pixel_row, dtype=int).tolist())))
+
+    reads = plan_reads(list(fft_indexes), fft_size, bytes_per_iq_sample, blob_size, azure_client.backend)
+    contents = await asyncio.gather(
+        *[azure_client.get_blob_content(filepath=iq_file, offset=range_read.offset, length=range_read.length) for range_read in reads]
+    )
+    content = b"".join(chunk for range_read, read_content in zip(reads, contents) for chunk in range_read.split(read_content))
+
+    # the FFTs and PNG encodes are CPU heavy and numpy and PIL release the GIL, so keep them off the event loop
+    return await asyncio.to_thread(render_tile_row, content, datatype, fft_size, decimation, pixel_row_starts, db_min, db_max)
+
+
+def render_tile_row(
+    content, datatype: str, fft_size: int, decimation: int, pixel_row_starts: List[int], db_min: float, db_max: float
+) -> List[bytes]:
+    spectrogram = compute_spectrogram(get_samples(content, datatype), fft_size)
+    spectrogram = np.maximum.reduceat(spectrogram, pixel_row_starts, axis=0)  # max over the FFTs under each pixel row
+    if decimation > 1:
+        spectrogram = block_reduce(spectrogram, (1, decimation), np.max)
+    image = to_uint8(spectrogram, db_min, db_max)
+    tile_width = min(TILE_SIZE, fft_size)
+    return [encode_png(image[:, x * tile_width : (x + 1) * tile_width]) for x in range(image.shape[1] // tile_width)]
@@ -0,0 +1,304 @@
+"""
+End to end benchmark of the API hot paths. Writes synthetic SigMF recordings, syncs them into the metadata database
+(the in-memory MongoDB unless IN_MEMORY_DB=0 and IQENGINE_METADATA_DB_CONNECTION_STRING is set), then drives the
+iq-data, minimap-data, thumbnail, meta and query endpoints through the ASGI app with concurrent clients and reports
+throughput and p50/p99 latency for each, plus how long a first sync and an unchanged re-sync took.
+
+    cd api && python -m benchmarks.bench_api
+    cd api && python -m benchmarks.bench_api --recordings 50 --samples 4000000 --datatype ci16_le --concurrency 64
+    cd api && python -m benchmarks.bench_api --backend s3   # a local moto S3 server stands in for AWS, needs moto[server]
+
+--json writes the results to a file, --baseline compares them against an earlier --json run and exits with 1 when a
+p50 or p99 got more than --tolerance slower, so a regression in iq_router or datasources.sync fails the build.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKENDS = ["local", "s3"]
+S3_REGION = "us-east-1"
+S3_BUCKET = "iqengine-bench"
+S3_CREDENTIALS = "testing"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=BACKENDS, default="local")
+    parser.add_argument("--recordings", type=int, default=10, help="number of synthetic recordings")
+    parser.add_argument("--samples", type=int, default=2_000_000, help="IQ samples per recording")
+    parser.add_argument("--datatype", default="cf32_le", help="SigMF datatype of the recordings")
+    parser.add_argument("--annotations", type=int, default=100, help="annotations per recording")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--block-size", type=int, default=1024, help="FFT size of the iq-data requests")
+    parser.add_argument("--blocks", type=int, default=64, help="blocks per iq-data request")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint first")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier --json run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against --baseline, 0.25 = 25%%")
+    return parser.parse_args(argv)
+
+
+def synthetic_recording(num_samples: int, datatype: str, num_annotations: int, seed: int):
+    # Returns (data bytes, meta dict), a tone plus noise so spectrograms and thumbnails have something to render
+    from helpers.samples import parse_datatype
+
+    dtype, _, _, is_complex = parse_datatype(datatype)
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_samples)
+    signal = 0.5 * np.exp(2j * np.pi * 0.05 * t) + 0.1 * (rng.standard_normal(num_samples) + 1j * rng.standard_normal(num_samples))
+    values = np.empty(num_samples * 2 if is_complex else num_samples, dtype=np.float64)
+    if is_complex:
+        values[0::2], values[1::2] = signal.real, signal.imag
+    else:
+        values[:] = signal.real
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        values = values * info.max if dtype.kind == "i" else (values + 1) * (info.max / 2)
+        values = np.clip(values, info.min, info.max)
+    data = values.astype(dtype).tobytes()
+
+    starts = np.sort(rng.integers(0, max(1, num_samples - 1000), num_annotations))
+    meta = {
+        "global": {
+            "core:datatype": datatype,
+            "core:sample_rate": 2e6,
+            "core:version": "1.0.0",
+            "core:author": "bench",
+            "core:description": f"synthetic recording {seed}",
+        },
+        "captures": [{"core:sample_start": 0, "core:frequency": 915e6 + seed * 1e6, "core:datetime": "2024-01-01T00:00:00Z"}],
+        "annotations": [
+            {
+                "core:sample_start": int(start),
+                "core:sample_count": 1000,
+                "core:freq_lower_edge": 914.9e6 + seed * 1e6,
+                "core:freq_upper_edge": 915.1e6 + seed * 1e6,
+                "core:label": f"burst {i % 10}",
+            }
+            for i, start in enumerate(starts)
+        ],
+    }
+    return data, meta
+
+
+def recording_name(i: int) -> str:
+    return f"bench/recording_{i:04}"
+
+
+def write_recordings(directory: str, args) -> list:
+    names = []
+    for i in range(args.recordings):
+        name = recording_name(i)
+        os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+        data, meta = synthetic_recording(args.samples, args.datatype, args.annotations, seed=i)
+        with open(os.path.join(directory, name + ".sigmf-data"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(directory, name + ".sigmf-meta"), "w") as f:
+            json.dump(meta, f)
+        names.append(name)
+    return names
+
+
+def start_s3_stand_in(directory: str):
+    # moto's threaded server speaks the S3 API on localhost, the recordings are uploaded to a bucket on it
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit("--backend s3 needs moto's server mode, pip install 'moto[server]'")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+    os.environ["IQENGINE_S3_ENDPOINT_URL"] = endpoint_url
+    s3 = boto3.client(
+        "s3", endpoint_url=endpoint_url, region_name=S3_REGION, aws_access_key_id=S3_CREDENTIALS, aws_secret_access_key=S3_CREDENTIALS
+    )
+    s3.create_bucket(Bucket=S3_BUCKET)
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            s3.upload_file(path, S3_BUCKET, os.path.relpath(path, directory).replace(os.sep, "/"))
+    return server
+
+
+def summarize(name: str, latencies: list, total_bytes: int, errors: int, elapsed: float) -> dict:
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "endpoint": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "mb_per_second": total_bytes / elapsed / 1e6 if elapsed else 0.0,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max()),
+    }
+
+
+async def run_endpoint(client, name: str, urls: list, concurrency: int, warmup: int) -> dict:
+    for url in urls[:warmup]:
+        await client.get(url)
+    latencies = []
+    total_bytes = 0
+    errors = 0
+    queue = iter(urls)
+
+    async def worker():
+        nonlocal total_bytes, errors
+        for url in queue:  # workers share the one iterator, each url is requested once
+            start = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - start)
+            total_bytes += len(response.content)
+            if response.status_code != 200:
+                errors += 1
+                if errors == 1:
+                    print(f"  {name}: {url} returned {response.status_code} {response.text[:200]}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(name, latencies, total_bytes, errors, time.perf_counter() - start)
+
+
+def endpoint_urls(account: str, container: str, names: list, args) -> dict:
+    rng = np.random.default_rng(0)
+    prefix = f"/api/datasources/{account}/{container}"
+    total_blocks = args.samples // args.block_size
+    pick = [names[i] for i in rng.integers(0, len(names), args.requests)]
+
+    iq_data = []
+    for name in pick:
+        # a window of consecutive blocks, like scrolling the spectrogram
+        first = int(rng.integers(0, max(1, total_blocks - args.blocks)))
+        blocks = ",".join(str(b) for b in range(first, min(total_blocks, first + args.blocks)))
+        iq_data.append(f"{prefix}/{name}/iq-data?block_indexes_str={blocks}&block_size={args.block_size}&format={args.datatype}")
+    return {
+        "iq-data": iq_data,
+        "minimap-data": [f"{prefix}/{name}/minimap-data?format={args.datatype}" for name in pick],
+        "thumbnail": [f"{prefix}/{name}.jpg" for name in pick],
+        "meta": [f"{prefix}/{name}/meta" for name in pick],
+        # ten distinct searches, the first of each misses the query cache and the rest hit it
+        "query": [f"/api/datasources/query?label=burst%20{i % 10}&min_frequency=900000000" for i in range(args.requests)],
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    from app import datasources
+    from app.client_pool import close_client_pool
+    from app.database import db, reset_db
+    from app.indexes import ensure_indexes
+    from app.models import DataSource
+    from main import app
+    from pydantic import SecretStr
+
+    db()
+    await ensure_indexes()
+    if args.backend == "local":
+        datasource = DataSource(account="local", container="local", name="bench", type="api", public=True)
+    else:
+        datasource = DataSource(
+            account=S3_REGION,
+            container=S3_BUCKET,
+            awsAccessKeyId=S3_CREDENTIALS,
+            awsSecretAccessKey=SecretStr(S3_CREDENTIALS),
+            name="bench",
+            type="api",
+            public=True,
+        )
+    await datasources.create_datasource(datasource, user=None)
+
+    results = {"config": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")}, "sync": {}, "endpoints": []}
+    for phase in ("first", "unchanged"):
+        start = time.perf_counter()
+        status = await datasources.sync(datasource.account, datasource.container, datasource.awsAccessKeyId)
+        seconds = time.perf_counter() - start
+        results["sync"][phase] = {
+            "seconds": seconds,
+            "recordings_per_second": args.recordings / seconds,
+            **{key: status[key] for key in ("added", "unchanged", "failed")},
+        }
+
+    transport = httpx.ASGITransport(app=app)
+    names = [recording_name(i) for i in range(args.recordings)]
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, urls in endpoint_urls(datasource.account, datasource.container, names, args).items():
+            results["endpoints"].append(await run_endpoint(client, name, urls, args.concurrency, args.warmup))
+
+    await close_client_pool()
+    datasources.close_process_pool()
+    await reset_db()
+    return results
+
+
+def print_results(results: dict):
+    for phase, sync in results["sync"].items():
+        print(
+            f"sync {phase:9} {sync['seconds']:8.2f} s  {sync['recordings_per_second']:8.1f} recordings/s"
+            f"  ({sync['added']} added, {sync['unchanged']} unchanged, {sync['failed']} failed)"
+        )
+    print(f"{'endpoint':14} {'requests':>8} {'errors':>6} {'req/s':>9} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for r in results["endpoints"]:
+        print(
+            f"{r['endpoint']:14} {r['requests']:8} {r['errors']:6} {r['requests_per_second']:9.1f} {r['mb_per_second']:9.2f}"
+            f" {r['p50_ms']:9.2f} {r['p99_ms']:9.2f} {r['max_ms']:9.2f}"
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # Endpoints (and the sync) that got more than tolerance slower than the baseline
+    regressions = []
+    previous = {r["endpoint"]: r for r in baseline.get("endpoints", [])}
+    for r in results["endpoints"]:
+        before = previous.get(r["endpoint"])
+        for key in ("p50_ms", "p99_ms"):
+            if before and before[key] > 0 and r[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{r['endpoint']} {key} {before[key]:.2f} -> {r[key]:.2f}")
+    for phase, sync in results["sync"].items():
+        before = baseline.get("sync", {}).get(phase)
+        if before and sync["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(f"sync {phase} {before['seconds']:.2f} s -> {sync['seconds']:.2f} s")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="iqengine-bench-") as directory:
+        # the app reads these when it's imported and when clients are made, so they're set before anything is imported
+        os.environ.setdefault("IN_MEMORY_DB", "1")
+        os.environ["IQENGINE_BACKEND_LOCAL_FILEPATH"] = directory
+        print(f"writing {args.recordings} recordings of {args.samples} {args.datatype} samples to {directory}")
+        write_recordings(directory, args)
+        server = start_s3_stand_in(directory) if args.backend == "s3" else None
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            if server is not None:
+                server.stop()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
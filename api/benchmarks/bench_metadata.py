@@ -0,0 +1,85 @@
+"""
+Metadata ingestion benchmark over a synthetic corpus of .sigmf-meta files with many annotations. Compares the path
+sync used to take (json.loads, validate_metadata, bson.encode) with app.datasources.encode_metadata_file using each
+installed JSON backend, then times the corpus through the sync process pool against doing it all in-process.
+
+    cd api && python -m benchmarks.bench_metadata
+"""
+import json
+import time
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from app import datasources
+from app.datasources import encode_metadata_file
+from app.metadata import validate_metadata
+from bson import encode
+from helpers import fastjson
+
+ANNOTATION_COUNTS = [10, 1_000, 10_000, 50_000]
+REPEAT = 5
+TRACEABILITY = {"traceability:origin": {"type": "api", "account": "local", "container": "local", "file_path": "rec"}, "traceability:revision": 0}
+
+
+def synthetic_meta(num_annotations: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.integers(0, 10**9, num_annotations))
+    annotations = [
+        {
+            "core:sample_start": int(start),
+            "core:sample_count": int(rng.integers(1000, 100_000)),
+            "core:freq_lower_edge": 915e6 + float(rng.uniform(-1e6, 0)),
+            "core:freq_upper_edge": 915e6 + float(rng.uniform(0, 1e6)),
+            "core:label": f"burst {i}",
+            "core:comment": "detected by the energy detector",
+        }
+        for i, start in enumerate(starts)
+    ]
+    meta = {
+        "global": {"core:datatype": "cf32_le", "core:sample_rate": 2e6, "core:version": "1.0.0", "core:description": "synthetic"},
+        "captures": [{"core:sample_start": 0, "core:frequency": 915e6, "core:datetime": "2024-01-01T00:00:00Z"}],
+        "annotations": annotations,
+    }
+    return json.dumps(meta, indent=2).encode()
+
+
+def legacy_encode(content: bytes) -> bytes:
+    metadata = validate_metadata(json.loads(content))
+    metadata["global"].update(TRACEABILITY)
+    return encode(metadata)
+
+
+def main():
+    backends = ["json"] + [name for name, module in (("orjson", fastjson.orjson), ("msgspec", fastjson.msgspec)) if module is not None]
+    corpus = {count: synthetic_meta(count) for count in ANNOTATION_COUNTS}
+    print(f"best of {REPEAT}, backends: {', '.join(backends)}")
+    for count, content in corpus.items():
+        legacy = min(timeit.repeat(lambda: legacy_encode(content), number=1, repeat=REPEAT))
+        line = f"{count:6} annotations ({len(content) / 1e6:6.2f} MB)  legacy {legacy * 1000:8.2f} ms"
+        for backend in backends:
+            fastjson.BACKEND, fastjson._loads, fastjson._decode_error = fastjson._select_backend(backend)
+            new = min(timeit.repeat(lambda: encode_metadata_file(content, TRACEABILITY, 800), number=1, repeat=REPEAT))
+            line += f"   {backend} {new * 1000:8.2f} ms ({legacy / new:4.1f}x)"
+        print(line)
+    fastjson.BACKEND, fastjson._loads, fastjson._decode_error = fastjson._select_backend("auto")
+
+    # a sync-sized batch of big metas, in-process vs the pool
+    batch = [synthetic_meta(10_000, seed) for seed in range(16)]
+    start = time.perf_counter()
+    for content in batch:
+        encode_metadata_file(content, TRACEABILITY, 800)
+    in_process = time.perf_counter() - start
+    with ProcessPoolExecutor(max_workers=max(1, datasources.SYNC_PROCESSES)) as pool:
+        list(pool.map(encode_metadata_file, batch[:1], [TRACEABILITY], [800]))  # start the workers
+        start = time.perf_counter()
+        list(pool.map(encode_metadata_file, batch, [TRACEABILITY] * len(batch), [800] * len(batch)))
+        pooled = time.perf_counter() - start
+    print(
+        f"{len(batch)} metas of 10000 annotations: in-process {in_process * 1000:.1f} ms, "
+        f"{datasources.SYNC_PROCESSES} processes {pooled * 1000:.1f} ms (the event loop is free meanwhile)"
+    )
+
+
+if __name__ == "__main__":
+    main()
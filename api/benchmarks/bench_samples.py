@@ -0,0 +1,53 @@
+"""
+IQ decoding benchmark, helpers.samples.get_samples (with and without a reused output buffer) against the
+frombuffer/astype/samples[::2] + 1j * samples[1::2] decoding it replaced.
+
+    cd api && python -m benchmarks.bench_samples
+"""
+import timeit
+
+import numpy as np
+from helpers.samples import get_samples, parse_datatype
+
+NUM_SAMPLES = 1024 * 1024
+REPEAT = 7
+DATATYPES = ["ci8", "cu8", "ci16_le", "ci16_be", "cu16_le", "ci32_le", "cf16", "cf32_le", "cf32_be", "cf64_le", "ri16_le"]
+
+
+def legacy_get_samples(data_bytes, data_type) -> np.ndarray:
+    # the old approach, generalized over the same formats so every datatype has a baseline
+    dtype, offset, scale, is_complex = parse_datatype(data_type)
+    samples = np.frombuffer(data_bytes, dtype=dtype).astype(np.float32)
+    if offset:
+        samples -= offset
+    if scale != 1.0:
+        samples /= scale
+    if is_complex:
+        return samples[::2] + 1j * samples[1::2]
+    return samples + 0j
+
+
+def main():
+    rng = np.random.default_rng(0)
+    out = np.empty(NUM_SAMPLES * 2, dtype=np.complex64)
+    print(f"{NUM_SAMPLES} samples per call, best of {REPEAT}")
+    for data_type in DATATYPES:
+        dtype, _, _, is_complex = parse_datatype(data_type)
+        num_values = NUM_SAMPLES * (2 if is_complex else 1)
+        if dtype.kind in "iu":
+            info = np.iinfo(dtype)
+            values = rng.integers(info.min, info.max, num_values, endpoint=True).astype(dtype)
+        else:
+            values = rng.standard_normal(num_values).astype(dtype)
+        content = values.tobytes()
+        legacy = min(timeit.repeat(lambda: legacy_get_samples(content, data_type), number=1, repeat=REPEAT))
+        new = min(timeit.repeat(lambda: get_samples(content, data_type), number=1, repeat=REPEAT))
+        reused = min(timeit.repeat(lambda: get_samples(content, data_type, out=out), number=1, repeat=REPEAT))
+        print(
+            f"{data_type:8} legacy {legacy * 1000:7.2f} ms   get_samples {new * 1000:7.2f} ms ({legacy / new:5.1f}x)"
+            f"   with out= {reused * 1000:7.2f} ms ({legacy / reused:5.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
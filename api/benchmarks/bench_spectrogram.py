@@ -0,0 +1,61 @@
+"""
+Thumbnail rendering benchmark, the shared batched FFT + colormap LUT path in helpers.samples.get_spectrogram_image
+against the per-row FFT loop + matplotlib figure it replaced.
+
+    cd api && python -m benchmarks.bench_spectrogram
+"""
+import io
+import timeit
+
+import numpy as np
+from helpers.samples import get_samples, get_spectrogram_image
+from PIL import Image
+
+FFT_SIZE = 512
+REPEAT = 5
+
+
+def legacy_spectrogram_image(content: bytes, data_type: str, fftSize: int) -> bytes:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    samples = get_samples(content, data_type)
+    num_rows = int(np.floor(len(samples) / fftSize))
+    spectrogram = np.zeros((num_rows, fftSize))
+    for i in range(num_rows):
+        spectrogram[i, :] = 10 * np.log10(np.abs(np.fft.fftshift(np.fft.fft(samples[i * fftSize : (i + 1) * fftSize]))) ** 2)
+    fig = plt.figure(frameon=False)
+    ax = plt.Axes(fig, [0.0, 0.0, 1.0, 1.0])
+    ax.set_axis_off()
+    fig.add_axes(ax)
+    ax.imshow(spectrogram, cmap="viridis", aspect="auto", vmin=30 + np.min(np.min(spectrogram)))
+    img_buf = io.BytesIO()
+    plt.savefig(img_buf, bbox_inches="tight", pad_inches=0)
+    plt.close(fig)
+    img_buf.seek(0)
+    im = Image.open(img_buf)
+    img_byte_arr = io.BytesIO()
+    im.convert("RGB").save(img_byte_arr, format="jpeg")
+    return img_byte_arr.getvalue()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    # same read size as AzureBlobClient.get_new_thumbnail, fftSize * 1024 bytes
+    for data_type, dtype in (("cf32_le", np.float32), ("ci16_le", np.int16)):
+        num_values = FFT_SIZE * 1024 // np.dtype(dtype).itemsize
+        if dtype == np.int16:
+            content = rng.integers(-2000, 2000, num_values, dtype=np.int16).tobytes()
+        else:
+            content = rng.standard_normal(num_values).astype(np.float32).tobytes()
+        get_spectrogram_image(content, data_type, FFT_SIZE)  # warm up the colormap LUT
+        legacy_spectrogram_image(content, data_type, FFT_SIZE)  # and matplotlib's import/font cache
+        legacy = min(timeit.repeat(lambda: legacy_spectrogram_image(content, data_type, FFT_SIZE), number=1, repeat=REPEAT))
+        shared = min(timeit.repeat(lambda: get_spectrogram_image(content, data_type, FFT_SIZE), number=1, repeat=REPEAT))
+        print(f"{data_type:8} legacy {legacy * 1000:8.2f} ms   batched+LUT {shared * 1000:8.2f} ms   speedup {legacy / shared:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,34 +15,65 @@ class CancelOnDisconnectRoute(APIRoute):
             raise
 
 
+class DisconnectStats:
+    """
+    How much work client disconnects saved, per worker. Bytes are of recording reads: cancelled_bytes were already
+    being read when the client went away, skipped_bytes were planned but never started.
+    """
+
+    def __init__(self):
+        self.requests_cancelled = 0  # disconnected before the handler returned
+        self.streams_cancelled = 0  # disconnected part way through sending the response
+        self.cancelled_reads = 0
+        self.cancelled_bytes = 0
+        self.skipped_bytes = 0
+
+    def record_stream(self, cancelled_reads: int, cancelled_bytes: int, skipped_bytes: int):
+        self.streams_cancelled += 1
+        self.cancelled_reads += cancelled_reads
+        self.cancelled_bytes += cancelled_bytes
+        self.skipped_bytes += skipped_bytes
+
+    def clear(self):
+        self.__init__()
+
+    def stats(self) -> dict:
+        return dict(vars(self))
+
+
+disconnect_stats = DisconnectStats()
+
+
 # Decorator that will check if the client disconnects, and cancel the task if required. Only used in iq_router
 def cancel_on_disconnect(handler: Callable[[Any, str, str, int, str, Any, Any], Coroutine[Any, Any, Any]]):
     @wraps(handler)
     async def cancel_on_disconnect_decorator(request: Request, *args, **kwargs):
-        sentinel = object()
-        poller_task = asyncio.ensure_future(disconnect_poller(request, sentinel))
+        await request.body()  # the waiter reads what comes after the body, it's cached for the handler
+        waiter_task = asyncio.ensure_future(wait_for_disconnect(request))
         handler_task = asyncio.ensure_future(handler(request, *args, **kwargs))
-        done, pending = await asyncio.wait([poller_task, handler_task], return_when=asyncio.FIRST_COMPLETED)
+        done, pending = await asyncio.wait([waiter_task, handler_task], return_when=asyncio.FIRST_COMPLETED)
         for t in pending:
             t.cancel()
             try:
                 await t
             except asyncio.CancelledError:
-                print(f"{t} was cancelled")
+                pass
             except Exception as exc:
                 print(f"{t} raised {exc} when being cancelled")
-        if handler_task in done:
-            return await handler_task
-        raise HTTPException(499)
+        # The waiter has taken the disconnect message, a response streamed now would never hear about it
+        if waiter_task in done:
+            disconnect_stats.requests_cancelled += 1
+            raise HTTPException(status_code=499, detail="Client disconnected")
+        return await handler_task
 
     return cancel_on_disconnect_decorator
 
 
-async def disconnect_poller(request: Request, result: Any):
-    try:
-        while not await request.is_disconnected():
-            await asyncio.sleep(0.01)
-        print("Request disconnected")
-        return result
-    except asyncio.CancelledError:
-        print("Stopping polling loop")
+async def wait_for_disconnect(request: Request):
+    # Waits on the ASGI receive channel rather than polling is_disconnected(), an idle request costs nothing until
+    # the server hands us the http.disconnect message
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            print("Request disconnected")
+            return
@@ -1,12 +1,13 @@
-import json
+import asyncio
+import hashlib
 import logging
 import os
 import time
-from typing import Any, Callable, List, Optional, Tuple, Union, cast
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, cast
 
+import httpx
 import jwt
-import requests
-from cachetools import TTLCache, cached
+from cachetools import TTLCache
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -26,50 +27,175 @@ http_bearer = OptionalHTTPBearer()
 
 
 class JWKSHandler:
+    """
+    The identity provider's signing keys, parsed once per key id. The JWKS is fetched with an async client so a
+    refresh never blocks the event loop: the first request waits for it, after that it's refreshed in the background
+    once it's refresh_after seconds old while requests keep using the current keys (if the provider is down they're
+    kept until a refresh succeeds). A token signed with a key id we don't know waits for a refresh, as that's what
+    a key rotation looks like, at most once every unknown_kid_interval seconds.
+    """
+
     openid_config_uri = "https://login.microsoftonline.com/common/v2.0/.well-known/openid-configuration"
-    jwks_cache: TTLCache[str, Any] = TTLCache(maxsize=1, ttl=600)  # cache the JWKS for 10 minutes
+    refresh_after = 480  # the keys used to be cached for 10 minutes, refresh 2 minutes before that
+    unknown_kid_interval = 30
+    retries = 5
+    retry_delay = 5
+    timeout = 10
+
+    def __init__(self):
+        self.jwks: Optional[dict] = None
+        self.issuer: Optional[str] = None
+        self.fetched_at = 0.0
+        self.public_keys: Dict[str, RSAPublicKey] = {}
+        self._keys_from: Optional[dict] = None  # the jwks public_keys was parsed from
+        self._refresh_task: Optional[asyncio.Task] = None
 
-    @classmethod
-    def get_openid_config(cls):
+    async def get_openid_config(self, client: httpx.AsyncClient) -> dict:
         try:
-            return requests.get(cls.openid_config_uri).json()
+            response = await client.get(self.openid_config_uri)
+            response.raise_for_status()
+            return response.json()
         except Exception as e:
             logging.error(f"Failed to fetch OpenID configuration: {e}")
             raise
 
-    @classmethod
-    @cached(cache=jwks_cache)
-    def get_jwks(cls):
-        openid_config = cls.get_openid_config()
-        jwks_uri = openid_config["jwks_uri"]
-        issuer = openid_config["issuer"]
+    async def fetch_jwks(self) -> Tuple[dict, str]:
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            openid_config = await self.get_openid_config(client)
+            jwks_uri = openid_config["jwks_uri"]
+            issuer = openid_config["issuer"]
+
+            for attempt in range(self.retries):
+                try:
+                    response = await client.get(jwks_uri)
+                    response.raise_for_status()
+                    return response.json(), issuer
+                except Exception as e:
+                    logging.error(f"Failed to update JWKS: {e}")
+                    if attempt < self.retries - 1:
+                        await asyncio.sleep(self.retry_delay)
+        raise Exception(f"Failed to update JWKS after {self.retries} retries")
+
+    async def _refresh(self):
+        jwks, issuer = await self.fetch_jwks()
+        self.jwks, self.issuer, self.fetched_at = jwks, issuer, time.monotonic()
+
+    def start_refresh(self) -> asyncio.Task:
+        # Concurrent callers share the one fetch that's in flight
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+            self._refresh_task.add_done_callback(_log_refresh_failure)
+        return self._refresh_task
 
-        for _ in range(5):  # retry up to 5 times
+    async def refresh(self):
+        await asyncio.shield(self.start_refresh())
+
+    async def get_jwks(self) -> Tuple[dict, Optional[str]]:
+        if self.jwks is None:
+            await self.refresh()
+        elif time.monotonic() - self.fetched_at >= self.refresh_after:
+            self.start_refresh()
+        return cast(dict, self.jwks), self.issuer
+
+    async def get_public_key(self, kid: str) -> Optional[RSAPublicKey]:
+        jwks, _ = await self.get_jwks()
+        if kid not in self.parsed_keys(jwks) and time.monotonic() - self.fetched_at >= self.unknown_kid_interval:
             try:
-                return requests.get(jwks_uri).json(), issuer
-            except Exception as e:
-                logging.error(f"Failed to update JWKS: {e}")
-                time.sleep(5)
-        raise Exception("Failed to update JWKS after 5 retries")
+                await self.refresh()
+                jwks, _ = await self.get_jwks()
+            except Exception:
+                pass  # logged by the refresh, the token is rejected below
+        return self.parsed_keys(jwks).get(kid)
+
+    def parsed_keys(self, jwks: dict) -> Dict[str, RSAPublicKey]:
+        if jwks is not self._keys_from:
+            self.public_keys = parse_public_keys(jwks)
+            self._keys_from = jwks
+        return self.public_keys
+
+    def clear(self):
+        self.jwks = self.issuer = self._keys_from = self._refresh_task = None
+        self.fetched_at = 0.0
+        self.public_keys = {}
+
+
+def _log_refresh_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"JWKS refresh failed: {task.exception()}")
+
+
+def parse_public_keys(jwks: dict) -> Dict[str, RSAPublicKey]:
+    public_keys = {}
+    for key in jwks.get("keys", []):
+        try:
+            public_keys[key["kid"]] = cast(RSAPublicKey, algorithms.RSAAlgorithm.from_jwk(key))
+        except Exception as e:
+            logging.error(f"Skipping JWKS key {key.get('kid') if isinstance(key, dict) else key}: {e}")
+    return public_keys
 
 
 jwks_handler = JWKSHandler()
 
 
-def validate_issuer_and_get_public_key(token: str) -> Tuple[RSAPublicKey, Any]:
+class VerifiedTokenCache:
+    """
+    Payloads of tokens that passed validation, by a hash of the token, so requests carrying the same bearer token
+    (every tile of a spectrogram) skip the signature check. An entry is kept for at most ttl seconds and never past
+    the token's own expiry, invalid tokens aren't cached.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.hits = 0
+        self.misses = 0
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        payload = self._entries.get(self.key(token))
+        if payload is None or payload.get("exp", float("inf")) <= time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return payload
+
+    def put(self, token: str, payload: dict):
+        if self._entries.ttl > 0:
+            self._entries[self.key(token)] = payload
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "ttl": self._entries.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# One cache per worker process, IQENGINE_AUTH_TOKEN_CACHE_TTL=0 disables it
+AUTH_TOKEN_CACHE_TTL = float(os.getenv("IQENGINE_AUTH_TOKEN_CACHE_TTL", "60"))
+verified_tokens = VerifiedTokenCache(AUTH_TOKEN_CACHE_TTL)
+
+
+async def validate_issuer_and_get_public_key(token: str) -> Tuple[RSAPublicKey, Any]:
     # Decode the token without verification to access the header
     unverified_header = jwt.get_unverified_header(token)
     unverified_payload = jwt.decode(token, options={"verify_signature": False})
     algorithm = unverified_header.get("alg")
 
-    # Look up the public key in the JWKS using the `kid` from the JWT header
-    jwks, issuer = jwks_handler.get_jwks()
     IQENGINE_APP_AUTHORITY = os.getenv("IQENGINE_APP_AUTHORITY", "")
     issuer = IQENGINE_APP_AUTHORITY + "/v2.0"
 
-    key = [k for k in jwks["keys"] if k["kid"] == unverified_header["kid"]][0]
-    public_key = cast(RSAPublicKey, algorithms.RSAAlgorithm.from_jwk(json.dumps(key)))
-
     # Check issuer
     # issuer = unverified_payload["iss"]
     if unverified_payload["iss"] != issuer:
@@ -78,29 +204,38 @@ def validate_issuer_and_get_public_key(token: str) -> Tuple[RSAPublicKey, Any]:
             detail="Invalid issuer",
         )
 
+    # Look up the public key in the JWKS using the `kid` from the JWT header
+    public_key = await jwks_handler.get_public_key(unverified_header.get("kid"))
+    if public_key is None:
+        raise jwt.InvalidKeyError("Unknown signing key")
+
     return public_key, algorithm
 
 
-def validate_and_decode_jwt(token: str) -> dict:
+async def validate_and_decode_jwt(token: str) -> dict:
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
     try:
         CLIENT_ID = os.getenv("IQENGINE_APP_ID")
-        public_key, algorithm = validate_issuer_and_get_public_key(token)
+        public_key, algorithm = await validate_issuer_and_get_public_key(token)
         payload = jwt.decode(token, public_key, algorithms=[algorithm], audience=CLIENT_ID)  # Checks expiration, audience, and signature
-        return payload
     except jwt.PyJWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid JWT",
         )
+    verified_tokens.put(token, payload)
+    return payload
 
 
-def get_current_user(
+async def get_current_user(
     token: Optional[Depends] = Depends(http_bearer),
 ) -> Optional[dict]:
     if not token:
         return {}
     try:
-        current_user = validate_and_decode_jwt(token.credentials)
+        current_user = await validate_and_decode_jwt(token.credentials)
         logging.info(f"User {current_user['preferred_username']} access token validated")
         return current_user
     except jwt.PyJWTError:
@@ -0,0 +1,90 @@
+import os
+from typing import Optional
+
+from cachetools import TTLCache
+
+
+class BlobInfoCache:
+    """
+    Remembers blob sizes and whether blobs exist, so serving a recording doesn't start with a HEAD request to
+    storage every time. Sync fills it with the sizes it learns from listing the container, entries expire after
+    ttl seconds and are dropped when this worker uploads the blob or re-syncs the container.
+    Values are the size in bytes, or True for exists with unknown size. Blobs known to be missing are kept apart for
+    only missing_ttl seconds, minimaps and thumbnails get uploaded by other workers and recordings straight to storage,
+    so a miss shouldn't hide them for long.
+    """
+
+    def __init__(self, ttl: float, missing_ttl: float = 10, maxsize: int = 100_000):
+        self.hits = 0
+        self.misses = 0
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._missing: TTLCache = TTLCache(maxsize=maxsize, ttl=missing_ttl)
+
+    def __len__(self):
+        return len(self._entries) + len(self._missing)
+
+    def get_size(self, account: str, container: str, filepath: str) -> Optional[int]:
+        value = self._entries.get((account, container, filepath))
+        if value is None or value is True:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def exists(self, account: str, container: str, filepath: str) -> Optional[bool]:
+        # None means unknown
+        key = (account, container, filepath)
+        if key in self._entries:
+            self.hits += 1
+            return True
+        if key in self._missing:
+            self.hits += 1
+            return False
+        self.misses += 1
+        return None
+
+    def set_size(self, account: str, container: str, filepath: str, size: int):
+        key = (account, container, filepath)
+        self._missing.pop(key, None)
+        self._entries[key] = int(size)
+
+    def set_exists(self, account: str, container: str, filepath: str, exists: bool):
+        key = (account, container, filepath)
+        if not exists:
+            self._entries.pop(key, None)
+            self._missing[key] = False
+            return
+        self._missing.pop(key, None)
+        if key not in self._entries:  # keep the size if we already know it
+            self._entries[key] = True
+
+    def invalidate(self, account: str, container: str, filepath: Optional[str] = None):
+        # Drops one blob, or the whole container if filepath is None
+        for entries in (self._entries, self._missing):
+            if filepath is not None:
+                entries.pop((account, container, filepath), None)
+                continue
+            for key in [k for k in list(entries.keys()) if k[0] == account and k[1] == container]:
+                entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._missing.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "missing_entries": len(self._missing),
+            "ttl": self._entries.ttl,
+            "missing_ttl": self._missing.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# One cache per worker process, IQENGINE_BLOB_INFO_CACHE_TTL=0 disables it
+BLOB_INFO_CACHE_TTL = float(os.getenv("IQENGINE_BLOB_INFO_CACHE_TTL", "600"))
+BLOB_INFO_MISSING_TTL = min(BLOB_INFO_CACHE_TTL, float(os.getenv("IQENGINE_BLOB_INFO_MISSING_TTL", "10")))
+blob_info_cache = BlobInfoCache(BLOB_INFO_CACHE_TTL, BLOB_INFO_MISSING_TTL)
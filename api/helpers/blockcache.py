@@ -0,0 +1,69 @@
+import os
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class BlockCache:
+    """
+    Size-bounded LRU cache for byte ranges read from blob storage, shared by every request in the worker.
+    Keys are (account, container, filepath, offset, length) tuples so a hot recording that many users scroll
+    through is only fetched from storage once. Least recently used ranges are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        content = self._entries.get(key)
+        if content is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content
+
+    def put(self, key: Hashable, content: bytes):
+        size = len(content)
+        if not self.max_bytes or size > self.max_bytes:
+            return  # cache disabled, or would evict everything else and still not fit
+        if key in self._entries:
+            self.current_bytes -= len(self._entries.pop(key))
+        self._entries[key] = content
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, account: str, container: str, filepath: Optional[str] = None):
+        # Drops every cached range of one blob, or of the whole container if filepath is None
+        for key in [k for k in self._entries if k[0] == account and k[1] == container and (filepath is None or k[2] == filepath)]:
+            self.current_bytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# One cache per worker process, IQENGINE_BLOCK_CACHE_SIZE_MB=0 disables it
+block_cache = BlockCache(int(float(os.getenv("IQENGINE_BLOCK_CACHE_SIZE_MB", "256")) * 1024 * 1024))
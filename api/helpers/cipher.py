@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 
 from cryptography.fernet import Fernet
 from pydantic import SecretStr
@@ -12,21 +13,31 @@ def get_key():
     return key
 
 
+@lru_cache(maxsize=8)
+def _fernet(key) -> Fernet:
+    return Fernet(key)
+
+
+@lru_cache(maxsize=1024)
+def _decrypt(key, sas_token: str) -> str:
+    # Requests decrypt the same few datasource credentials over and over, keyed on the encryption key as well so
+    # changing DB_ENCRYPTION_KEY can't hand back a stale plain text
+    return _fernet(key).decrypt(sas_token).decode("utf-8")
+
+
 def decrypt(sas_token: str) -> SecretStr:
     if not sas_token:
         return None
     key = get_key()
     if not key:
         return None
-    cipher_suite = Fernet(key)
-    plain_text = cipher_suite.decrypt(sas_token)
-    return SecretStr(plain_text.decode("utf-8"))
+    return SecretStr(_decrypt(key, sas_token))
 
 
 def encrypt(sas_token: SecretStr):
     key = get_key()
     if not key:
         return None
-    cipher_suite = Fernet(key)
+    cipher_suite = _fernet(key)
     cipher_text = cipher_suite.encrypt(sas_token.get_secret_value().encode())
     return cipher_text.decode("utf-8")
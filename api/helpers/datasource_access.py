@@ -1,18 +1,90 @@
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
 from app.database import db
+from cachetools import TTLCache
 from fastapi import Depends
 from helpers.authorization import get_current_user
 
 
-async def check_access(account: str, container: str, user=Depends(get_current_user)) -> str | None:
-    if account == "local":
-        return "reader"
+class DatasourceCache:
+    """
+    Datasource documents (owners, readers, public flag and credentials) by (account, container), so check_access
+    and datasources.get don't each fetch the same document on every request. Entries expire after ttl seconds and
+    are dropped when this worker creates or updates the datasource, so a change made through another worker takes
+    up to ttl seconds to apply here. Missing datasources aren't cached, one created elsewhere shows up straight away.
+    The documents are shared, callers must not modify them.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.hits = 0
+        self.misses = 0
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, account: str, container: str) -> Optional[dict]:
+        datasource = self._entries.get((account, container))
+        if datasource is not None:
+            self.hits += 1
+            return datasource
+        self.misses += 1
+        datasource = await db().datasources.find_one({"account": account, "container": container})
+        if datasource is not None:
+            self._entries[(account, container)] = datasource
+        return datasource
+
+    async def get_many(self, keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[dict]]:
+        # Everything that isn't cached is fetched with one query
+        result = {}
+        missing = []
+        for key in set(keys):
+            result[key] = self._entries.get(key)
+            if result[key] is None:
+                missing.append(key)
+        self.hits += len(result) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            query = {"$or": [{"account": account, "container": container} for account, container in missing]}
+            async for datasource in db().datasources.find(query):
+                key = (datasource["account"], datasource["container"])
+                self._entries[key] = datasource
+                result[key] = datasource
+        return result
+
+    def invalidate(self, account: str, container: str):
+        self._entries.pop((account, container), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "ttl": self._entries.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# One cache per worker process, IQENGINE_DATASOURCE_CACHE_TTL=0 disables it
+DATASOURCE_CACHE_TTL = float(os.getenv("IQENGINE_DATASOURCE_CACHE_TTL", "30"))
+datasource_cache = DatasourceCache(DATASOURCE_CACHE_TTL)
+
+
+def user_groups(user) -> list:
+    # Anonymous users have no groups or username, a None left in here would match datasources without ACL fields
+    user = user or {}
     groups = user.get("groups", [])
     if isinstance(groups, str):
         groups = [groups]
-    groups.append(user.get("preferred_username"))
+    return [group for group in [*groups, user.get("preferred_username")] if group]
 
-    data_source = await db().datasources.find_one({"account": account, "container": container})
 
+def access_level(data_source: Optional[dict], groups: list) -> str | None:
     if data_source:
         if "owners" in data_source and any(group in data_source["owners"] for group in groups):
             return "owner"
@@ -21,3 +93,23 @@ async def check_access(account: str, container: str, user=Depends(get_current_us
         if "public" in data_source and data_source["public"]:
             return "public"
     return None
+
+
+async def check_access(account: str, container: str, user=Depends(get_current_user)) -> str | None:
+    if account == "local":
+        return "reader"
+    return access_level(await datasource_cache.get(account, container), user_groups(user))
+
+
+async def check_access_many(keys: Iterable[Tuple[str, str]], user) -> Dict[Tuple[str, str], str | None]:
+    # check_access for a batch of (account, container), e.g. to filter query results, with at most one query
+    keys = set(keys)
+    data_sources = await datasource_cache.get_many([key for key in keys if key[0] != "local"])
+    groups = user_groups(user)
+    return {key: "reader" if key[0] == "local" else access_level(data_sources[key], groups) for key in keys}
+
+
+def accessible_datasources_filter(user) -> dict:
+    # The datasources check_access gives this user any access to, as a query, so listing them is a single find
+    groups = user_groups(user)
+    return {"$or": [{"account": "local"}, {"public": True}, {"owners": {"$in": groups}}, {"readers": {"$in": groups}}]}
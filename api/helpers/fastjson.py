@@ -0,0 +1,64 @@
+import json
+import os
+
+# Pluggable JSON decoder/encoder for the hot paths (sync parses every .sigmf-meta it picks up, the listing endpoints
+# stream thousands of docs). orjson and msgspec are both several times faster than the stdlib on annotation-heavy
+# metas, neither is required, the first one installed is used unless IQENGINE_JSON_BACKEND picks one (orjson, msgspec
+# or json).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+def _select_backend(name: str):
+    if name in ("", "auto"):
+        name = "orjson" if orjson is not None else "msgspec" if msgspec is not None else "json"
+    if name == "orjson" and orjson is not None:
+        return "orjson", orjson.loads, orjson.JSONDecodeError
+    if name == "msgspec" and msgspec is not None:
+        return "msgspec", msgspec.json.Decoder().decode, msgspec.DecodeError
+    if name != "json":
+        print(f"[JSON] {name} is not installed, falling back to the json module")
+    return "json", _stdlib_loads, json.JSONDecodeError
+
+
+BACKEND, _loads, _decode_error = _select_backend(os.getenv("IQENGINE_JSON_BACKEND", "auto"))
+
+
+def loads(data: bytes | str):
+    """
+    Parses JSON with the fastest decoder available. The fast decoders are strict about things the json module lets
+    through (NaN/Infinity, invalid UTF-8 surrogates), so those documents are retried with the json module rather
+    than rejected.
+    """
+    if _loads is _stdlib_loads:
+        return json.loads(data)
+    try:
+        return _loads(data)
+    except _decode_error:
+        return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    # Anything the encoders don't know (ObjectId, Decimal128, ...) is written as its str()
+    if BACKEND == "orjson":
+        try:
+            return orjson.dumps(obj, default=str)
+        except TypeError:  # non-str dict keys or ints beyond 64 bits
+            pass
+    elif BACKEND == "msgspec":
+        try:
+            return msgspec.json.encode(obj, enc_hook=str)
+        except (TypeError, msgspec.EncodeError):
+            pass
+    return json.dumps(obj, default=str).encode()
@@ -0,0 +1,99 @@
+import base64
+import os
+from typing import AsyncIterator, Callable, List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from helpers import fastjson
+
+# Shared plumbing for the listing endpoints (metadata, datasources, plugins). Results are sorted on a unique key so
+# ?limit= can page through them, the response's X-Next-Cursor header is passed back as ?after= to get the next page
+# and is left out on the last one. Documents are serialized one at a time as they're sent, as a JSON array or, with
+# ?format=ndjson, one document per line, so a big container is never built up as one huge response in memory.
+LISTING_MAX_LIMIT = int(os.getenv("IQENGINE_LISTING_MAX_LIMIT", "10000"))
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_CHUNK_SIZE = 64 * 1024  # small docs are sent a batch at a time rather than a write each
+
+
+def encode_cursor(sort_values: list) -> str:
+    return base64.urlsafe_b64encode(fastjson.dumps(sort_values)).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        sort_values = fastjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(sort_values, list) or len(sort_values) != length or not all(isinstance(v, str) for v in sort_values):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return sort_values
+
+
+def after_filter(fields: List[str], after: Optional[str]) -> dict:
+    """
+    The condition for everything sorted after the cursor, on the same fields (all ascending) the listing sorts by,
+    e.g. for (account, container) it's account > a or (account == a and container > c).
+    """
+    if after is None:
+        return {}
+    sort_values = decode_cursor(after, len(fields))
+    conditions = []
+    for i, field in enumerate(fields):
+        condition = {fields[j]: sort_values[j] for j in range(i)}
+        condition[field] = {"$gt": sort_values[i]}
+        conditions.append(condition)
+    return conditions[0] if len(conditions) == 1 else {"$or": conditions}
+
+
+async def listing_response(
+    documents: AsyncIterator[dict],
+    sort_key: Callable[[dict], list],
+    limit: Optional[int] = None,
+    format: str = "json",
+) -> StreamingResponse:
+    """
+    Streams the documents back. With a limit the query should have asked for limit + 1 documents, the extra one only
+    says whether there's another page and isn't sent.
+    """
+    headers = {}
+    if limit is not None:
+        page = []
+        async for document in documents:
+            page.append(document)
+        if len(page) > limit:
+            page = page[:limit]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor(sort_key(page[-1]))
+        documents = iterate(page)
+
+    if format == "ndjson":
+        return StreamingResponse(stream_ndjson(documents), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    return StreamingResponse(stream_json_array(documents), media_type="application/json", headers=headers)
+
+
+async def iterate(items: list):
+    for item in items:
+        yield item
+
+
+async def stream_json_array(documents: AsyncIterator[dict]):
+    buffer = bytearray(b"[")
+    separator = b""
+    async for document in documents:
+        buffer += separator + fastjson.dumps(document)
+        separator = b","
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer + b"]")
+
+
+async def stream_ndjson(documents: AsyncIterator[dict]):
+    buffer = bytearray()
+    async for document in documents:
+        buffer += fastjson.dumps(document) + b"\n"
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
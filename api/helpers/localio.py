@@ -0,0 +1,88 @@
+import asyncio
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from helpers.mmapcache import mmap_cache
+
+# Local storage calls (open/read/stat and page faults on the memory maps) block, so they run on a dedicated bounded
+# pool instead of the event loop. It's separate from the default executor so a slow disk can't starve the other
+# to_thread users (thumbnails, tiles), and the queue depth says how far behind the disk is.
+LOCAL_IO_THREADS = int(os.getenv("IQENGINE_LOCAL_IO_THREADS", "16"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+_stats = {
+    "queued": 0,
+    "active": 0,
+    "max_queued": 0,
+    "completed": 0,
+    "cancelled": 0,
+    "wait_seconds": 0.0,
+    "max_wait_seconds": 0.0,
+}
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, LOCAL_IO_THREADS), thread_name_prefix="iqengine-local-io")
+    return _executor
+
+
+def _run(func: Callable, args: tuple, submitted: float, job: dict):
+    waited = time.perf_counter() - submitted
+    with _lock:
+        if job["cancelled"]:
+            return None  # the caller gave up while this was queued, it already took it off the queue count
+        job["started"] = True
+        _stats["queued"] -= 1
+        _stats["active"] += 1
+        _stats["wait_seconds"] += waited
+        _stats["max_wait_seconds"] = max(_stats["max_wait_seconds"], waited)
+    try:
+        return func(*args)
+    finally:
+        with _lock:
+            _stats["active"] -= 1
+            _stats["completed"] += 1
+
+
+async def run_local_io(func: Callable, *args):
+    job = {"started": False, "cancelled": False}
+    with _lock:
+        _stats["queued"] += 1
+        _stats["max_queued"] = max(_stats["max_queued"], _stats["queued"])
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), _run, func, args, time.perf_counter(), job)
+    finally:
+        # a request cancelled (e.g. the client disconnected) before its job started leaves it queued, or the executor
+        # drops it and _run never gets to count it, so it's taken off the queue here and skipped if it runs later
+        with _lock:
+            if not job["started"]:
+                job["cancelled"] = True
+                _stats["queued"] -= 1
+                _stats["cancelled"] += 1
+
+
+def read_local_file(path: str, offset: Optional[int] = None, length: Optional[int] = None, use_mmap: bool = False):
+    if use_mmap and offset is not None and length is not None:
+        view = mmap_cache.read(path, offset, length)
+        # touch every page now, so the disk reads happen on this thread and not when the event loop copies the view
+        view[:: mmap.PAGESIZE].tobytes()
+        return view
+    with open(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        return f.read(length)
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+    snapshot["threads"] = max(1, LOCAL_IO_THREADS)
+    snapshot["mean_wait_seconds"] = snapshot["wait_seconds"] / snapshot["completed"] if snapshot["completed"] else 0.0
+    return snapshot
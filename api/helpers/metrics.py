@@ -0,0 +1,217 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Per worker process metrics in the Prometheus text format, served at /api/metrics. Counters and histograms are
+# updated as things happen (requests, storage calls, mongo commands, sync phases), the caches and pools already count
+# their own hits and sizes so their stats() are read as gauges when the metrics are scraped. Updates take a lock,
+# mongo commands are reported from pymongo's threads.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SYNC_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.type = "counter"
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = "histogram"
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Labels, list] = {}  # labels -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        values = self._values.get(tuple(sorted(labels.items())))
+        return values[-1] if values else 0
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        samples = []
+        with self._lock:
+            for labels, values in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, values):
+                    cumulative += bucket_count
+                    samples.append((self.name + "_bucket", labels + (("le", format_value(bound)),), cumulative))
+                samples.append((self.name + "_bucket", labels + (("le", "+Inf"),), values[-1]))
+                samples.append((self.name + "_sum", labels, values[-2]))
+                samples.append((self.name + "_count", labels, values[-1]))
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Registry:
+    def __init__(self, prefix: str = "iqengine_"):
+        self.prefix = prefix
+        self._metrics: Dict[str, object] = {}
+        self._collectors: List[Tuple[str, Callable[[], dict], dict]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(self.prefix + name, Counter(self.prefix + name, help))
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(self.prefix + name, Histogram(self.prefix + name, help, buckets))
+
+    def register_stats(self, subsystem: str, stats: Callable[[], dict], **labels):
+        """
+        Exposes the numbers in a stats() dict as gauges when the metrics are scraped, e.g. block_cache.stats()
+        registered as ("cache", cache="block") gives iqengine_cache_hits{cache="block"}.
+        """
+        self._collectors.append((subsystem, stats, labels))
+
+    def collect_stats(self) -> Dict[str, List[Tuple[Labels, float]]]:
+        gauges: Dict[str, List[Tuple[Labels, float]]] = {}
+        for subsystem, stats, labels in self._collectors:
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"[METRICS] Failed to collect {subsystem} stats: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.setdefault(f"{self.prefix}{subsystem}_{key}", []).append((tuple(sorted(labels.items())), value))
+        return gauges
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in samples)
+        for name, samples in self.collect_stats().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        # Resets the counters and histograms, the stats collectors stay registered
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route template and status code")
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time from receiving a request to sending the last byte of the response"
+)
+http_response_bytes = registry.counter("http_response_bytes_total", "Response body bytes sent by route template")
+storage_requests = registry.counter("storage_requests_total", "Storage calls by backend (local, azure, s3), operation and outcome")
+storage_request_duration = registry.histogram("storage_request_duration_seconds", "Storage call latency by backend and operation")
+storage_bytes_read = registry.counter("storage_bytes_read_total", "Bytes read from storage by backend")
+mongo_commands = registry.counter("mongo_commands_total", "MongoDB commands by command name and outcome")
+mongo_command_duration = registry.histogram("mongo_command_duration_seconds", "MongoDB command latency by command name")
+sync_phase_duration = registry.histogram("sync_phase_duration_seconds", "Datasource sync time per phase", SYNC_BUCKETS)
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request until the last byte of the response is sent (so streamed iq-data is counted in full)
+    and counts the bytes sent. Requests are labelled with the route template, not the path, so there's one series
+    per endpoint rather than per recording, anything that isn't an API route (the static client) is "other".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = 500
+        sent_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, sent_bytes
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                sent_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", "other")
+            method = scope.get("method", "")
+            http_requests.inc(method=method, route=route, status=str(status_code))
+            http_request_duration.observe(time.perf_counter() - start, method=method, route=route)
+            http_response_bytes.inc(sent_bytes, method=method, route=route)
+
+
+def observe_storage_call(backend: str, operation: str, seconds: float, outcome: str, bytes_read: Optional[int] = None):
+    storage_requests.inc(backend=backend, operation=operation, outcome=outcome)
+    storage_request_duration.observe(seconds, backend=backend, operation=operation)
+    if bytes_read:
+        storage_bytes_read.inc(bytes_read, backend=backend)
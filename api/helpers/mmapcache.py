@@ -0,0 +1,85 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class MmapCache:
+    """
+    Bounded LRU of read-only memory maps of local recordings, so range reads are a slice of an already mapped file
+    instead of an open/seek/read/close per request, and the OS page cache does the caching. A map is keyed by path
+    and remapped if the file's inode, size or mtime changed since it was mapped.
+    """
+
+    def __init__(self, max_handles: int):
+        self.max_handles = max_handles
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._maps: OrderedDict[str, tuple] = OrderedDict()  # path -> (stat key, mmap)
+        self._lock = threading.Lock()  # reads happen on the local I/O threads
+
+    def __len__(self):
+        return len(self._maps)
+
+    def get(self, path: str) -> Optional[mmap.mmap]:
+        # Returns None for empty files, which can't be mapped
+        st = os.stat(path)
+        with self._lock:
+            return self._get(path, st)
+
+    def _get(self, path: str, st: os.stat_result) -> Optional[mmap.mmap]:
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        entry = self._maps.get(path)
+        if entry is not None:
+            if entry[0] == stat_key:
+                self._maps.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self._release(path)  # the file was replaced or modified
+        self.misses += 1
+        if st.st_size == 0:
+            return None
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # the map keeps its own handle
+        self._maps[path] = (stat_key, mapped)
+        while len(self._maps) > self.max_handles:
+            self._release(next(iter(self._maps)))
+            self.evictions += 1
+        return mapped
+
+    def read(self, path: str, offset: int, length: int) -> memoryview:
+        # Zero-copy slice of the file, short at the end of the file like f.read() would be
+        st = os.stat(path)
+        with self._lock:
+            mapped = self._get(path, st)
+            if mapped is None:
+                return memoryview(b"")
+            # taken under the lock, an exported map can't be closed by another thread evicting it
+            return memoryview(mapped)[offset : offset + length]
+
+    def _release(self, path: str):
+        _, mapped = self._maps.pop(path)
+        try:
+            mapped.close()
+        except BufferError:
+            pass  # slices are still being sent, the map is unmapped once the last one is garbage collected
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._maps):
+                self._release(path)
+
+    def stats(self) -> dict:
+        return {
+            "handles": len(self._maps),
+            "max_handles": self.max_handles,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# One set of maps per worker process, IQENGINE_LOCAL_MMAP_HANDLES=0 goes back to plain reads
+mmap_cache = MmapCache(int(os.getenv("IQENGINE_LOCAL_MMAP_HANDLES", "128")))
@@ -0,0 +1,130 @@
+import datetime
+import os
+import re
+from typing import Any, List, NamedTuple, Optional
+
+from cachetools import TTLCache
+
+
+class QueryCacheEntry(NamedTuple):
+    results: list
+    accounts: tuple  # the account, container and database_id filters, to work out which datasources it could match
+    containers: tuple
+    database_ids: tuple
+    match_mode: str
+
+
+def normalize(value: Any):
+    # Lists are filters where order and repeats don't matter, datetimes compare by value
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(set(normalize(v) for v in value), key=repr))
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def filter_values(value) -> tuple:
+    # account/container/database_id are lists from the query route, the AI search can hand back a single string
+    if not value:
+        return ()
+    return normalize([value] if isinstance(value, str) else value)
+
+
+def matches(pattern: str, value: str, match_mode: str) -> bool:
+    if match_mode == "exact":
+        return pattern == value
+    if match_mode == "prefix":
+        return value.startswith(pattern)
+    try:
+        return re.search(pattern, value, re.IGNORECASE) is not None
+    except re.error:
+        return True  # mongo's regex dialect isn't python's, assume it could match
+
+
+class QueryCache:
+    """
+    Results of query_metadata keyed by the normalized query parameters, so the same search from a dashboard (or the
+    AI search, which ends up as the same query) doesn't scan the collection each time. Results are cached before the
+    per-user access filtering, which happens on every request. Writing metadata to a datasource drops every entry
+    whose account/container filters could match that datasource, entries also expire after ttl seconds, which bounds
+    how long a write made through another worker takes to show up here. maxsize is in cached results, not queries.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1_000_000):
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped by every invalidation, see put()
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=lambda entry: max(1, len(entry.results)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(params: dict) -> tuple:
+        return tuple(sorted((name, normalize(value)) for name, value in params.items() if value is not None and value != []))
+
+    def get(self, params: dict) -> Optional[list]:
+        entry = self._entries.get(self.key(params))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.results
+
+    def put(self, params: dict, results: List, generation: int):
+        # generation is what it was when the query started, if anything was invalidated since then the results may
+        # predate that write and aren't cached
+        if generation != self.generation:
+            return
+        entry = QueryCacheEntry(
+            results,
+            filter_values(params.get("account")),
+            filter_values(params.get("container")),
+            filter_values(params.get("database_id")),
+            params.get("match_mode") or "regex",
+        )
+        try:
+            self._entries[self.key(params)] = entry
+        except ValueError:
+            pass  # bigger than the whole cache
+
+    @staticmethod
+    def could_match(entry: QueryCacheEntry, account: str, container: str) -> bool:
+        # Errs on the side of yes, the query only has to possibly include documents from account/container
+        if not (entry.accounts or entry.containers or entry.database_ids):
+            return True
+        if any(matches(pattern, account, entry.match_mode) for pattern in entry.accounts):
+            return True
+        if any(matches(pattern, container, entry.match_mode) for pattern in entry.containers):
+            return True
+        for database_id in entry.database_ids:
+            account_part, _, container_part = database_id.partition("/")
+            if matches(account_part, account, entry.match_mode) and matches(container_part, container, entry.match_mode):
+                return True
+        return False
+
+    def invalidate(self, account: str, container: str):
+        self.generation += 1
+        for key, entry in list(self._entries.items()):
+            if self.could_match(entry, account, container):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "results": self._entries.currsize,
+            "ttl": self._entries.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# One cache per worker process, IQENGINE_QUERY_CACHE_TTL=0 disables it
+QUERY_CACHE_TTL = float(os.getenv("IQENGINE_QUERY_CACHE_TTL", "60"))
+query_cache = QueryCache(QUERY_CACHE_TTL)
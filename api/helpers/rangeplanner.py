@@ -0,0 +1,60 @@
+from typing import List, NamedTuple, Tuple
+
+from helpers.conversions import find_smallest_and_largest_next_to_each_other
+
+# Per backend (max_gap_bytes, max_read_bytes). Reading through a gap and throwing the bytes away is cheaper than
+# issuing another request as long as the gap transfers faster than one round trip, which is a lot of bytes for
+# blob storage and very few for a local disk. Reads are capped so a long scroll still gets fetched in parallel.
+READ_PROFILES = {
+    "local": (64 * 1024, 4 * 1024 * 1024),
+    "azure": (1024 * 1024, 4 * 1024 * 1024),
+    "s3": (1024 * 1024, 8 * 1024 * 1024),
+}
+
+
+class RangeRead(NamedTuple):
+    offset: int
+    length: int
+    segments: List[Tuple[int, int]]  # (start, stop) slices of the returned buffer that were actually requested
+
+    def is_whole(self) -> bool:
+        return len(self.segments) == 1 and self.segments[0] == (0, self.length)
+
+    def split(self, content: bytes) -> List[bytes]:
+        # Slice a coalesced read back into the blocks that were asked for, a read of a single run is passed through as is
+        if self.is_whole():
+            return [content]
+        return [content[start:stop] for start, stop in self.segments]
+
+
+def plan_reads(block_indexes: List[int], block_size: int, bytes_per_iq_sample: int, blob_size: int, backend: str) -> List[RangeRead]:
+    """
+    Turns the requested block indexes into as few storage reads as makes sense for the backend. Contiguous runs of
+    blocks are clipped to the end of the blob, runs separated by a small gap are merged into one read, and runs
+    longer than the backend's max read size are split up. Each read lists the segments of its buffer that belong
+    in the response, in order.
+    """
+    max_gap, max_read = READ_PROFILES[backend]
+    block_bytes = block_size * bytes_per_iq_sample  # FYI, bytes_per_iq_sample includes the *2 for I+Q
+
+    byte_ranges = []
+    for first, last in find_smallest_and_largest_next_to_each_other(block_indexes):
+        start = first * block_bytes
+        stop = min((last + 1) * block_bytes, blob_size)
+        if start >= stop:
+            continue  # past the end of the blob
+        # split long runs so no single read exceeds max_read
+        for piece_start in range(start, stop, max_read):
+            byte_ranges.append((piece_start, min(piece_start + max_read, stop)))
+
+    reads: List[RangeRead] = []
+    for start, stop in byte_ranges:
+        if reads:
+            current = reads[-1]
+            current_stop = current.offset + current.length
+            if start - current_stop <= max_gap and stop - current.offset <= max_read:
+                current.segments.append((start - current.offset, stop - current.offset))
+                reads[-1] = current._replace(length=max(current.length, stop - current.offset))
+                continue
+        reads.append(RangeRead(offset=start, length=stop - start, segments=[(0, stop - start)]))
+    return reads
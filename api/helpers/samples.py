@@ -1,64 +1,89 @@
-import io
+from functools import lru_cache
+from typing import Optional
 
-import matplotlib.pyplot as plt
 import numpy as np
+from helpers.spectrogram import apply_colormap, compute_spectrogram, encode_image, to_uint8
 from PIL import Image
 
+# Thumbnails used to come out of a default matplotlib figure, keep the same size
+THUMBNAIL_WIDTH = 640
+THUMBNAIL_HEIGHT = 480
 
-def get_samples(data_bytes, data_type) -> np.ndarray:
-    if data_type == "ci8" or data_type == "ci8_le" or data_type == "i8":
-        samples = np.frombuffer(data_bytes, dtype=np.int8).astype(np.float32)
-        samples /= 127.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "cu8" or data_type == "cu8_le" or data_type == "u8":
-        samples = np.frombuffer(data_bytes, dtype=np.uint8).astype(np.float32)
-        samples -= 127.0
-        samples /= 127.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "ci16" or data_type == "ci16_le":
-        samples = np.frombuffer(data_bytes, dtype=np.int16).astype(np.float32)
-        samples /= 32767.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "cu16" or data_type == "cu16_le":
-        samples = np.frombuffer(data_bytes, dtype=np.uint16).astype(np.float32)
-        samples -= 32767.0
-        samples /= 32767.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "cu32" or data_type == "cu32_le":
-        samples = np.frombuffer(data_bytes, dtype=np.uint32).astype(np.float32)
-        samples -= 2147483647.0
-        samples /= 2147483647.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "ci32" or data_type == "ci32_le":
-        samples = np.frombuffer(data_bytes, dtype=np.uint32).astype(np.float32)
-        samples /= 2147483647.0
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "f16" or data_type == "f16_le":
-        samples = np.frombuffer(data_bytes, dtype=np.float16).astype(np.float32)
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "f32" or data_bytes == "f32_le":
-        samples = np.frombuffer(data_bytes, dtype=np.float32)
-        samples = samples[::2] + 1j * samples[1::2]
-    elif data_type == "cf32_le" or data_type == "cf32":
-        samples = np.frombuffer(data_bytes, dtype=np.complex64)
-    elif data_type == "cf64_le" or data_type == "cf64":
-        samples = np.frombuffer(data_bytes, dtype=np.complex128).astype(np.complex64)
-    else:
+
+# SigMF sample formats without the c/r prefix and endianness suffix -> (numpy type, offset, scale), values are
+# decoded as (value - offset) / scale so integer formats end up in +/-1
+SAMPLE_FORMATS = {
+    "i8": ("i1", 0.0, 127.0),
+    "u8": ("u1", 127.0, 127.0),
+    "i16": ("i2", 0.0, 32767.0),
+    "u16": ("u2", 32767.0, 32767.0),
+    "i32": ("i4", 0.0, 2147483647.0),
+    "u32": ("u4", 2147483647.0, 2147483647.0),
+    "f16": ("f2", 0.0, 1.0),
+    "f32": ("f4", 0.0, 1.0),
+    "f64": ("f8", 0.0, 1.0),
+}
+# Older names that were always treated as complex
+DATATYPE_ALIASES = {"i8": "ci8", "u8": "cu8", "f16": "cf16", "f16_le": "cf16_le", "f32": "cf32", "f32_le": "cf32_le"}
+
+
+@lru_cache(maxsize=None)
+def parse_datatype(data_type: str):
+    """
+    Returns (numpy dtype, offset, scale, is_complex) for a SigMF datatype such as cf32_le, ri16_be or cu8. No endianness
+    suffix means little endian.
+    """
+    name = DATATYPE_ALIASES.get(data_type, data_type)
+    base, _, endianness = name.partition("_")
+    if base[:1] not in ("c", "r") or base[1:] not in SAMPLE_FORMATS or endianness not in ("", "le", "be"):
         raise ValueError("Datatype " + data_type + " not implemented")
-    return samples
+    type_code, offset, scale = SAMPLE_FORMATS[base[1:]]
+    return np.dtype((">" if endianness == "be" else "<") + type_code), offset, scale, base[0] == "c"
 
 
-def get_bytes_per_iq_sample(data_type):
-    if "64" in data_type:
-        return 16
-    elif "32" in data_type:
-        return 8
-    elif "16" in data_type:
-        return 4
-    elif "8" in data_type:
-        return 2
+def get_samples(data_bytes, data_type, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Decodes raw samples into complex64. The conversion is written straight into the output through its interleaved
+    float32 view, without the full size temporaries of building it from separate I and Q arrays. Pass a complex64
+    array as out to reuse a buffer, the returned array is the decoded part of it. Real datatypes get a zero imaginary
+    part, a trailing half sample is dropped.
+    """
+    dtype, offset, scale, is_complex = parse_datatype(data_type)
+    values = np.frombuffer(data_bytes, dtype=dtype)
+    num_samples = len(values) // 2 if is_complex else len(values)
+    if is_complex:
+        values = values[: num_samples * 2]
+
+    if out is None:
+        if is_complex and dtype == np.dtype("<f4"):
+            return values.view(np.complex64)  # already in the output layout, no copy needed
+        out = np.empty(num_samples, dtype=np.complex64)
     else:
-        raise ValueError("within get_bytes_per_iq_sample, didn't see 64 or 32 or 16 or 8")
+        if out.dtype != np.complex64 or out.ndim != 1 or not out.flags.c_contiguous:
+            raise ValueError("out must be a contiguous 1D complex64 array")
+        if len(out) < num_samples:
+            raise ValueError(f"out holds {len(out)} samples but {num_samples} were given")
+        out = out[:num_samples]
+
+    interleaved = out.view(np.float32)
+    # real samples are converted contiguously first, the strided in-place math is much slower than one strided copy
+    target = interleaved if is_complex else np.empty(num_samples, dtype=np.float32)
+    if offset:
+        np.subtract(values, offset, out=target, dtype=np.float32)
+    else:
+        np.copyto(target, values, casting="same_kind")
+    if scale != 1.0:
+        target /= scale
+    if not is_complex:
+        interleaved[0::2] = target
+        interleaved[1::2] = 0.0
+    return out
+
+
+def get_bytes_per_iq_sample(data_type):
+    # bytes per sample, real datatypes only have one value per sample
+    dtype, _, _, is_complex = parse_datatype(data_type)
+    return dtype.itemsize * 2 if is_complex else dtype.itemsize
 
 
 def get_spectrogram_image(
@@ -67,22 +92,15 @@ def get_spectrogram_image(
     fftSize: int,
     cmap: str = "viridis",
     format: str = "jpeg",
+    width: int = THUMBNAIL_WIDTH,
+    height: int = THUMBNAIL_HEIGHT,
 ) -> bytes:
     # Generate a spectrogram image from bytes, used for generating thumbnail
-    samples = get_samples(content, data_type)
-    num_rows = int(np.floor(len(samples) / fftSize))
-    spectrogram = np.zeros((num_rows, fftSize))
-    for i in range(num_rows):
-        spectrogram[i, :] = 10 * np.log10(np.abs(np.fft.fftshift(np.fft.fft(samples[i * fftSize: (i + 1) * fftSize]))) ** 2)
-    fig = plt.figure(frameon=False)
-    ax = plt.Axes(fig, [0.0, 0.0, 1.0, 1.0])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    ax.imshow(spectrogram, cmap=cmap, aspect="auto", vmin=30 + np.min(np.min(spectrogram)))
-    img_buf = io.BytesIO()
-    plt.savefig(img_buf, bbox_inches="tight", pad_inches=0)
-    img_buf.seek(0)
-    im = Image.open(img_buf)
-    img_byte_arr = io.BytesIO()
-    im.convert("RGB").save(img_byte_arr, format=format)
-    return img_byte_arr.getvalue()
+    spectrogram = compute_spectrogram(get_samples(content, data_type), fftSize)
+    if spectrogram.size == 0:
+        raise ValueError("Not enough samples for a single FFT")
+    # same color scaling the matplotlib version used, bottom 30 dB above the noise floor clipped to the darkest color
+    db_min = 30 + spectrogram.min()
+    db_max = max(spectrogram.max(), db_min + 1e-3)
+    image = Image.fromarray(to_uint8(spectrogram, db_min, db_max), "L").resize((width, height), Image.BILINEAR)
+    return encode_image(apply_colormap(np.asarray(image), cmap), format)
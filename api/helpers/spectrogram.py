@@ -0,0 +1,68 @@
+import io
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+
+def compute_spectrogram(samples: np.ndarray, fft_size: int) -> np.ndarray:
+    """
+    Power spectrogram in dB with one row per FFT and DC in the middle. All rows are computed with a single batched
+    FFT over a reshaped view of the samples, any trailing partial FFT is dropped.
+    """
+    num_rows = len(samples) // fft_size
+    frames = samples[: num_rows * fft_size].reshape(num_rows, fft_size)
+    spectrum = np.fft.fftshift(np.fft.fft(frames, axis=1), axes=1)
+    power = spectrum.real**2
+    power += spectrum.imag**2
+    power += np.finfo(power.dtype).tiny  # avoid log10(0) on all-zero frames
+    return 10 * np.log10(power)
+
+
+def block_reduce(array: np.ndarray, block_shape: tuple, func=np.max) -> np.ndarray:
+    """
+    Same as skimage.measure.block_reduce for 2D arrays whose shape is a multiple of block_shape, e.g. max-decimate a
+    spectrogram by (2, 2) to get the next zoom level out. Edges that don't fill a whole block are dropped.
+    """
+    rows, cols = block_shape
+    out_rows, out_cols = array.shape[0] // rows, array.shape[1] // cols
+    blocks = array[: out_rows * rows, : out_cols * cols].reshape(out_rows, rows, out_cols, cols)
+    return func(blocks, axis=(1, 3))
+
+
+def to_uint8(spectrogram: np.ndarray, db_min: float, db_max: float) -> np.ndarray:
+    # Map [db_min, db_max] onto 0-255, anything outside is clipped
+    scaled = (spectrogram - db_min) * (255.0 / (db_max - db_min))
+    return np.clip(scaled, 0, 255, out=scaled).astype(np.uint8)
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    # uint8 2D array -> 8 bit greyscale PNG
+    img_byte_arr = io.BytesIO()
+    Image.fromarray(image, "L").save(img_byte_arr, format="PNG")
+    return img_byte_arr.getvalue()
+
+
+@lru_cache(maxsize=16)
+def get_colormap_lut(cmap: str = "viridis") -> np.ndarray:
+    """
+    The matplotlib colormap sampled once into a (256, 3) uint8 table, so coloring an image is a single fancy-index
+    instead of going through a matplotlib figure.
+    """
+    from matplotlib import colormaps  # only the colormap registry, pyplot isn't needed
+
+    return (colormaps[cmap](np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def apply_colormap(image: np.ndarray, cmap: str = "viridis") -> np.ndarray:
+    # uint8 2D array -> (rows, cols, 3) RGB array
+    return get_colormap_lut(cmap)[image]
+
+
+def encode_image(rgb: np.ndarray, format: str = "jpeg", quality: int = 85) -> bytes:
+    img_byte_arr = io.BytesIO()
+    if format.lower() in ("jpeg", "jpg"):
+        Image.fromarray(rgb, "RGB").save(img_byte_arr, format="jpeg", quality=quality)
+    else:
+        Image.fromarray(rgb, "RGB").save(img_byte_arr, format=format)
+    return img_byte_arr.getvalue()
@@ -7,6 +7,7 @@ class ApiType(Enum):
     IQDATA = 3
     METADATA = 4
     MINIMAP = 5
+    TILE = 6
 
 
 def get_content_type(apiType: ApiType):
@@ -21,6 +22,8 @@ def get_content_type(apiType: ApiType):
             return "application/octet-stream"  # was "application/json" but it didn't download the file when you clicked it, it opened it in browser, which was annoying considering we are only using this functionality within the downlink link in the recordingslist
         case ApiType.MINIMAP:
             return "application/octet-stream"
+        case ApiType.TILE:
+            return "image/png"
         case _:
             raise ValueError("Invalid ApiType value")
 
@@ -37,5 +40,12 @@ def get_file_name(filepath: str, apiType: ApiType) -> str:
             return filepath + ".sigmf-meta"
         case ApiType.MINIMAP:
             return filepath + ".minimap"
+        case ApiType.TILE:
+            return filepath + ".png"
         case _:
             raise ValueError("Invalid ApiType value")
+
+
+def get_tile_file_name(filepath: str, datatype: str, fft_size: int, zoom: int, x: int, y: int) -> str:
+    # Spectrogram tiles are stored next to the recording, one directory per datatype, fft size and zoom level
+    return get_file_name(f"{filepath}.tiles/{datatype}/{fft_size}/{zoom}/{x}/{y}", ApiType.TILE)
@@ -2,11 +2,15 @@ import logging
 import os
 from logging.config import dictConfig
 
+from app.client_pool import close_client_pool
 from app.config_router import router as config_router
 from app.converter_router import router as converter_router
 from app.database import db
+from app.datasources import close_process_pool
 from app.datasources_router import router as datasources_router
+from app.indexes import ensure_indexes
 from app.iq_router import router as iq_router
+from app.overviews import cancel_overview_tasks
 from app.plugins_router import router as plugins_router
 from app.status_router import router as status_router
 from app.users_router import router as users_router
@@ -15,6 +19,7 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from helpers.apidisconnect import CancelOnDisconnectRoute
 from helpers.import_env import import_all_from_env
+from helpers.metrics import MetricsMiddleware
 from pydantic import v1 as pydantic_v1
 from pymongo.errors import ServerSelectionTimeoutError
 from starlette.exceptions import HTTPException
@@ -82,6 +87,7 @@ logger = logging.getLogger("api")
 
 app = FastAPI(docs_url="/api_docs")
 app.router.route_class = CancelOnDisconnectRoute  # our Custom route (path operation) class to be used by this router
+app.add_middleware(MetricsMiddleware)  # request counts, latencies and bytes sent for /api/metrics
 
 app.include_router(iq_router)
 app.include_router(datasources_router)
@@ -94,7 +100,11 @@ app.include_router(converter_router)
 app.mount("/", SPAStaticFiles(directory="iqengine", html=True), name="iqengine")
 
 app.add_event_handler("startup", db)  # connect to mongodb or set up in-memory db
+app.add_event_handler("startup", ensure_indexes)  # create the metadata indexes if they don't exist
 app.add_event_handler("startup", import_all_from_env)  # clears db and adds plugins, feature flags, datasources, metadata
+app.add_event_handler("shutdown", cancel_overview_tasks)  # stop overview builds still running from a sync
+app.add_event_handler("shutdown", close_client_pool)  # close the pooled Azure/S3 storage clients
+app.add_event_handler("shutdown", close_process_pool)  # stop the processes sync parses big metas in
 
 
 @app.exception_handler(ServerSelectionTimeoutError)
@@ -13,8 +13,15 @@ async def env_setup():
     os.environ["IN_MEMORY_DB"] = "1"
     yield
     import app.database as db
+    from helpers.authorization import jwks_handler, verified_tokens
+    from helpers.datasource_access import datasource_cache
+    from helpers.querycache import query_cache
 
     db._db = None
+    datasource_cache.clear()  # the next test gets a fresh database
+    query_cache.clear()
+    verified_tokens.clear()
+    jwks_handler.clear()
 
 
 @pytest.mark.asyncio
@@ -1,4 +1,6 @@
 # vim: tabstop=4 shiftwidth=4 expandtab
+import copy
+import json
 import os
 from unittest import mock
 
@@ -275,3 +277,82 @@ async def test_api_update_file_version(client):
     assert response_object["global"]["traceability:origin"]["container"] == test_datasource["container"]
     assert response_object["global"]["traceability:origin"]["file_path"] == "file/path"
     assert response_object["annotations"][0]["core:sample_start"] == 10000
+
+
+@pytest.mark.asyncio
+async def test_api_meta_data_size_only_comes_from_sync(client):
+    from app.azure_client import AzureBlobClient
+    from app.database import db
+
+    client.post("/api/datasources", json=test_datasource).json()
+    url = f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}/sized/meta'
+    origin = {"global.traceability:origin.file_path": "sized"}
+    metadata = copy.deepcopy(valid_metadata)
+    metadata["global"]["traceability:data_size"] = 999
+    assert client.post(url, json=metadata).status_code == 201
+    assert "traceability:data_size" not in (await db().metadata.find_one(origin))["global"]
+
+    await db().metadata.update_one(origin, {"$set": {"global.traceability:data_size": 400}})  # what sync stores
+    assert client.put(url, json=metadata).status_code == 204
+    assert (await db().metadata.find_one(origin))["global"]["traceability:data_size"] == 400
+    azure_client = AzureBlobClient(test_datasource["account"], test_datasource["container"], None)
+    assert await azure_client.get_file_length_from_metadata("sized.sigmf-data") == 400
+
+    # a write SAS means the data file is about to be replaced
+    response = client.get(f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}/sized.sigmf-data/sas?write=true')
+    assert response.status_code != 403
+    assert await azure_client.get_file_length_from_metadata("sized.sigmf-data") is None
+
+
+@pytest.mark.asyncio
+async def test_api_get_all_meta_pages(client):
+    client.post("/api/datasources", json=test_datasource).json()
+    for name in ["record_c", "record_a", "record_b"]:
+        client.post(
+            f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}/{name}/meta',
+            json=valid_metadata,
+        )
+    url = f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}/meta'
+
+    response = client.get(url, params={"limit": 2, "fields": "summary"})
+    assert response.status_code == 200
+    page = response.json()
+    assert [m["global"]["traceability:origin"]["file_path"] for m in page] == ["record_a", "record_b"]
+    assert page[0]["annotation_count"] == len(valid_metadata["annotations"])
+    assert "annotations" not in page[0]
+
+    response = client.get(url, params={"limit": 2, "after": response.headers["X-Next-Cursor"], "fields": "global", "format": "ndjson"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "X-Next-Cursor" not in response.headers
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [m["global"]["traceability:origin"]["file_path"] for m in lines] == ["record_c"]
+    assert list(lines[0]) == ["global"]
+
+    assert client.get(url, params={"after": "not a cursor"}).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_api_get_datasources_pages(client):
+    for container in ["c2", "c1", "c3"]:
+        client.post("/api/datasources", json={**test_datasource, "container": container, "sasToken": "secret"})
+    response = client.get("/api/datasources", params={"limit": 2})
+    assert [d["container"] for d in response.json()] == ["c1", "c2"]
+    assert response.json()[0]["sasToken"] == "**********"
+    response = client.get("/api/datasources", params={"limit": 2, "after": response.headers["X-Next-Cursor"]})
+    assert [d["container"] for d in response.json()] == ["c3"]
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_accessible_datasources_filter_for_anonymous_user():
+    from app.database import db
+    from helpers.datasource_access import accessible_datasources_filter
+
+    await db().datasources.insert_many(
+        [
+            {"account": "a", "container": "no-acl", "public": False},  # created without owners or readers
+            {"account": "a", "container": "public", "public": True},
+        ]
+    )
+    listed = await db().datasources.find(accessible_datasources_filter({})).to_list(None)
+    assert [datasource["container"] for datasource in listed] == ["public"]
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+from helpers.apidisconnect import cancel_on_disconnect, disconnect_stats
+
+
+def make_request(disconnect: asyncio.Event) -> Request:
+    # A GET with no body, then http.disconnect once the event is set, like the server sends it
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    return Request({"type": "http", "method": "GET", "headers": []}, receive)
+
+
+@pytest.mark.asyncio
+async def test_cancel_on_disconnect_returns_handler_result():
+    @cancel_on_disconnect
+    async def handler(request):
+        return "response"
+
+    assert await handler(make_request(asyncio.Event())) == "response"
+
+
+@pytest.mark.asyncio
+async def test_cancel_on_disconnect_cancels_handler():
+    disconnect_stats.clear()
+    disconnect = asyncio.Event()
+    handler_cancelled = asyncio.Event()
+
+    @cancel_on_disconnect
+    async def handler(request):
+        disconnect.set()  # the client goes away while we're working on it
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            handler_cancelled.set()
+            raise
+
+    with pytest.raises(HTTPException) as e:
+        await asyncio.wait_for(handler(make_request(disconnect)), timeout=1)
+    assert e.value.status_code == 499
+    assert handler_cancelled.is_set()
+    assert disconnect_stats.requests_cancelled == 1
@@ -1,60 +1,109 @@
+import time
+
 import jwt
+import pytest
 from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
-from helpers.authorization import JWKSHandler, get_current_user, validate_and_decode_jwt
+from helpers.authorization import JWKSHandler, get_current_user, validate_and_decode_jwt, verified_tokens
+
+
+def mock_response(mocker, body):
+    return mocker.Mock(json=lambda: body, raise_for_status=lambda: None)
 
 
-def test_get_jwks(mocker):
-    # Mock the requests.get to return a response with the desired OpenID Config and JWKS
+@pytest.mark.asyncio
+async def test_get_jwks(mocker):
+    # Mock httpx to return a response with the desired OpenID Config and JWKS
     openid_config_response = {"jwks_uri": "mock_jwks_uri", "issuer": "mock_issuer"}
     jwks_response = {"keys": "mock_jwks"}
 
     mocker.patch(
-        "requests.get",
+        "httpx.AsyncClient.get",
         side_effect=[
-            mocker.Mock(json=lambda: openid_config_response),
-            mocker.Mock(json=lambda: jwks_response),
+            mock_response(mocker, openid_config_response),
+            mock_response(mocker, jwks_response),
         ],
     )
 
     jwks_handler = JWKSHandler()
-    jwks, issuer = jwks_handler.get_jwks()
+    jwks, issuer = await jwks_handler.get_jwks()
 
     assert jwks.get("keys") == "mock_jwks"
     assert issuer == "mock_issuer"
 
 
-def test_get_jwks_failure(mocker):
-    # Mock the requests.get to raise an exception
+@pytest.mark.asyncio
+async def test_get_jwks_failure(mocker):
+    # Mock httpx to raise an exception
     mocker.patch(
-        "requests.get",
+        "httpx.AsyncClient.get",
         side_effect=[
-            mocker.Mock(json=lambda: {"jwks_uri": "mock_jwks_uri", "issuer": "mock_issuer"}),
-            Exception("Mock exception"),
+            mock_response(mocker, {"jwks_uri": "mock_jwks_uri", "issuer": "mock_issuer"}),
+            *[Exception("Mock exception")] * 5,
         ],
     )
     jwks_handler = JWKSHandler()
+    jwks_handler.retry_delay = 0
+
+    with pytest.raises(Exception) as e:
+        await jwks_handler.get_jwks()
+    assert str(e.value) == "Failed to update JWKS after 5 retries"
 
-    try:
-        jwks_handler.get_jwks()
-    except Exception as e:
-        assert str(e) == "Failed to update JWKS after 5 retries"
 
+@pytest.mark.asyncio
+async def test_get_jwks_refreshes_in_background(mocker):
+    jwks_handler = JWKSHandler()
+    jwks_handler.jwks, jwks_handler.issuer = {"keys": "old"}, "mock_issuer"
+    jwks_handler.fetched_at = time.monotonic() - jwks_handler.refresh_after
+    fetch_jwks = mocker.patch.object(jwks_handler, "fetch_jwks", return_value=({"keys": "new"}, "mock_issuer"))
+
+    # The stale keys are returned straight away while they're refreshed
+    jwks, _ = await jwks_handler.get_jwks()
+    assert jwks == {"keys": "old"}
+    await jwks_handler._refresh_task
+
+    jwks, _ = await jwks_handler.get_jwks()
+    assert jwks == {"keys": "new"}
+    assert fetch_jwks.await_count == 1
 
-def test_validate_and_decode_jwt(mocker):
+
+@pytest.mark.asyncio
+async def test_get_public_key_unknown_kid(mocker):
+    jwks_handler = JWKSHandler()
+    mocker.patch("helpers.authorization.parse_public_keys", side_effect=lambda jwks: {key["kid"]: key["kid"] for key in jwks["keys"]})
+    fetch_jwks = mocker.patch.object(
+        jwks_handler,
+        "fetch_jwks",
+        side_effect=[({"keys": [{"kid": "a"}]}, "mock_issuer"), ({"keys": [{"kid": "a"}, {"kid": "b"}]}, "mock_issuer")],
+    )
+
+    assert await jwks_handler.get_public_key("a") == "a"
+    # A new key id right after a refresh is rejected without fetching again
+    assert await jwks_handler.get_public_key("b") is None
+    assert fetch_jwks.await_count == 1
+
+    # Later it's looked for in a fresh JWKS, as the keys may have been rotated
+    jwks_handler.fetched_at -= jwks_handler.unknown_kid_interval
+    assert await jwks_handler.get_public_key("b") == "b"
+    assert fetch_jwks.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_validate_and_decode_jwt(mocker):
     # Mock the validate_issuer_and_get_public_key function to return a public key and algorithm
     mocker.patch(
         "helpers.authorization.validate_issuer_and_get_public_key",
         return_value=("mock_public_key", "HS256"),
     )
     mocker.patch("jwt.decode", return_value={"payload": "mock_payload"})
-    result = validate_and_decode_jwt("mock_token")
+    result = await validate_and_decode_jwt("mock_token")
 
     # Assert that the function returned the expected payload
     assert result == {"payload": "mock_payload"}
 
 
-def test_validate_and_decode_jwt_failure(mocker):
+@pytest.mark.asyncio
+async def test_validate_and_decode_jwt_failure(mocker):
     # Mock the validate_issuer_and_get_public_key function to return a public key and algorithm
     mocker.patch(
         "helpers.authorization.validate_issuer_and_get_public_key",
@@ -63,12 +112,13 @@ def test_validate_and_decode_jwt_failure(mocker):
     mocker.patch("jwt.decode", side_effect=jwt.PyJWTError)
 
     try:
-        validate_and_decode_jwt("mock_token")
+        await validate_and_decode_jwt("mock_token")
     except HTTPException as e:
         assert e.detail == "Invalid JWT"
 
 
-def test_get_current_user(mocker):
+@pytest.mark.asyncio
+async def test_get_current_user(mocker):
     # Mock the validate_and_decode_jwt function to return a payload
     mocker.patch(
         "helpers.authorization.validate_and_decode_jwt",
@@ -77,5 +127,26 @@ def test_get_current_user(mocker):
     mock_token = HTTPAuthorizationCredentials(scheme="Bearer", credentials="mock_token")
 
     # Call the function and assert that it returns the expected payload
-    user = get_current_user(mock_token)
+    user = await get_current_user(mock_token)
     assert user == {"preferred_username": "test_user", "roles": ["role1"]}
+
+
+@pytest.mark.asyncio
+async def test_validate_and_decode_jwt_cached(mocker):
+    validate = mocker.patch(
+        "helpers.authorization.validate_issuer_and_get_public_key",
+        return_value=("mock_public_key", "RS256"),
+    )
+    mocker.patch("jwt.decode", return_value={"preferred_username": "test_user", "exp": time.time() + 3600})
+
+    first = await validate_and_decode_jwt("mock_token")
+    second = await validate_and_decode_jwt("mock_token")
+    assert first is second
+    assert validate.await_count == 1
+    assert verified_tokens.stats()["hits"] >= 1
+
+    # Not past the token's own expiry
+    mocker.patch("jwt.decode", return_value={"preferred_username": "test_user", "exp": time.time() - 1})
+    await validate_and_decode_jwt("expired_token")
+    await validate_and_decode_jwt("expired_token")
+    assert validate.await_count == 3
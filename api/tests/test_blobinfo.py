@@ -0,0 +1,53 @@
+import pytest
+from app.azure_client import AzureBlobClient
+from helpers.blobinfo import BlobInfoCache, blob_info_cache
+
+
+def test_blob_info_cache():
+    cache = BlobInfoCache(ttl=60)
+    assert cache.get_size("a", "c", "x.sigmf-data") is None
+    assert cache.exists("a", "c", "x.sigmf-data") is None
+    cache.set_size("a", "c", "x.sigmf-data", 0)
+    cache.set_exists("a", "c", "x.sigmf-data", True)  # doesn't forget the size
+    assert cache.get_size("a", "c", "x.sigmf-data") == 0
+    assert cache.exists("a", "c", "x.sigmf-data") is True
+    cache.set_exists("a", "c", "x.minimap", False)
+    assert cache.exists("a", "c", "x.minimap") is False
+    assert cache.get_size("a", "c", "x.minimap") is None
+    cache.set_size("a", "other", "x.sigmf-data", 10)
+    cache.invalidate("a", "c")
+    assert len(cache) == 1
+    assert cache.get_size("a", "other", "x.sigmf-data") == 10
+    cache.set_size("a", "c", "x.minimap", 5)  # uploaded since
+    assert cache.exists("a", "c", "x.minimap") is True
+
+
+def test_blob_info_cache_forgets_missing_blobs_sooner():
+    cache = BlobInfoCache(ttl=60, missing_ttl=0)
+    cache.set_exists("a", "c", "x.minimap", False)
+    assert cache.exists("a", "c", "x.minimap") is None
+    cache.set_exists("a", "c", "x.sigmf-data", True)
+    assert cache.exists("a", "c", "x.sigmf-data") is True
+
+
+@pytest.mark.asyncio
+async def test_local_client_caches_size_and_existence(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    blob_info_cache.clear()
+    with open(tmp_path / "rec.sigmf-data", "wb") as f:
+        f.write(b"0" * 100)
+    client = AzureBlobClient("local", "local", None)
+    assert await client.get_file_length("rec.sigmf-data") == 100
+    assert await client.blob_exist("rec.sigmf-data") is True
+    assert await client.blob_exist("rec.minimap") is False
+
+    with open(tmp_path / "rec.sigmf-data", "ab") as f:
+        f.write(b"0" * 100)
+    open(tmp_path / "rec.minimap", "wb").close()
+    assert await client.get_file_length("rec.sigmf-data") == 100  # served from the cache
+    assert await client.blob_exist("rec.minimap") is False
+
+    blob_info_cache.invalidate("local", "local")  # what a re-sync does
+    assert await client.get_file_length("rec.sigmf-data") == 200
+    assert await client.blob_exist("rec.minimap") is True
+    blob_info_cache.clear()
@@ -0,0 +1,62 @@
+from unittest import mock
+from unittest.mock import AsyncMock
+
+import pytest
+from app.azure_client import AzureBlobClient
+from helpers.blockcache import BlockCache, block_cache
+
+
+def test_block_cache_hit_and_miss():
+    cache = BlockCache(max_bytes=100)
+    assert cache.get(("account", "container", "file", 0, 10)) is None
+    cache.put(("account", "container", "file", 0, 10), b"0123456789")
+    assert cache.get(("account", "container", "file", 0, 10)) == b"0123456789"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["bytes"] == 10
+
+
+def test_block_cache_evicts_least_recently_used():
+    cache = BlockCache(max_bytes=20)
+    cache.put("a", b"x" * 10)
+    cache.put("b", b"x" * 10)
+    cache.get("a")  # a is now more recent than b
+    cache.put("c", b"x" * 10)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.current_bytes == 20
+    assert cache.evictions == 1
+
+
+def test_block_cache_skips_oversized_entries():
+    cache = BlockCache(max_bytes=5)
+    cache.put("a", b"x" * 10)
+    assert len(cache) == 0
+    assert cache.current_bytes == 0
+
+
+def test_block_cache_invalidate():
+    cache = BlockCache(max_bytes=100)
+    cache.put(("account", "container", "file1", 0, 1), b"1")
+    cache.put(("account", "container", "file2", 0, 1), b"2")
+    cache.put(("account", "other", "file1", 0, 1), b"3")
+    cache.invalidate("account", "container", "file1")
+    assert len(cache) == 2
+    cache.invalidate("account", "container")
+    assert len(cache) == 1
+    assert cache.current_bytes == 1
+
+
+@pytest.mark.asyncio
+async def test_get_blob_content_range_reads_are_cached():
+    block_cache.clear()
+    azure_client = AzureBlobClient(account="account", container="container", awsAccessKeyId=None)
+    with mock.patch.object(AzureBlobClient, "_get_blob_content", new=AsyncMock(return_value=b"data")) as mock_read:
+        assert await azure_client.get_blob_content("file.sigmf-data", offset=0, length=4) == b"data"
+        assert await azure_client.get_blob_content("file.sigmf-data", offset=0, length=4) == b"data"
+        mock_read.assert_called_once()
+        await azure_client.get_blob_content("file.sigmf-meta")
+        await azure_client.get_blob_content("file.sigmf-meta")
+        assert mock_read.call_count == 3  # whole-blob reads are not cached
+    block_cache.clear()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+from app import azure_client as azure_client_module
+from app import client_pool
+from app.azure_client import AzureBlobClient
+from app.models import DataSource
+from azure.storage.blob.aio import ContainerClient
+from helpers import cipher
+from pydantic import SecretStr
+
+
+@pytest.mark.asyncio
+async def test_container_clients_are_reused_per_credential():
+    first = client_pool.get_container_client("account", "container", sas_token="sv=1&sig=abc")
+    second = client_pool.get_container_client("account", "container", sas_token="sv=1&sig=abc")
+    other = client_pool.get_container_client("account", "container", sas_token="sv=1&sig=def")
+    assert first is second
+    assert first is not other
+    await client_pool.close_client_pool()
+    assert client_pool.stats()["azure_container_clients"] == 0
+
+
+@pytest.mark.asyncio
+async def test_blob_clients_share_the_pooled_container_client():
+    azure_client = AzureBlobClient(account="account", container="container", awsAccessKeyId=None)
+    azure_client.set_sas_token(SecretStr("sv=1&sig=abc"))
+    blob_client = azure_client.get_blob_client("file.sigmf-data")
+    assert blob_client.blob_name == "file.sigmf-data"
+    assert azure_client.get_blob_client("file.sigmf-data") is blob_client
+    assert client_pool.stats()["azure_container_clients"] == 1
+    await azure_client.close_blob_clients()
+    await client_pool.close_client_pool()
+
+
+def test_clients_left_on_a_previous_loop_are_closed_on_it():
+    old_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=old_loop.run_forever)
+    thread.start()
+
+    async def get_client():
+        return client_pool.get_container_client("account", "container", sas_token="sv=1&sig=abc")
+
+    try:
+        with mock.patch.object(ContainerClient, "close", new_callable=mock.AsyncMock) as close:
+            old_client = asyncio.run_coroutine_threadsafe(get_client(), old_loop).result()
+            new_client = asyncio.run(get_client())  # a new loop, the old client can't be used on it
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), old_loop).result()  # let the close run
+            assert new_client is not old_client
+            close.assert_awaited_once()
+    finally:
+        old_loop.call_soon_threadsafe(old_loop.stop)
+        thread.join()
+        old_loop.close()
+        client_pool._take_clients()
+
+
+@pytest.mark.asyncio
+async def test_s3_clients_are_reused():
+    first = await client_pool.get_s3_client("us-east-1", "key_id", "secret")
+    second = await client_pool.get_s3_client("us-east-1", "key_id", "secret")
+    assert first is second
+    assert client_pool.stats()["s3_clients"] == 1
+    await client_pool.close_client_pool()
+    assert client_pool.stats()["s3_clients"] == 0
+
+
+@pytest.mark.asyncio
+async def test_s3_endpoint_url(monkeypatch):
+    monkeypatch.setenv("IQENGINE_S3_ENDPOINT_URL", "http://127.0.0.1:9000")
+    s3_client = await client_pool.get_s3_client("us-east-1", "key_id", "secret")
+    assert s3_client.meta.endpoint_url == "http://127.0.0.1:9000"
+    await client_pool.close_client_pool()
+
+
+def test_from_datasource_decrypts_once():
+    datasource = DataSource(
+        type="api",
+        name="name",
+        account="account",
+        container="container",
+        sasToken=SecretStr(cipher.encrypt(SecretStr("sv=1&sig=abc"))),
+        accountKey=SecretStr(cipher.encrypt(SecretStr("a2V5"))),
+    )
+    azure_client = AzureBlobClient.from_datasource(datasource)
+    assert azure_client.sas_token.get_secret_value() == "sv=1&sig=abc"
+    assert azure_client.account_key.get_secret_value() == "a2V5"
+    with mock.patch.object(cipher.Fernet, "decrypt", side_effect=AssertionError("not cached")):
+        assert AzureBlobClient.from_datasource(datasource).sas_token.get_secret_value() == "sv=1&sig=abc"
+
+
+def test_sas_tokens_are_reused_until_near_expiry():
+    azure_client = AzureBlobClient(account="account", container="container", awsAccessKeyId=None)
+    with mock.patch.object(azure_client_module, "generate_blob_sas", side_effect=["token1", "token2", "token3"]) as generate:
+        assert azure_client.generate_sas_token("file.sigmf-data", "a2V5") == "token1"
+        assert azure_client.generate_sas_token("file.sigmf-data", "a2V5") == "token1"
+        assert azure_client.generate_sas_token("file.sigmf-data", "a2V5", include_write=True) == "token2"
+        azure_client_module._sas_tokens.clear()
+        assert azure_client.generate_sas_token("file.sigmf-data", "a2V5") == "token3"
+        assert generate.call_count == 3
@@ -0,0 +1,52 @@
+import pytest
+from app.database import db
+from helpers.datasource_access import accessible_datasources_filter, check_access, check_access_many, datasource_cache
+
+reader = {"preferred_username": "reader@example.com", "groups": ["team"]}
+
+
+@pytest.mark.asyncio
+async def test_check_access_is_cached_until_invalidated():
+    await db().datasources.insert_one({"account": "a", "container": "c", "owners": [], "readers": ["team"], "public": False})
+    assert await check_access("a", "c", reader) == "reader"
+
+    await db().datasources.update_one({"account": "a", "container": "c"}, {"$set": {"readers": []}})
+    assert await check_access("a", "c", reader) == "reader"  # still cached
+    datasource_cache.invalidate("a", "c")
+    assert await check_access("a", "c", reader) is None
+    assert datasource_cache.stats()["hits"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_check_access_many():
+    await db().datasources.insert_many(
+        [
+            {"account": "a", "container": "owned", "owners": ["reader@example.com"], "readers": [], "public": False},
+            {"account": "a", "container": "public", "owners": [], "readers": [], "public": True},
+            {"account": "a", "container": "private", "owners": [], "readers": [], "public": False},
+        ]
+    )
+    keys = [("a", "owned"), ("a", "public"), ("a", "private"), ("a", "missing"), ("local", "local"), ("a", "owned")]
+    assert await check_access_many(keys, reader) == {
+        ("a", "owned"): "owner",
+        ("a", "public"): "public",
+        ("a", "private"): None,
+        ("a", "missing"): None,
+        ("local", "local"): "reader",
+    }
+    assert len(datasource_cache) == 3  # missing datasources aren't cached
+
+
+@pytest.mark.asyncio
+async def test_anonymous_user_only_sees_public_datasources():
+    await db().datasources.insert_many(
+        [
+            {"account": "a", "container": "no-acl", "public": False},  # created without owners or readers
+            {"account": "a", "container": "public", "public": True},
+        ]
+    )
+    anonymous = {}
+    assert await check_access("a", "no-acl", anonymous) is None
+    assert await check_access("a", "public", anonymous) == "public"
+    listed = await db().datasources.find(accessible_datasources_filter(anonymous)).to_list(None)
+    assert [datasource["container"] for datasource in listed] == ["public"]
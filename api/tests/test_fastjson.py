@@ -0,0 +1,26 @@
+import json
+
+import pytest
+from helpers import fastjson
+
+
+def test_loads_matches_json_module():
+    document = {"global": {"core:datatype": "cf32_le", "core:sample_rate": 1e6}, "annotations": [{"core:comment": "é ✓"}] * 3}
+    encoded = json.dumps(document)
+    assert fastjson.loads(encoded) == document
+    assert fastjson.loads(encoded.encode()) == document
+
+
+def test_loads_falls_back_for_what_fast_decoders_reject():
+    # NaN isn't valid JSON but the json module has always accepted it, some recorders write it
+    assert str(fastjson.loads(b'{"core:frequency": NaN}')["core:frequency"]) == "nan"
+    with pytest.raises(ValueError):
+        fastjson.loads(b"not json")
+
+
+def test_dumps_round_trips():
+    document = {"global": {"core:datatype": "cf32_le"}, "annotations": [{"core:sample_start": 2**40}], "_id": object()}
+    decoded = json.loads(fastjson.dumps(document))
+    assert decoded["annotations"] == document["annotations"]
+    assert isinstance(decoded["_id"], str)
+    assert json.loads(fastjson.dumps({1: 2**70})) == {"1": 2**70}  # falls back to the json module
@@ -0,0 +1,42 @@
+from unittest import mock
+
+import pytest
+from app.database import db
+from app.indexes import METADATA_INDEXES, ensure_indexes
+
+
+def origin(file_path):
+    return {"global": {"traceability:origin": {"account": "account", "container": "container", "file_path": file_path}}}
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes():
+    assert await ensure_indexes() == {spec.name: "ok" for spec in METADATA_INDEXES}
+    assert await ensure_indexes() == {spec.name: "ok" for spec in METADATA_INDEXES}  # already there
+    indexes = await db().metadata.index_information()
+    assert indexes["origin"]["unique"]
+    assert indexes["captures_geolocation"]["key"] == [("captures.core:geolocation", "2dsphere")]
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_with_duplicate_recordings():
+    await db().metadata.insert_many([origin("rec"), origin("rec")])
+    results = await ensure_indexes()
+    assert results["origin"] == "non-unique"
+    indexes = await db().metadata.index_information()
+    assert "origin" in indexes and not indexes["origin"].get("unique")
+
+
+@mock.patch("app.status_router.get_index_usage", return_value={})
+def test_indexes_status_requires_admin(mock_get_index_usage, client):
+    # the client fixture signs everyone in as an admin, swap the user the role check sees
+    route = next(route for route in client.app.routes if getattr(route, "path", None) == "/api/status/indexes")
+    role_check = next(dependency for dependency in route.dependant.dependencies if dependency.call.__name__ == "_check_roles")
+    current_user = role_check.dependencies[0].call
+    assert client.get("/api/status/indexes").status_code == 200
+
+    client.app.dependency_overrides[current_user] = lambda: {"roles": ["IQEngine-User"], "preferred_username": "user"}
+    assert client.get("/api/status/indexes").status_code == 403
+    client.app.dependency_overrides[current_user] = lambda: None
+    assert client.get("/api/status/indexes").status_code == 401
+    client.app.dependency_overrides.clear()
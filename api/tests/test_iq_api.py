@@ -1,3 +1,4 @@
+import asyncio
 from unittest import mock
 from unittest.mock import AsyncMock
 
@@ -13,7 +14,7 @@ test_blob_properties.size = 100
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_invalid_format(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with invalid format. Returns 400."""
@@ -36,7 +37,7 @@ async def mock_get_test_datasource():
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_ci16_le(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with iq16_le. Returns populated float of float array."""
@@ -56,7 +57,7 @@ async def test_get_iq_data_with_ci16_le(mock_decrypt, mock_get_file_length, clie
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_ci16(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with ci16. Returns populated float of float array."""
@@ -76,7 +77,7 @@ async def test_get_iq_data_with_ci16(mock_decrypt, mock_get_file_length, client)
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_ci16_be(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with ci16_be. Returns populated float of float array."""
@@ -96,7 +97,7 @@ async def test_get_iq_data_with_ci16_be(mock_decrypt, mock_get_file_length, clie
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_cf32_le(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with cf32_le. Returns populated float of float array."""
@@ -116,7 +117,7 @@ async def test_get_iq_data_with_cf32_le(mock_decrypt, mock_get_file_length, clie
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_cf32(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with cf32. Returns populated float of float array."""
@@ -136,7 +137,7 @@ async def test_get_iq_data_with_cf32(mock_decrypt, mock_get_file_length, client)
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_cf32_be(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with cf32_be. Returns populated float of float array."""
@@ -156,7 +157,7 @@ async def test_get_iq_data_with_cf32_be(mock_decrypt, mock_get_file_length, clie
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_ci8(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with ci8. Returns populated float of float array."""
@@ -177,7 +178,7 @@ async def test_get_iq_data_with_ci8(mock_decrypt, mock_get_file_length, client):
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_i8(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with i8. Returns populated float of float array."""
@@ -197,7 +198,7 @@ async def test_get_iq_data_with_i8(mock_decrypt, mock_get_file_length, client):
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=100)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_multiple_arr_elements_returns_data(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with i8. Returns populated float of float array."""
@@ -206,18 +207,23 @@ async def test_get_iq_data_with_multiple_arr_elements_returns_data(mock_decrypt,
     client.app.dependency_overrides[datasources.get] = mock_get_test_datasource
     arr = numpy.array([1, 2, 3, 4, 5, 6, 7, 8], dtype=numpy.int8).tobytes()
     input_arr_str = "1,3"
-    with mock.patch("app.azure_client.AzureBlobClient.get_blob_content", return_value=arr):
+
+    async def get_blob_content(filepath, offset=None, length=None):
+        return arr[offset : offset + length]
+
+    # blocks 1 and 3 are close enough to be fetched with one read, which then gets sliced back into the two blocks
+    with mock.patch("app.azure_client.AzureBlobClient.get_blob_content", side_effect=get_blob_content):
         response = client.get(
             f"/api/datasources/"
             f'{test_datasource["account"]}/{test_datasource["container"]}'
             f"/file_path/iq-data?format=i8&block_size=1&block_indexes_str={input_arr_str}&filepath=test"
         )
         assert response.status_code == 200
-        assert response.content == arr + arr
+        assert response.content == arr[2:4] + arr[6:8]
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=2)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_offset_larger_than_blob_size(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with offset larger than blob size. Returns partially populated float of float array."""
@@ -237,7 +243,7 @@ async def test_get_iq_data_with_offset_larger_than_blob_size(mock_decrypt, mock_
 
 
 @mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=3)
-@mock.patch("app.iq_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_get_iq_data_with_offset_plus_count_larger_than_blob_size(mock_decrypt, mock_get_file_length, client):
     """Get IQ data with offset plus count larger than blob size. Returns empty float of float array."""
@@ -255,3 +261,76 @@ async def test_get_iq_data_with_offset_plus_count_larger_than_blob_size(mock_dec
         )
         assert response.status_code == 200
         assert response.content == arr
+
+
+@pytest.mark.asyncio
+async def test_calculate_iq_data_streams_before_later_reads_finish():
+    """The first block is sent while a later read is still in flight, closing the stream cancels that read."""
+    from app.iq_router import calculate_iq_data
+    from helpers.apidisconnect import disconnect_stats
+
+    disconnect_stats.clear()
+    release_second_read = asyncio.Event()
+    second_read_cancelled = asyncio.Event()
+
+    class SlowSecondReadClient:
+        backend = "local"
+
+        async def get_file_length(self, filepath):
+            return 100 * 1024 * 1024
+
+        async def get_blob_content(self, filepath, offset=None, length=None):
+            if offset > 0:
+                try:
+                    await release_second_read.wait()
+                except asyncio.CancelledError:
+                    second_read_cancelled.set()
+                    raise
+            return b"x" * length
+
+    # two blocks far enough apart that they are fetched with separate reads
+    stream = calculate_iq_data([0, 10_000], 1024, 4, "file.sigmf-data", SlowSecondReadClient(), None)
+    first_chunk = await asyncio.wait_for(stream.__anext__(), timeout=1)
+    assert first_chunk == b"x" * 4096
+    await stream.aclose()
+    await asyncio.wait_for(second_read_cancelled.wait(), timeout=1)
+    assert disconnect_stats.streams_cancelled == 1
+    assert disconnect_stats.cancelled_reads == 1
+    assert disconnect_stats.cancelled_bytes == 4096
+    assert disconnect_stats.skipped_bytes == 0
+
+
+@mock.patch("app.azure_client.decrypt", return_value="secret")
+def test_get_spectrogram_tile_fft_size_bound(mock_decrypt, client):
+    from app import datasources
+
+    client.app.dependency_overrides[datasources.get] = mock_get_test_datasource
+    response = client.get(
+        f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}'
+        "/file_path/spectrogram-tile?format=cf32_le&zoom=0&x=0&y=0&fft_size=131072"
+    )
+    assert response.status_code == 422
+
+
+@mock.patch("app.iq_router.AzureBlobClient.get_file_length", return_value=256 * 1024 * 8)
+@mock.patch("app.azure_client.decrypt", return_value="secret")
+def test_get_spectrogram_tile_cached_per_format(mock_decrypt, mock_get_file_length, client):
+    """The same tile read as another datatype is a different tile, not a cache hit."""
+    from app import datasources
+
+    client.app.dependency_overrides[datasources.get] = mock_get_test_datasource
+
+    async def get_blob_content(filepath, offset=None, length=None):
+        return numpy.random.randint(-100, 100, length, dtype=numpy.int8).tobytes()
+
+    url = (
+        f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}'
+        "/file_path/spectrogram-tile?zoom=0&x=0&y=0&fft_size=256&db_min=-50&db_max=50&format="
+    )
+    with mock.patch("app.azure_client.AzureBlobClient.get_blob_content", side_effect=get_blob_content) as mock_get_blob_content:
+        assert client.get(url + "cf32_le").status_code == 200
+        reads = mock_get_blob_content.call_count
+        assert client.get(url + "cf32_le").status_code == 200
+        assert mock_get_blob_content.call_count == reads
+        assert client.get(url + "ci16_le").status_code == 200
+        assert mock_get_blob_content.call_count > reads
@@ -17,7 +17,7 @@ def override_dependency_datasources_get():
     "app.metadata.get_metadata",
     return_value=valid_metadata,
 )
-@mock.patch("app.datasources_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_api_get_thumbnail_with_image(
     mock_decrypt: Mock,
@@ -47,7 +47,7 @@ async def test_api_get_thumbnail_with_image(
     return_value=b"<thumbnail data>",
 )
 @mock.patch("app.datasources_router.AzureBlobClient.upload_blob", return_value=None)
-@mock.patch("app.datasources_router.decrypt", return_value="secret")
+@mock.patch("app.azure_client.decrypt", return_value="secret")
 @pytest.mark.asyncio
 async def test_api_get_thumbnail_with_no_image(
     mock_decrypt: Mock,
@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import pytest
+from app.azure_client import AzureBlobClient
+from helpers.metrics import Registry, storage_bytes_read, storage_requests
+
+
+def test_registry_renders_counters_and_histograms():
+    metrics = Registry()
+    requests = metrics.counter("requests_total", "Requests")
+    latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    requests.inc(route="/a")
+    requests.inc(2, route="/a")
+    latency.observe(0.05, route="/a")
+    latency.observe(0.5, route="/a")
+    latency.observe(5, route="/a")
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE iqengine_requests_total counter" in lines
+    assert 'iqengine_requests_total{route="/a"} 3' in lines
+    assert 'iqengine_latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'iqengine_latency_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'iqengine_latency_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'iqengine_latency_seconds_sum{route="/a"} 5.55' in lines
+    assert 'iqengine_latency_seconds_count{route="/a"} 3' in lines
+
+
+def test_registry_stats_gauges():
+    metrics = Registry()
+    metrics.register_stats("cache", lambda: {"hits": 3, "hit_rate": 0.75, "enabled": True, "name": "x"}, cache="block")
+    metrics.register_stats("cache", lambda: {"hits": 1}, cache='odd"name')
+    metrics.register_stats("broken", lambda: 1 / 0)  # skipped, doesn't break the scrape
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE iqengine_cache_hits gauge" in lines
+    assert 'iqengine_cache_hits{cache="block"} 3' in lines
+    assert 'iqengine_cache_hits{cache="odd\\"name"} 1' in lines
+    assert 'iqengine_cache_hit_rate{cache="block"} 0.75' in lines
+    assert not any(line.startswith(("iqengine_cache_enabled", "iqengine_cache_name", "iqengine_broken")) for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_storage_calls_are_counted(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    with open(tmp_path / "rec.sigmf-meta", "wb") as f:
+        f.write(b"0" * 100)
+    reads = storage_requests.value(backend="local", operation="read", outcome="ok")
+    bytes_read = storage_bytes_read.value(backend="local")
+
+    client = AzureBlobClient("local", "local", None)
+    assert await client.get_blob_content("rec.sigmf-meta") == b"0" * 100
+    with pytest.raises(FileNotFoundError):
+        await client.get_blob_content("missing.sigmf-meta")
+
+    assert storage_requests.value(backend="local", operation="read", outcome="ok") == reads + 1
+    assert storage_requests.value(backend="local", operation="read", outcome="error") >= 1
+    assert storage_bytes_read.value(backend="local") == bytes_read + 100
+
+
+def test_mongo_command_metrics():
+    from app.database import command_metrics
+    from helpers.metrics import mongo_command_duration, mongo_commands
+
+    finds = mongo_commands.value(command="find", outcome="ok")
+    command_metrics.succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+    assert mongo_commands.value(command="find", outcome="ok") == finds + 1
+    assert mongo_command_duration.count(command="find") >= 1
+
+
+def test_metrics_endpoint(client):
+    client.get("/api/status")
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'iqengine_http_requests_total{method="GET",route="/api/status",status="200"}' in response.text
+    assert 'iqengine_cache_hits{cache="datasource"}' in response.text
+    assert "iqengine_local_io_completed" in response.text
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from app.azure_client import iter_local_file
+from helpers import localio
+from helpers.mmapcache import MmapCache
+
+
+def test_mmap_cache_reads_ranges(tmp_path):
+    path = str(tmp_path / "a.sigmf-data")
+    with open(path, "wb") as f:
+        f.write(bytes(range(256)) * 4)
+    cache = MmapCache(max_handles=2)
+    view = cache.read(path, 10, 20)
+    assert isinstance(view, memoryview)
+    assert bytes(view) == bytes(range(10, 30))
+    assert bytes(cache.read(path, 1020, 100)) == bytes(range(252, 256))  # short at the end of the file
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_mmap_cache_remaps_modified_files(tmp_path):
+    path = str(tmp_path / "a.sigmf-data")
+    with open(path, "wb") as f:
+        f.write(b"a" * 100)
+    cache = MmapCache(max_handles=2)
+    old_view = cache.read(path, 0, 10)
+    with open(path, "wb") as f:
+        f.write(b"b" * 200)
+    os.utime(path, ns=(0, 0))  # make sure the mtime changes even on coarse filesystem clocks
+    assert bytes(cache.read(path, 190, 10)) == b"b" * 10
+    assert len(cache) == 1
+    del old_view
+
+    empty_path = str(tmp_path / "empty.sigmf-data")
+    open(empty_path, "wb").close()
+    assert bytes(cache.read(empty_path, 0, 10)) == b""
+
+
+def test_mmap_cache_evicts_least_recently_used(tmp_path):
+    cache = MmapCache(max_handles=2)
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"{i}.sigmf-data"))
+        with open(paths[-1], "wb") as f:
+            f.write(bytes([i]) * 10)
+    held = cache.read(paths[0], 0, 5)  # a slice still being sent when its map is evicted
+    cache.read(paths[1], 0, 5)
+    cache.read(paths[2], 0, 5)
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert bytes(held) == bytes([0]) * 5
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_iter_local_file(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.azure_client.LOCAL_STREAM_CHUNK_SIZE", 4)
+    path = str(tmp_path / "a.sigmf-data")
+    with open(path, "wb") as f:
+        f.write(b"0123456789\n0123456789")
+    assert list(iter_local_file(path)) == [b"0123", b"4567", b"89\n0", b"1234", b"5678", b"9"]
+    assert b"".join(iter_local_file(path, offset=3, length=6)) == b"345678"
+
+
+@pytest.mark.asyncio
+async def test_local_reads_run_on_the_io_pool(tmp_path):
+    path = str(tmp_path / "a.sigmf-data")
+    with open(path, "wb") as f:
+        f.write(bytes(range(256)) * 64)
+    completed = localio.stats()["completed"]
+    contents = await asyncio.gather(*[localio.run_local_io(localio.read_local_file, path, i * 256, 256, True) for i in range(64)])
+    assert all(bytes(content) == bytes(range(256)) for content in contents)
+    assert bytes(await localio.run_local_io(localio.read_local_file, path)) == bytes(range(256)) * 64
+    stats = localio.stats()
+    assert stats["completed"] == completed + 65
+    assert stats["queued"] == 0 and stats["active"] == 0
+    assert stats["max_queued"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_local_reads_leave_the_queue(monkeypatch):
+    monkeypatch.setattr(localio, "_executor", ThreadPoolExecutor(max_workers=1))
+    release = threading.Event()
+    blocker = asyncio.ensure_future(localio.run_local_io(release.wait))
+    await asyncio.sleep(0.05)  # the only thread is busy, everything after this queues
+    ran = []
+    queued = [asyncio.ensure_future(localio.run_local_io(ran.append, i)) for i in range(10)]
+    await asyncio.sleep(0)
+    for task in queued:
+        task.cancel()
+    await asyncio.gather(*queued, return_exceptions=True)
+    release.set()
+    await blocker
+    await asyncio.get_running_loop().run_in_executor(localio._executor, lambda: None)  # drain anything left behind
+
+    stats = localio.stats()
+    assert stats["queued"] == 0 and stats["active"] == 0
+    assert stats["cancelled"] >= 10
+    assert ran == []
+    localio._executor.shutdown()
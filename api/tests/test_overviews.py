@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from helpers.urlmapping import ApiType, get_file_name, get_tile_file_name
+
+
+class FakeBlobClient:
+    backend = "local"
+    account = "local"
+    container = "local"
+    awsAccessKeyId = None
+
+    def __init__(self, files, writable=True):
+        self.files = files
+        self.writable = writable
+        self.uploads = []
+
+    def can_write(self):
+        return self.writable
+
+    async def blob_exist(self, filepath):
+        return filepath in self.files
+
+    async def get_file_length(self, filepath):
+        return len(self.files[filepath])
+
+    async def get_blob_content(self, filepath, offset=None, length=None):
+        return self.files[filepath][offset : offset + length]
+
+    async def get_new_thumbnail(self, data_type, filepath):
+        return b"thumbnail"
+
+    async def upload_blob(self, filepath, data):
+        self.uploads.append(filepath)
+        self.files[filepath] = data
+
+
+@pytest.mark.asyncio
+async def test_build_overviews_generates_missing_artifacts_once(monkeypatch):
+    # imported here, importing the routers before the client fixture patches check_access breaks the API tests
+    from app import overviews
+    from app.overviews import build_overviews, overview_progress
+
+    monkeypatch.setattr(overviews, "PRECOMPUTE_FFT_SIZE", 1024)
+    monkeypatch.setattr(overviews, "PRECOMPUTE_MAX_ZOOM", 1)
+    samples = (np.random.randn(1024 * 300) + 1j * np.random.randn(1024 * 300)).astype(np.complex64)
+    fake_client = FakeBlobClient({get_file_name("rec", ApiType.IQDATA): samples.tobytes()})
+
+    progress = await build_overviews(fake_client, [("rec", "cf32_le")])
+    assert progress["done"] == 1 and progress["failed"] == 0
+    assert overview_progress[("local", "local")] is progress
+    assert get_file_name("rec", ApiType.MINIMAP) in fake_client.uploads
+    assert get_file_name("rec", ApiType.THUMB) in fake_client.uploads
+    # zoom 0 is a single tile, zoom 1 is 2 tiles across and the 300 FFTs still fit in one row
+    assert get_tile_file_name("rec", "cf32_le", 1024, 0, 0, 0) in fake_client.uploads
+    assert get_tile_file_name("rec", "cf32_le", 1024, 1, 1, 0) in fake_client.uploads
+    assert progress["generated"] == len(fake_client.uploads) == 2 + 1 + 2
+
+    # a second run finds everything already there
+    progress = await build_overviews(fake_client, [("rec", "cf32_le")])
+    assert progress["generated"] == 0
+
+
+@pytest.mark.asyncio
+async def test_build_overviews_skips_read_only_datasource():
+    from app.overviews import build_overviews
+
+    fake_client = FakeBlobClient({}, writable=False)
+    assert await build_overviews(fake_client, [("rec", "cf32_le")]) is None
+    assert fake_client.uploads == []
@@ -18,3 +18,85 @@ async def test_query_meta_success(client):
 
     assert response.status_code == 200
     assert response.json() == valid_datasourcereference_array
+
+
+@pytest.mark.asyncio
+async def test_query_meta_match_mode(client):
+    client.post("/api/datasources", json=test_datasource).json()
+    client.post(
+        f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}/file_path/meta',
+        json=valid_metadata,
+    )
+    for query, expected in [
+        ("account=account&match_mode=exact", 1),
+        ("account=acc&match_mode=exact", 0),
+        ("account=acc&match_mode=prefix", 1),
+        ("account=ccount&match_mode=prefix", 0),
+        ("account=ccount", 1),  # regex matches anywhere
+        ("database_id=account/cont&match_mode=prefix", 1),
+        ("container=Container&match_mode=exact", 0),  # exact and prefix are case sensitive
+    ]:
+        response = client.get(f"/api/datasources/query?{query}")
+        assert response.status_code == 200
+        assert len(response.json()) == expected, query
+    assert client.get("/api/datasources/query?account=a&match_mode=fuzzy").status_code == 422
+
+
+def test_text_search_condition():
+    from app.metadata import text_search_condition
+
+    condition = text_search_condition("burst", {"annotations.core:label": 'LTE "uplink"', "global.core:author": None})
+    assert condition == {
+        "$text": {"$search": '"burst" "LTE  uplink "'},
+        "annotations.core:label": {"$regex": 'LTE\\ "uplink"', "$options": "i"},
+    }
+    assert text_search_condition(None, {"global.core:author": None}) == {}
+
+
+@pytest.mark.asyncio
+async def test_query_meta_text_search_with_geo_is_rejected(client):
+    # MongoDB doesn't allow $text and $near in the same query
+    response = client.get("/api/datasources/query?text=burst&search_mode=text&captures_geo=-175.8,4.4,500000")
+    assert response.status_code == 400
+    assert "geolocation" in response.json()["detail"]
+
+
+@pytest.mark.asyncio
+async def test_query_meta_cached_and_paged(client):
+    from helpers.querycache import query_cache
+
+    client.post("/api/datasources", json=test_datasource).json()
+    url = f'/api/datasources/{test_datasource["account"]}/{test_datasource["container"]}'
+    for name in ["rec_c", "rec_a", "rec_b"]:
+        client.post(f"{url}/{name}/meta", json=valid_metadata)
+
+    response = client.get("/api/datasources/query?account=account&offset=1&limit=1")
+    assert response.status_code == 200
+    assert response.headers["X-Total-Count"] == "3"
+    assert [item["file_path"] for item in response.json()] == ["rec_b"]  # sorted on the origin
+    hits = query_cache.hits
+    assert client.get("/api/datasources/query?limit=2&account=account").headers["X-Total-Count"] == "3"
+    assert query_cache.hits == hits + 1  # offset and limit aren't part of the query
+
+    client.post(f"{url}/rec_d/meta", json=valid_metadata)  # invalidates searches that could match this datasource
+    assert client.get("/api/datasources/query?account=account").headers["X-Total-Count"] == "4"
+
+
+def test_query_cache_invalidation_scope():
+    from helpers.querycache import QueryCache
+
+    cache = QueryCache(ttl=60)
+    everything = {"min_frequency": 1.0}
+    other_account = {"account": ["other"], "match_mode": "exact"}
+    by_database_id = {"database_id": ["acc/cont"]}
+    for params in [everything, other_account, by_database_id]:
+        cache.put(params, ["result"], cache.generation)
+    cache.invalidate("account", "container")
+    assert cache.get(everything) is None
+    assert cache.get(other_account) == ["result"]
+    assert cache.get(by_database_id) is None  # regex match_mode, acc and cont are substrings
+
+    generation = cache.generation
+    cache.invalidate("other", "container")
+    cache.put(everything, ["stale"], generation)  # the query started before the write
+    assert cache.get(everything) is None
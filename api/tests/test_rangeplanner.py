@@ -0,0 +1,66 @@
+import random
+
+import pytest
+from helpers.rangeplanner import READ_PROFILES, plan_reads
+
+
+def test_plan_reads_merges_small_gaps():
+    # blocks of 1024 bytes, a 1 block gap is much cheaper to read through than a second request
+    reads = plan_reads([0, 1, 3], block_size=256, bytes_per_iq_sample=4, blob_size=10_000_000, backend="azure")
+    assert len(reads) == 1
+    assert reads[0].offset == 0
+    assert reads[0].length == 4096
+    assert reads[0].segments == [(0, 2048), (3072, 4096)]
+
+
+def test_plan_reads_keeps_large_gaps_apart():
+    max_gap, _ = READ_PROFILES["local"]
+    block_bytes = 1024
+    far_block = (max_gap // block_bytes) + 5
+    reads = plan_reads([0, far_block], block_size=256, bytes_per_iq_sample=4, blob_size=10_000_000, backend="local")
+    assert [(r.offset, r.length) for r in reads] == [(0, 1024), (far_block * 1024, 1024)]
+    assert all(r.is_whole() for r in reads)
+
+
+def test_plan_reads_splits_long_runs():
+    _, max_read = READ_PROFILES["azure"]
+    num_blocks = 3 * max_read // 1024
+    reads = plan_reads(list(range(num_blocks)), block_size=256, bytes_per_iq_sample=4, blob_size=100 * max_read, backend="azure")
+    assert len(reads) == 3
+    assert all(r.length == max_read for r in reads)
+
+
+def test_plan_reads_clips_to_blob_size():
+    reads = plan_reads([0, 1, 2, 50], block_size=1, bytes_per_iq_sample=2, blob_size=5, backend="s3")
+    assert [(r.offset, r.length) for r in reads] == [(0, 5)]
+
+
+class FakeBlobClient:
+    backend = "azure"
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+
+    async def get_file_length(self, filepath):
+        return len(self.data)
+
+    async def get_blob_content(self, filepath, offset=None, length=None):
+        self.reads += 1
+        return self.data[offset : offset + length]
+
+
+@pytest.mark.asyncio
+async def test_calculate_iq_data_matches_block_by_block_reads():
+    # imported here, importing the routers before the client fixture patches check_access breaks the API tests
+    from app.iq_router import calculate_iq_data
+
+    data = bytes(random.getrandbits(8) for _ in range(64 * 1024))
+    block_size, bytes_per_iq_sample = 16, 4
+    block_indexes = sorted(random.sample(range(1100), 300))
+    fake_client = FakeBlobClient(data)
+    chunks = [chunk async for chunk in calculate_iq_data(list(block_indexes), block_size, bytes_per_iq_sample, "file.sigmf-data", fake_client, None)]
+    block_bytes = block_size * bytes_per_iq_sample
+    expected = b"".join(data[i * block_bytes : (i + 1) * block_bytes] for i in block_indexes)
+    assert b"".join(chunks) == expected
+    assert fake_client.reads == 1
@@ -32,7 +32,7 @@ async def test_required_roles_with_no_role():
     with patch("helpers.authorization.get_current_user") as mock_get_current_user:
         mock_get_current_user.return_value = {}
         access_control = required_roles(roles=None)
-        result = access_control()
+        result = await access_control()
         assert result == {}
 
 
@@ -48,12 +48,13 @@ TEST_PUBLIC_KEY = json_data["TEST_PUBLIC_KEY"]
 VALID_TEST_TOKEN = json_data["VALID_TEST_TOKEN"]
 
 
+@pytest.mark.asyncio
 @patch("helpers.authorization.jwks_handler.get_jwks")
-def test_get_current_user(mock_get_jwks):
+async def test_get_current_user(mock_get_jwks):
     # Tests `get_current_user` which is used to get the current user from the JWT token
     mock_get_jwks.return_value = ({"keys": [TEST_PUBLIC_KEY]}, "test/v2.0")
     os.environ["IQENGINE_APP_ID"] = "test"
     os.environ["IQENGINE_APP_AUTHORITY"] = "test"
     credentials = Mock(credentials=VALID_TEST_TOKEN)
-    current_user = get_current_user(token=credentials)
+    current_user = await get_current_user(token=credentials)
     assert current_user["preferred_username"] == "JohnDoe@test.com"
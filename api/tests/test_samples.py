@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from helpers.samples import get_bytes_per_iq_sample, get_samples
+
+
+def reference_samples(values, offset, scale, is_complex):
+    values = (values.astype(np.float64) - offset) / scale
+    return values[::2] + 1j * values[1::2] if is_complex else values.astype(np.complex128)
+
+
+@pytest.mark.parametrize(
+    "data_type,dtype,offset,scale",
+    [
+        ("ci8", "i1", 0, 127),
+        ("cu8", "u1", 127, 127),
+        ("ci16_le", "<i2", 0, 32767),
+        ("ci16_be", ">i2", 0, 32767),
+        ("cu16_be", ">u2", 32767, 32767),
+        ("ci32_le", "<i4", 0, 2147483647),
+        ("cu32_le", "<u4", 2147483647, 2147483647),
+        ("cf16", "<f2", 0, 1),
+        ("cf32_le", "<f4", 0, 1),
+        ("cf32_be", ">f4", 0, 1),
+        ("cf64_le", "<f8", 0, 1),
+        ("ri16_le", "<i2", 0, 32767),
+        ("ru8", "u1", 127, 127),
+        ("rf32_be", ">f4", 0, 1),
+    ],
+)
+def test_get_samples_all_datatypes(data_type, dtype, offset, scale):
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype) if np.dtype(dtype).kind in "iu" else None
+    if info:
+        values = rng.integers(info.min, info.max, 64, endpoint=True).astype(dtype)
+    else:
+        values = rng.standard_normal(64).astype(dtype)
+    is_complex = data_type.startswith("c")
+    samples = get_samples(values.tobytes(), data_type)
+    assert samples.dtype == np.complex64
+    assert len(samples) == (32 if is_complex else 64)
+    assert np.allclose(samples, reference_samples(values, offset, scale, is_complex), rtol=1e-6, atol=1e-6)
+    assert get_bytes_per_iq_sample(data_type) == len(values.tobytes()) // len(samples)
+
+
+def test_get_samples_legacy_names():
+    values = np.arange(-4, 4, dtype=np.int8)
+    assert np.array_equal(get_samples(values.tobytes(), "i8"), get_samples(values.tobytes(), "ci8"))
+    values = np.arange(8, dtype=np.float32)
+    assert get_samples(values.tobytes(), "f32_le").tolist() == [0 + 1j, 2 + 3j, 4 + 5j, 6 + 7j]
+    with pytest.raises(ValueError):
+        get_samples(values.tobytes(), "cq16")
+
+
+def test_get_samples_into_caller_buffer():
+    values = np.arange(8, dtype=np.int16)
+    out = np.full(10, 99, dtype=np.complex64)
+    samples = get_samples(values.tobytes(), "ci16_le", out=out)
+    assert np.shares_memory(samples, out)
+    assert len(samples) == 4
+    assert np.allclose(samples, (values[::2] + 1j * values[1::2]) / 32767)
+    assert out[4] == 99  # the rest of the buffer is untouched
+    with pytest.raises(ValueError):
+        get_samples(values.tobytes(), "ci16_le", out=np.empty(3, dtype=np.complex64))
@@ -0,0 +1,32 @@
+import io
+
+import numpy as np
+from helpers.samples import THUMBNAIL_HEIGHT, THUMBNAIL_WIDTH, get_spectrogram_image
+from helpers.spectrogram import apply_colormap, get_colormap_lut
+from PIL import Image
+
+
+def test_colormap_lut_matches_matplotlib():
+    from matplotlib import colormaps
+
+    lut = get_colormap_lut("viridis")
+    assert lut.shape == (256, 3) and lut.dtype == np.uint8
+    assert np.allclose(lut[200], np.array(colormaps["viridis"](200)[:3]) * 255, atol=1)
+    assert get_colormap_lut("viridis") is lut  # sampled once
+    assert apply_colormap(np.array([[0, 255]], dtype=np.uint8)).tolist() == [[lut[0].tolist(), lut[255].tolist()]]
+
+
+def test_get_spectrogram_image():
+    fft_size = 512
+    samples = np.exp(2j * np.pi * 0.25 * np.arange(fft_size * 128)).astype(np.complex64)
+    samples += (np.random.randn(len(samples)) + 1j * np.random.randn(len(samples))).astype(np.complex64) * 0.01
+    image = Image.open(io.BytesIO(get_spectrogram_image(samples.tobytes(), "cf32_le", fft_size)))
+    assert image.format == "JPEG"
+    assert image.size == (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+    pixels = np.asarray(image.convert("L")).astype(int)
+    # the tone at +fs/4 stands out from the noise in every row, viridis gets brighter towards the top of the scale
+    tone_columns = pixels[:, THUMBNAIL_WIDTH * 3 // 4 - 4 : THUMBNAIL_WIDTH * 3 // 4 + 4]
+    assert (tone_columns.max(axis=1) > pixels[:, : THUMBNAIL_WIDTH // 2].mean() + 60).all()
+
+    png = get_spectrogram_image(samples.tobytes(), "cf32_le", fft_size, format="png")
+    assert Image.open(io.BytesIO(png)).format == "PNG"
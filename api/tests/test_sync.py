@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from app import datasources
+from app.database import db
+from app.datasources import BlobVersion, encode_metadata_file, is_unchanged
+from bson import decode
+from pymongo.errors import BulkWriteError
+from app.models import DataSource
+
+
+def test_is_unchanged():
+    version = BlobVersion('"0x1"', "2024-01-01T00:00:00+00:00", 123)
+    synced = {
+        "traceability:etag": '"0x1"',
+        "traceability:last_modified": "2024-01-01T00:00:00+00:00",
+        "traceability:size": 123,
+        "traceability:data_size": 100,
+        "core:datatype": "ci16_le",
+    }
+    assert is_unchanged(synced, version, data_size=100)
+    assert not is_unchanged(synced, version, data_size=104)  # data file replaced
+    assert not is_unchanged(synced, version._replace(etag='"0x2"'), data_size=100)
+    assert not is_unchanged({"core:datatype": "ci16_le"}, version, data_size=100)  # synced before versions were stored
+    without_data_size = {key: value for key, value in synced.items() if key != "traceability:data_size"}
+    assert not is_unchanged({**without_data_size, "traceability:sample_length": 25.0}, version, data_size=100)  # resynced once
+    assert not is_unchanged(None, version, data_size=100)
+
+
+def test_encode_metadata_file():
+    content = json.dumps({"global": {"core:datatype": "ci16_le"}, "annotations": [{"core:sample_start": i} for i in range(1000)]})
+    metadata_bson, datatype = encode_metadata_file(content.encode(), {"traceability:revision": 0}, data_size=400)
+    metadata = decode(metadata_bson)
+    assert datatype == "ci16_le"
+    assert metadata["global"]["traceability:sample_length"] == 100
+    assert metadata["global"]["core:sample_rate"] == 1  # defaults filled in
+    assert metadata["captures"] == [{"core:sample_start": 0, "core:frequency": 0}]
+    assert len(metadata["annotations"]) == 1000
+    with pytest.raises(Exception):
+        encode_metadata_file(b'{"global": {}}', {}, data_size=400)
+
+
+def write_recording(base, name, num_samples=100):
+    with open(os.path.join(base, name + ".sigmf-meta"), "w") as f:
+        json.dump({"global": {"core:datatype": "ci16_le"}, "captures": [], "annotations": []}, f)
+    with open(os.path.join(base, name + ".sigmf-data"), "wb") as f:
+        f.write(b"\0" * 4 * num_samples)
+
+
+@pytest.mark.asyncio
+async def test_local_sync_is_incremental(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    await datasources.create_datasource(DataSource(account="local", container="local", name="local", type="api", description=""), None)
+    for i in range(3):
+        write_recording(tmp_path, f"rec{i}")
+
+    summary = await datasources.sync("local", "local")
+    assert (summary["added"], summary["unchanged"]) == (3, 0)
+    summary = await datasources.sync("local", "local")
+    assert (summary["added"], summary["updated"], summary["unchanged"]) == (0, 0, 3)
+
+    write_recording(tmp_path, "rec0", num_samples=200)
+    os.remove(tmp_path / "rec1.sigmf-meta")
+    summary = await datasources.sync("local", "local")
+    assert (summary["updated"], summary["unchanged"], summary["deleted"]) == (1, 1, 1)
+    rec0 = await db().metadata.find_one({"global.traceability:origin.file_path": "rec0"})
+    assert rec0["global"]["traceability:sample_length"] == 200
+    assert await db().metadata.count_documents({}) == 2
+    assert await db().versions.count_documents({}) == 4  # one per meta written
+
+
+@pytest.mark.asyncio
+async def test_local_sync_without_version_audit(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    monkeypatch.setattr(datasources, "SYNC_VERSION_AUDIT", False)
+    monkeypatch.setattr(datasources, "SYNC_BATCH_SIZE", 7)
+    await datasources.create_datasource(DataSource(account="local", container="local", name="local", type="api", description=""), None)
+    os.makedirs(tmp_path / "a" / "b")
+    for i in range(20):
+        write_recording(tmp_path, os.path.join("a", "b", f"rec{i}") if i % 2 else f"rec{i}")
+
+    summary = await datasources.sync("local", "local")
+    assert (summary["added"], summary["failed"]) == (20, 0)
+    assert await db().metadata.find_one({"global.traceability:origin.file_path": os.path.join("a", "b", "rec1")})
+    assert await db().versions.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_local_sync_counts_failed_writes_per_doc(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    await datasources.create_datasource(DataSource(account="local", container="local", name="local", type="api", description=""), None)
+    for i in range(3):
+        write_recording(tmp_path, f"rec{i}")
+    metadata_collection = db().metadata
+
+    class PartlyFailingMetadata:
+        # the first write of the batch fails, the rest go through like an unordered bulk write would do
+        def __getattr__(self, name):
+            return getattr(metadata_collection, name)
+
+        async def bulk_write(self, requests, ordered=True):
+            await metadata_collection.bulk_write(requests[1:], ordered=ordered)
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 2, "errmsg": "bad doc"}], "nUpserted": len(requests) - 1})
+
+    class FailingVersions:
+        async def insert_many(self, documents, ordered=True):
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 2, "errmsg": "bad audit"}]})
+
+    monkeypatch.setattr(datasources, "db", lambda: SimpleNamespace(metadata=PartlyFailingMetadata()))
+    monkeypatch.setattr(datasources, "versions_collection", lambda: FailingVersions())
+
+    summary = await datasources.sync("local", "local")
+    assert (summary["added"], summary["failed"]) == (2, 1)  # a failed audit insert isn't a failed metadata write
+    assert await metadata_collection.count_documents({}) == 2
+
+
+@pytest.mark.asyncio
+async def test_cloud_sync_pipeline(monkeypatch):
+    await datasources.create_datasource(DataSource(account="account", container="container", name="cloud", type="api", description=""), None)
+    meta = json.dumps({"global": {"core:datatype": "cf32_le"}, "captures": [], "annotations": []}).encode()
+
+    async def fake_listing(azure_blob_client):
+        yield "late.sigmf-meta", BlobVersion('"m"', "2024-01-01T00:00:00+00:00", len(meta))  # listed before its data
+        for i in range(25):
+            yield f"rec{i:02}.sigmf-data", BlobVersion('"d"', "2024-01-01T00:00:00+00:00", 800)
+            yield f"rec{i:02}.sigmf-meta", BlobVersion('"m"', "2024-01-01T00:00:00+00:00", len(meta))
+        yield "late.sigmf-data", BlobVersion('"d"', "2024-01-01T00:00:00+00:00", 800)
+        yield "nodata.sigmf-meta", BlobVersion('"m"', "2024-01-01T00:00:00+00:00", len(meta))
+
+    async def fake_get_blob_content(self, filepath, offset=None, length=None):
+        if filepath == "rec13.sigmf-meta":
+            return b"not json"
+        return meta
+
+    monkeypatch.setattr(datasources, "iter_datasource_blobs", fake_listing)
+    monkeypatch.setattr("app.azure_client.AzureBlobClient.get_blob_content", fake_get_blob_content)
+    monkeypatch.setattr(datasources, "SYNC_WORKERS", 3)
+    monkeypatch.setattr(datasources, "SYNC_BATCH_SIZE", 4)
+
+    status = await datasources.sync("account", "container")
+    assert status["phase"] == "done"
+    assert (status["listed"], status["added"], status["failed"]) == (26, 25, 1)
+    assert datasources.sync_status[("account", "container")] is status
+    assert await db().metadata.count_documents({"global.traceability:origin.container": "container"}) == 25
+    late = await db().metadata.find_one({"global.traceability:origin.file_path": "late"})
+    assert late["global"]["traceability:sample_length"] == 100
+
+
+@pytest.mark.asyncio
+async def test_local_sync_parses_big_metas_in_process_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    monkeypatch.setattr(datasources, "SYNC_PROCESSES", 1)
+    monkeypatch.setattr(datasources, "SYNC_PROCESS_MIN_BYTES", 0)  # every meta goes to the pool
+    await datasources.create_datasource(DataSource(account="local", container="local", name="local", type="api", description=""), None)
+    for i in range(3):
+        write_recording(tmp_path, f"rec{i}")
+    try:
+        summary = await datasources.sync("local", "local")
+        assert datasources._process_pool is not None
+        assert datasources._process_pool._mp_context.get_start_method() in ("forkserver", "spawn")
+    finally:
+        datasources.close_process_pool()
+    assert (summary["added"], summary["failed"]) == (3, 0)
+    assert await db().metadata.count_documents({}) == 3
+
+
+@pytest.mark.asyncio
+async def test_sync_returns_before_overviews_are_done(tmp_path, monkeypatch):
+    from app import overviews
+
+    monkeypatch.setenv("IQENGINE_BACKEND_LOCAL_FILEPATH", str(tmp_path))
+    monkeypatch.setenv("IQENGINE_PRECOMPUTE_OVERVIEWS", "1")
+    await datasources.create_datasource(DataSource(account="local", container="local", name="local", type="api", description=""), None)
+    write_recording(tmp_path, "rec0")
+    release = asyncio.Event()
+    built = []
+
+    async def slow_build_overviews(azure_client, recordings):
+        await release.wait()
+        built.extend(recordings)
+
+    monkeypatch.setattr(overviews, "build_overviews", slow_build_overviews)
+    summary = await datasources.sync("local", "local")
+    assert summary["added"] == 1
+    task = overviews.overview_tasks[("local", "local")]
+    assert not task.done() and built == []
+
+    release.set()
+    await task
+    assert built == [("rec0", "ci16_le")]
+    assert ("local", "local") not in overviews.overview_tasks
+
+    # a build still running at shutdown is cancelled
+    release.clear()
+    await datasources.sync("local", "local")
+    task = overviews.overview_tasks[("local", "local")]
+    await overviews.cancel_overview_tasks()
+    assert task.cancelled() and overviews.overview_tasks == {}
@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pytest
+from app.tiles import TILE_SIZE, build_tile_row, get_max_zoom
+from helpers.spectrogram import block_reduce, compute_spectrogram
+from PIL import Image
+
+
+def test_compute_spectrogram_matches_per_row_fft():
+    samples = (np.random.randn(4 * 64) + 1j * np.random.randn(4 * 64)).astype(np.complex64)
+    spectrogram = compute_spectrogram(samples, 64)
+    assert spectrogram.shape == (4, 64)
+    for i in range(4):
+        expected = 10 * np.log10(np.abs(np.fft.fftshift(np.fft.fft(samples[i * 64 : (i + 1) * 64]))) ** 2)
+        assert np.allclose(spectrogram[i], expected, atol=1e-3)
+
+
+def test_block_reduce_max():
+    array = np.arange(16).reshape(4, 4)
+    assert block_reduce(array, (2, 2), np.max).tolist() == [[5, 7], [13, 15]]
+
+
+def test_get_max_zoom():
+    assert get_max_zoom(256) == 0
+    assert get_max_zoom(1024) == 2
+    with pytest.raises(ValueError):
+        get_max_zoom(1000)
+
+
+def decode_tiles(tiles):
+    return [np.array(Image.open(io.BytesIO(tile))) for tile in tiles]
+
+
+class FakeBlobClient:
+    backend = "local"
+
+    def __init__(self, data):
+        self.data = data
+
+    async def get_file_length(self, filepath):
+        return len(self.data)
+
+    async def get_blob_content(self, filepath, offset=None, length=None):
+        return self.data[offset : offset + length]
+
+
+@pytest.mark.asyncio
+async def test_build_tile_row_zoom_levels():
+    fft_size = 1024
+    num_ffts = 600
+    # tone at +1/4 of the sample rate, which lands in bin 768 once fftshifted
+    samples = np.exp(2j * np.pi * 0.25 * np.arange(fft_size * num_ffts)).astype(np.complex64)
+    fake_client = FakeBlobClient(samples.tobytes())
+
+    tiles = decode_tiles(await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", fft_size, zoom=2, y=0))
+    assert len(tiles) == 4
+    assert all(tile.shape == (TILE_SIZE, TILE_SIZE) and tile.dtype == np.uint8 for tile in tiles)
+    assert tiles[3][:, 0].min() > 200  # the tone is the first column of the last tile
+    assert tiles[0].max() < 50
+
+    last_row = decode_tiles(await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", fft_size, zoom=2, y=2))
+    assert last_row[0].shape == (600 - 2 * TILE_SIZE, TILE_SIZE)
+    assert await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", fft_size, zoom=2, y=3) == []
+
+    # zoomed all the way out, one tile covers the whole band and 4x as many FFTs per pixel row
+    tiles = decode_tiles(await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", fft_size, zoom=0, y=0))
+    assert len(tiles) == 1
+    assert tiles[0].shape == (150, TILE_SIZE)
+    assert tiles[0][:, 768 // 4].min() > 200
+
+    with pytest.raises(ValueError):
+        await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", fft_size, zoom=3, y=0)
+
+
+@pytest.mark.asyncio
+async def test_build_tile_row_refuses_rows_over_the_sample_cap(monkeypatch):
+    monkeypatch.setattr("app.tiles.MAX_SAMPLES_PER_TILE_ROW", 256 * 1024)
+    samples = np.zeros(4096 * 256, dtype=np.complex64)
+    fake_client = FakeBlobClient(samples.tobytes())
+
+    assert len(await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", 1024, zoom=2, y=0)) == 4
+    with pytest.raises(ValueError):
+        await build_tile_row(fake_client, "file.sigmf-data", "cf32_le", 4096, zoom=4, y=0)
@@ -0,0 +1,17 @@
+import { convertToFloat32 } from '@/utils/fetch-more-data-source';
+
+describe('convertToFloat32', () => {
+  test('should interleave complex samples as they are', () => {
+    const buffer = new Int16Array([32767, 0, 0, -32767]).buffer;
+    expect(Array.from(convertToFloat32(buffer, 'ci16_le'))).toEqual([1, 0, 0, -1]);
+  });
+
+  test.each`
+    datatype     | values
+    ${'ri16_le'} | ${new Int16Array([32767, -32767])}
+    ${'ri8'}     | ${new Int8Array([127, -127])}
+    ${'rf32_le'} | ${new Float32Array([1, -1])}
+  `('should give real samples a zero Q', ({ datatype, values }) => {
+    expect(Array.from(convertToFloat32(values.buffer, datatype))).toEqual([1, 0, -1, 0]);
+  });
+});
@@ -98,6 +98,10 @@ describe('getBytesPerIQSample', () => {
     ${'ci8_be'}  | ${2}
     ${'ci16'}    | ${4}
     ${'ci16_le'} | ${4}
+    ${'ri8'}     | ${1}
+    ${'ri16_le'} | ${2}
+    ${'rf32_le'} | ${4}
+    ${'rf64_be'} | ${8}
   `('should have the number of bytes', ({ datatype, expected }) => {
     sampleSigmfMetadata.global['core:datatype'] = datatype;
     expect(sampleSigmfMetadata.getBytesPerIQSample()).toBe(expected);
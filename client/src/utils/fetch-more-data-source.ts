@@ -68,7 +68,13 @@ export function applyProcessing(samples, taps, squareSignal, pythonSnippet, pyod
 }
 
 export function convertToFloat32(buffer, dataType) {
-  if (dataType === 'ci8_le' || dataType === 'ci8' || dataType === 'i8') {
+  if (dataType.startsWith('r')) {
+    // real samples, decoded like their complex counterpart and then spread out as I/Q pairs with Q = 0
+    const real = convertToFloat32(buffer, 'c' + dataType.slice(1));
+    const samples = new Float32Array(real.length * 2);
+    for (let i = 0; i < real.length; i++) samples[i * 2] = real[i];
+    return samples;
+  } else if (dataType === 'ci8_le' || dataType === 'ci8' || dataType === 'i8') {
     let samples = Float32Array.from(new Int8Array(buffer));
     for (let i = 0; i < samples.length; i++) samples[i] = samples[i] / 127.0;
     return samples;
@@ -156,15 +156,16 @@ export function range(start: number, end: number): number[] {
 }
 
 export function dataTypeToBytesPerIQSample(dataType: string): number {
-  // remember there are 2 numbers per IQ sample
+  // remember there are 2 numbers per IQ sample, except for the real (r prefixed) datatypes which have just 1
+  const numbersPerSample = dataType.startsWith('r') ? 1 : 2;
   if (dataType.includes('8')) {
-    return 2;
+    return numbersPerSample;
   } else if (dataType.includes('16')) {
-    return 4;
+    return 2 * numbersPerSample;
   } else if (dataType.includes('32')) {
-    return 8;
+    return 4 * numbersPerSample;
   } else if (dataType.includes('64')) {
-    return 16;
+    return 8 * numbersPerSample;
   } else {
     console.error('unsupported datatype');
     return 2;
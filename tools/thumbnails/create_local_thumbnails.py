@@ -2,13 +2,13 @@
 # Copyright (c) 2023 Marc Lichtman
 # Licensed under the MIT License
 
-import io
 import json
 import os
+import sys
 
-import matplotlib.pyplot as plt
-import numpy as np
-from PIL import Image
+# share the spectrogram rendering with the API so thumbnails look the same wherever they're made
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "api"))
+from helpers.samples import get_spectrogram_image  # noqa: E402
 
 num_bytes = 1000000
 offset = 0
@@ -33,56 +33,15 @@ def spectro_maker(directory, basename):
         bytes = f.read()
     meta_data_global = meta_data.get("global", {})
     datatype = meta_data_global.get("core:datatype", "cf32_le")
-    sample_rate = float(meta_data_global.get("core:sample_rate", 0)) / 1e6  # MHz
-    center_freq = (
-        float(meta_data.get("captures", [])[0].get("core:frequency", 0)) / 1e6
-    )  # MHz
 
-    if datatype == "cf32_le":
-        samples = np.frombuffer(bytes, dtype=np.complex64)
-    elif datatype == "ci16_le":
-        samples = np.frombuffer(bytes, dtype=np.int16)
-        samples = samples[::2] + 1j * samples[1::2]
-    elif datatype == "ri16_le":
-        samples = np.frombuffer(bytes, dtype=np.int16)
-    else:
-        print("Datatype not implemented")
-        samples = np.zeros(1024)
-
-    # Generate spectrogram
-    num_rows = int(np.floor(len(samples) / fftSize))
-    spectrogram = np.zeros((num_rows, fftSize))
-    for i in range(num_rows):
-        spectrogram[i, :] = np.log10(
-            np.abs(
-                np.fft.fftshift(np.fft.fft(samples[i * fftSize: (i + 1) * fftSize]))
-            )
-            ** 2
-        )
-
-    fig = plt.figure()
-    ax = fig.add_subplot(1, 1, 1)
-    ax.imshow(
-        spectrogram,
-        aspect="auto",
-        extent=[
-            sample_rate / -2 + center_freq,
-            sample_rate / 2 + center_freq,
-            0,
-            len(samples) / sample_rate,
-        ],
-    )
-    plt.axis("off")
-    plt.grid(False)
-    img_buf = io.BytesIO()
-    plt.savefig(img_buf, bbox_inches="tight", pad_inches=0)
-    img_buf.seek(0)
-    im = Image.open(img_buf)
-
-    img_byte_arr = io.BytesIO()
-    im.convert("RGB").save(img_byte_arr, format="png")
+    try:
+        data = get_spectrogram_image(bytes, datatype, fftSize, format="png")
+    except ValueError as e:
+        print(e)
+        return
     output = f"{basename}.png"
-    im.save(directory + "\\" + output)
+    with open(directory + "\\" + output, "wb") as f:
+        f.write(data)
     # print("New image saved")
 
 
@@ -2,13 +2,15 @@
 # Licensed under the MIT License
 
 import argparse
-import io
 import json
+import os
+import sys
 
-import matplotlib.pyplot as plt
-import numpy as np
 from azure.storage.blob import BlobServiceClient
-from PIL import Image
+
+# share the spectrogram rendering with the API so thumbnails look the same wherever they're made
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "api"))
+from helpers.samples import get_spectrogram_image  # noqa: E402
 
 parser = argparse.ArgumentParser()
 parser.add_argument("connectionstring")
@@ -48,45 +50,13 @@ def spectro_maker(container_client, basename):
     metainfo = json.loads(metainfo)
 
     dtype = metainfo["global"]["core:datatype"]
-    if dtype == "ci16_le" or dtype == "ci16":
-        samples = np.frombuffer(data_bytes, dtype=np.int16)
-        samples = samples[::2] + 1j * samples[1::2]
-    elif dtype == "cf32_le":
-        samples = np.frombuffer(data_bytes, dtype=np.complex64)
-    elif dtype == "ci8" or dtype == "i8":
-        samples = np.frombuffer(data_bytes, dtype=np.int8)
-        samples = samples[::2] + 1j * samples[1::2]
-    else:
-        print("Datatype " + dtype + " not implemented")
+    try:
+        data = get_spectrogram_image(data_bytes, dtype, fftSize)
+    except ValueError as e:
+        print(e)
         return
-
-    # Generate spectrogram
-    num_rows = int(np.floor(len(samples) / fftSize))
-    spectrogram = np.zeros((num_rows, fftSize))
-    for i in range(num_rows):
-        spectrogram[i, :] = 10 * np.log10(
-            np.abs(
-                np.fft.fftshift(np.fft.fft(samples[i * fftSize: (i + 1) * fftSize]))
-            )
-            ** 2
-        )
-
-    fig = plt.figure(frameon=False)
-    ax = plt.Axes(fig, [0.0, 0.0, 1.0, 1.0])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    ax.imshow(spectrogram, cmap="viridis", aspect="auto", vmin=30+np.min(np.min(spectrogram))) # used to be jet
-
-    img_buf = io.BytesIO()
-    plt.savefig(img_buf, bbox_inches="tight", pad_inches=0)
-    img_buf.seek(0)
-    im = Image.open(img_buf)
-    img_byte_arr = io.BytesIO()
-    im.convert("RGB").save(img_byte_arr, format="jpeg")
-    data = img_byte_arr.getvalue()
     container_client.upload_blob(name=basename + ".jpeg", data=data, overwrite=True)
     print("Uploaded image!")
-    plt.close()
 
 
 if __name__ == "__main__":